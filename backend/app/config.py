@@ -1,3 +1,6 @@
+import json
+import os
+
 # SYSTEM_PROMPT_OFFLINE = """You are 'BridgeAI' in OFFLINE MODE - a basic AI assistant running on limited local resources.
 # Built by Team 'Cyber_Samurais' for the FutureStack GenAI Hackathon 2025.
 
@@ -52,6 +55,162 @@ ONLINE CAPABILITIES:
 
 Respond naturally and completely without meta-commentary about response length."""
 
-MAX_HISTORY = 8
-MODEL_PATH = "models/llama-2-7b-chat.Q4_K_M.gguf"
+MAX_STORED_MESSAGES = 200  # per-session cap; prompts are windowed by token budget, not count
+
+# Session store: in-memory LRU bounds, plus optional write-behind SQLite persistence (None disables)
+SESSION_MAX_COUNT = 1000
+SESSION_IDLE_TTL = 6 * 60 * 60  # seconds
+SESSION_MAX_BYTES = 64 * 1024 ** 2
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH") or None  # e.g. "data/sessions.db"
+
+# History compaction: once a session's stored turns pass COMPACTION_TRIGGER_TOKENS, a background thread folds
+# the older ones into a single rolling summary message, keeping the newest COMPACTION_KEEP_TOKENS verbatim.
+# Summarizers are tried in order: "local" (the default model tier, only while it has no other work) and
+# "online" (Cerebras, when configured). Token counts here are the online estimate (~3 chars/token).
+COMPACTION_ENABLED = os.getenv("COMPACTION_ENABLED", "false").lower() == "true"
+COMPACTION_TRIGGER_TOKENS = int(os.getenv("COMPACTION_TRIGGER_TOKENS", "3000"))
+COMPACTION_KEEP_TOKENS = 1000
+COMPACTION_MAX_INPUT_TOKENS = 2000  # turns folded per pass; longer backlogs take several passes
+COMPACTION_SUMMARY_TOKENS = 256
+COMPACTION_SUMMARIZERS = ("local", "online")
+COMPACTION_PROMPT = """Summarize the conversation below for your own later reference. Keep names, facts, numbers, \
+decisions, open questions and the user's preferences; drop greetings and filler. If an earlier summary is given, \
+merge it in. Write at most a short paragraph of plain text, with no preamble."""
+MODEL_PATH = os.getenv("MODEL_PATH", "models/llama-2-7b-chat.Q4_K_M.gguf")
 N_CTX = 4096
+N_BATCH = 512  # prompt tokens evaluated per llama.cpp batch (llama-cpp-python's default)
+
+# Local model loading (in the background, after startup)
+MODEL_USE_MMAP = os.getenv("MODEL_USE_MMAP", "true").lower() == "true"  # map weights instead of reading them in
+MODEL_USE_MLOCK = os.getenv("MODEL_USE_MLOCK", "false").lower() == "true"  # pin weights in RAM (needs memlock limits)
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "true").lower() == "true"  # prime the system prompt before serving
+OFFLINE_MAX_TOKENS = 512
+OFFLINE_TEMPERATURE = 0.5
+
+# Speculative decoding on the local model: "off", "prompt_lookup" (drafts copied from n-grams already in the
+# context; no second model) or "draft" (greedy drafts from a small GGUF model with the same vocabulary, e.g.
+# TinyLlama for Llama 2). The output is distributed exactly as without it. llama.cpp then keeps logits for every
+# position: n_ctx x n_vocab floats per worker (~0.5 GB for Llama 2 at 4096).
+SPECULATIVE_MODE = os.getenv("SPECULATIVE_MODE", "off")
+DRAFT_MODEL_PATH = os.getenv("DRAFT_MODEL_PATH", "models/tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf")
+SPECULATIVE_DRAFT_TOKENS = 8  # tokens proposed per decode
+SPECULATIVE_NGRAM = 3  # longest n-gram matched by prompt lookup
+SPECULATIVE_MIN_ACCEPTANCE = 0.2  # below this share of recent draft tokens kept, drafting pauses and re-probes later
+
+# Cerebras llama-3.3-70b context window and reply budget
+ONLINE_MODEL_CTX = 8192
+ONLINE_MAX_TOKENS = 1024
+ONLINE_TEMPERATURE = 0.8
+
+# Cerebras admission: online requests that would take the tokens used over the last minute (from the streams'
+# reported usage) plus those reserved by requests in flight past CEREBRAS_HEADROOM of the quota go to the local
+# model instead, before the API starts refusing them. 0 disables the check. The gateway calls Cerebras with the
+# same key and admits against its own CEREBRAS_TPM_SHARE of the quota; this process gets CEREBRAS_TPM_SHARE of it,
+# and the shares of the gateway and every backend replica must add up to at most 1.
+CEREBRAS_TOKENS_PER_MINUTE = int(os.getenv("CEREBRAS_TOKENS_PER_MINUTE", "60000"))
+CEREBRAS_TPM_SHARE = float(os.getenv("CEREBRAS_TPM_SHARE", "0.5"))
+CEREBRAS_HEADROOM = 0.9
+
+# Per-session and global rate limits on /api/chat, per minute, in requests and in estimated tokens (prompt plus
+# RATE_LIMIT_REPLY_TOKENS); a session may burst up to a minute's allowance. 0 disables a limit.
+RATE_LIMIT_SESSION_REQUESTS = int(os.getenv("RATE_LIMIT_SESSION_REQUESTS", "20"))
+RATE_LIMIT_SESSION_TOKENS = int(os.getenv("RATE_LIMIT_SESSION_TOKENS", "40000"))
+RATE_LIMIT_GLOBAL_REQUESTS = int(os.getenv("RATE_LIMIT_GLOBAL_REQUESTS", "600"))
+RATE_LIMIT_GLOBAL_TOKENS = int(os.getenv("RATE_LIMIT_GLOBAL_TOKENS", "1000000"))
+RATE_LIMIT_REPLY_TOKENS = 256
+RATE_LIMIT_MAX_SESSIONS = 10000  # sessions whose buckets are kept (least recently seen dropped first)
+
+# Cerebras usage log: written in batches by a background thread, rotated by size or date
+USAGE_LOG_PATH = "cerebras_usage.jsonl"
+USAGE_LOG_MAX_BYTES = 10 * 1024 ** 2
+USAGE_LOG_BACKUPS = 10  # rotated files kept
+USAGE_FLUSH_INTERVAL = 1.0  # seconds
+USAGE_FLUSH_BATCH = 100  # events
+
+# Exact-match response cache for repeat questions
+RESPONSE_CACHE_BYTES = 32 * 1024 ** 2
+RESPONSE_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+RESPONSE_CACHE_DB_PATH = os.getenv("RESPONSE_CACHE_DB_PATH") or None  # e.g. "data/responses.db", kept across restarts
+RESPONSE_CACHE_REPLAY_CHARS = 24  # characters per replayed SSE frame
+RESPONSE_CACHE_REPLAY_INTERVAL = 0.02  # seconds between replayed frames (0 = as fast as possible)
+
+# SSE framing: text deltas arriving faster than this are coalesced into one frame (0 sends every delta)
+SSE_FRAME_INTERVAL = 0.05  # seconds
+SSE_FRAME_MAX_CHARS = 256
+
+# Offline inference scheduler
+MODEL_WORKERS = 1  # Llama instances loaded side by side (each holds its own context)
+MAX_QUEUE_DEPTH = 8  # requests allowed to wait for a worker before new ones get a 429
+QUEUE_TIMEOUT = 120  # seconds a queued request may wait before giving up
+
+# Local model tiers, best first (see services/tiers.py). MODEL_TIERS is a JSON list of {"name", "model_path", "n_ctx"}
+# with optional "workers", "max_prompt_tokens" (only prompts up to this size), "tokens_per_s" (speed guess until
+# measured) and "memory_bytes" (else weights file + KV cache estimate). Unset: one tier from MODEL_PATH and N_CTX.
+# For example:
+# [{"name": "7b-q4", "model_path": "models/llama-2-7b-chat.Q4_K_M.gguf", "n_ctx": 4096},
+#  {"name": "7b-q2", "model_path": "models/llama-2-7b-chat.Q2_K.gguf", "n_ctx": 4096, "tokens_per_s": 14},
+#  {"name": "7b-q4-short", "model_path": "models/llama-2-7b-chat.Q4_K_M.gguf", "n_ctx": 1024, "workers": 2,
+#   "max_prompt_tokens": 512}]
+MODEL_TIERS = json.loads(os.getenv("MODEL_TIERS", "[]")) or [
+    {"name": "default", "model_path": MODEL_PATH, "n_ctx": N_CTX, "workers": MODEL_WORKERS}
+]
+TIER_MAX_WAIT = float(os.getenv("TIER_MAX_WAIT", "5"))  # seconds of estimated queue wait before moving to a faster tier
+TIER_MEMORY_BUDGET = int(os.getenv("TIER_MEMORY_BUDGET", "0"))  # bytes for loaded tiers; 0 loads every tier
+TIER_MIN_IDLE = 60  # seconds a swapped-in tier must go unused before it may be evicted again
+TIER_KV_BYTES_PER_TOKEN = 512 * 1024  # KV cache per context token, for memory estimates (Llama 2 7B, f16)
+
+# Per-session llama.cpp state snapshots reused across turns (0 disables). A snapshot holds the session's KV cache
+# (TIER_KV_BYTES_PER_TOKEN per token) plus the worker's float32 logits rows: N_BATCH of them, or one per context
+# token when speculative decoding is on (llama.cpp then keeps logits for every position). A snapshot larger than
+# the whole budget is never kept. The default suits CPU-only hosts and keeps the recent shorter sessions; a full
+# N_CTX session of Llama 2 7B needs about 2.1 GiB (2.5 GiB with speculation), so raise it on hosts with memory
+# to spare. Model loading warns when a tier's full-context snapshot does not fit.
+SNAPSHOT_LOGITS_ROW_BYTES = 32000 * 4  # Llama 2's vocabulary
+KV_CACHE_BYTES = int(os.getenv("KV_CACHE_BYTES", str(256 * 1024 ** 2)))
+
+# Batch endpoint (/api/chat/batch): continuous batching in a separate llama.cpp context that shares the
+# model weights. Its KV cache is allocated on first use; 0 sequences disables the endpoint. Interactive chat comes
+# first: the batch decodes on its own BATCH_THREADS (a quarter of the cores by default, so it leaves the chat
+# workers theirs) and holds its next step while chat requests wait in the default tier's queue.
+BATCH_MAX_SEQUENCES = 8  # sequences decoded together
+BATCH_N_CTX = 4096  # KV cells shared by all sequences in flight
+BATCH_MAX_ITEMS = 256  # prompts per request
+BATCH_THREADS = int(os.getenv("BATCH_THREADS", str(max(1, (os.cpu_count() or 4) // 4))))
+
+# Request tracing: spans per request (queueing, prompt building, prompt eval, decode, response writes), the last
+# TRACE_BUFFER_SIZE traces kept in memory for /api/debug/traces (0 disables). The gateway's trace id arrives
+# in the X-Trace-Id header.
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "1000"))
+TRACE_MAX_SPANS = 256  # per trace; later spans are counted but dropped
+
+# Session history endpoints (/api/sessions/{id}/history and /turns) are for the gateway only: they take
+# "Authorization: Bearer <SESSION_SYNC_TOKEN>", the same value as the gateway's; unset disables them
+SESSION_SYNC_TOKEN = os.getenv("SESSION_SYNC_TOKEN", "")
+
+# Admin endpoints (/api/debug/traces, /api/debug/profile, /api/usage) take "Authorization: Bearer <ADMIN_TOKEN>";
+# unset disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_MAX_SECONDS = 30  # longest sampling profile one request may run
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+
+# Retrieval over past answers: completed question/answer pairs from RETRIEVAL_SOURCES are embedded in the
+# background (by the default tier's model in embedding mode, or RETRIEVAL_EMBED_MODEL_PATH, e.g. a small GGUF
+# embedding model) into a memory-mapped index under RETRIEVAL_PATH. Offline prompts get the RETRIEVAL_TOP_K most
+# similar pairs scoring at least RETRIEVAL_MIN_SCORE (cosine; depends on the embedding model) as context, in at
+# most RETRIEVAL_CONTEXT_TOKENS. Embeddings are projected to RETRIEVAL_DIM dimensions, which keeps a search over
+# 100k entries within a few milliseconds. Each session only searches its own answers unless RETRIEVAL_SHARED,
+# which lets every session search every session's answers. Clearing a chat removes its answers either way.
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "false").lower() == "true"
+RETRIEVAL_PATH = os.getenv("RETRIEVAL_PATH", "data/retrieval")
+RETRIEVAL_EMBED_MODEL_PATH = os.getenv("RETRIEVAL_EMBED_MODEL_PATH", "")  # empty: the default tier's model
+RETRIEVAL_EMBED_CTX = 512  # tokens of a pair that are embedded (the rest is still stored and injected)
+RETRIEVAL_SOURCES = ("online", "mixed")  # history sources whose answers are indexed
+RETRIEVAL_SHARED = os.getenv("RETRIEVAL_SHARED", "false").lower() == "true"
+RETRIEVAL_DIM = 256
+RETRIEVAL_TOP_K = 3
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE", "0.5"))
+RETRIEVAL_CONTEXT_TOKENS = 768  # at most a third of the history budget
+RETRIEVAL_PASSAGE_TOKENS = 256  # per injected answer
+RETRIEVAL_MAX_ENTRIES = 200000  # oldest answers are dropped past this
+RETRIEVAL_COMPACT_RATIO = 0.25  # share of removed rows at which the files are rewritten without them
+RETRIEVAL_PROMPT = "Earlier answers to similar questions, for reference (use them only if they are relevant):"
@@ -1,6 +1,13 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware 
-from .routes import chat      
+from shared.tracing import TRACE_HEADER, TracingMiddleware
+from .routes import chat, debug
+from .routes.chat import response_cache
+from .services.cerebras_service import usage_recorder
+from .services.memory import answer_index, session_store
+from .services import cerebras_service, metrics
+from .services.model_service import close_batch_engine, is_model_ready, model_status, start_model_loading
 
 app = FastAPI(
     title="BridgeAI",
@@ -15,20 +22,57 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[TRACE_HEADER],
+)
+# Probes, scrapes and the trace/profile endpoints themselves are not traced
+app.add_middleware(
+    TracingMiddleware, tracer=metrics.tracer, exclude=("/healthz", "/readyz", "/metrics", "/api/debug")
 )
 
 
 app.include_router(chat.router, prefix="/api", tags=["Chat"])
+app.include_router(debug.router, prefix="/api/debug", tags=["Debug"])
 
 
 @app.on_event("startup")
 async def startup_event():
     print("🚀 BridgeAI backend starting up...")
+    # The local model loads in the background; online requests are served meanwhile
+    start_model_loading()
     
 
 @app.on_event("shutdown")
 async def shutdown_event():
     print("🛑 BridgeAI backend shutting down...")
+    session_store.close()
+    response_cache.close()
+    usage_recorder.close()
+    answer_index.close()
+    close_batch_engine()
+
+
+metrics.session_count.set_function(lambda: session_store.stats()["sessions"])
+metrics.session_bytes.set_function(lambda: session_store.stats()["bytes"])
+metrics.retrieval_entries.set_function(lambda: answer_index.stats()["entries"])
+
+
+@app.get("/healthz")
+def liveness():
+    """Liveness: the process is up and serving requests (the local model may still be loading)"""
+    return {"status": "alive"}
+
+
+@app.get("/readyz")
+def readiness():
+    """Readiness: the local model is loaded and warmed up; 503 until then"""
+    body = {"ready": is_model_ready(), "online_ready": cerebras_service.cerebras_client is not None, "model": model_status}
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.registry.render(), media_type=metrics.registry.content_type)
 
 
 @app.get("/")
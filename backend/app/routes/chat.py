@@ -1,74 +1,418 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from ..services.model_service import generate_offline_response_stream
-from ..services.cerebras_service import generate_online_response_stream
-from ..services.memory import clear_history, get_history
+from pydantic import BaseModel, Field, field_validator
+from starlette.concurrency import iterate_in_threadpool
+from typing import Literal, Optional
+from shared.guards import reject_if_rate_limited, require_admin, require_token
+from shared.rate_limit import RateLimiter
+from shared.response_cache import ResponseCache, cache_key
+from shared.sse import event, replay_frames
+from shared.tracing import annotate
+from ..config import (
+    ADMIN_TOKEN, BATCH_MAX_ITEMS, BATCH_MAX_SEQUENCES, OFFLINE_MAX_TOKENS, OFFLINE_TEMPERATURE, ONLINE_TEMPERATURE,
+    RATE_LIMIT_GLOBAL_REQUESTS, RATE_LIMIT_GLOBAL_TOKENS, RATE_LIMIT_MAX_SESSIONS, RATE_LIMIT_REPLY_TOKENS,
+    RATE_LIMIT_SESSION_REQUESTS, RATE_LIMIT_SESSION_TOKENS, RESPONSE_CACHE_BYTES, RESPONSE_CACHE_DB_PATH,
+    RESPONSE_CACHE_REPLAY_CHARS, RESPONSE_CACHE_REPLAY_INTERVAL, RESPONSE_CACHE_TTL, SESSION_SYNC_TOKEN,
+    SYSTEM_PROMPT_OFFLINE, SYSTEM_PROMPT_ONLINE
+)
+from ..services.model_service import (
+    batch_stats, discard_session_state, generate_batch, generate_offline_response_stream, get_batch_engine,
+    is_model_ready, model_status, session_states, speculative_decoding_stats, tiers
+)
+from ..services.scheduler import QueueFullError
+from ..services.cerebras_service import (
+    CEREMODEL, admit_online, cerebras_budget, estimate_prompt_tokens, generate_online_response_stream,
+    online_configured, online_failure_cause, usage_recorder
+)
+from ..services.memory import (
+    add_to_history, answer_index, clear_history, compactor, get_history, history_since, history_state,
+    replace_history, seed_history, session_store
+)
+from ..services.metrics import fallbacks, rate_limited, route_decisions, streams
+import asyncio
+import concurrent.futures
+import contextvars
 import json
 import logging
+import threading
+import time
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+response_cache = ResponseCache(RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL, db_path=RESPONSE_CACHE_DB_PATH)
+rate_limiter = RateLimiter(
+    RATE_LIMIT_SESSION_REQUESTS, RATE_LIMIT_SESSION_TOKENS, RATE_LIMIT_GLOBAL_REQUESTS, RATE_LIMIT_GLOBAL_TOKENS,
+    max_sessions=RATE_LIMIT_MAX_SESSIONS
+)
+
+def clamp_priority(priority: int) -> int:
+    """Clients can only yield their place: the default, 0, is the most urgent a request can ask to be."""
+    return max(priority, 0)
+
+
 class ChatRequest(BaseModel):
     session_id: str
     query: str
     online: bool = False
+    priority: int = 0  # lower values are served first by the local model queue; negatives count as 0
+    no_cache: bool = False  # skip the response cache lookup (a fresh answer still refreshes it)
+    compact: bool = False  # compact SSE framing: bare-string text frames, source sent once (see shared/sse.py)
+    tier: Optional[str] = None  # local model tier to use while it is loaded, instead of the load-aware choice
+    revision: Optional[int] = None  # session revision the client last saw; 409 if the history has moved on
+
+    _clamp_priority = field_validator("priority")(clamp_priority)
 
 
 class LocalStreamRequest(BaseModel):
-    """Request format for MCP Gateway to call local model"""
-    messages: list
+    """
+    Request format for MCP Gateway to call local model: the new turn as `query` at the caller's
+    `revision` of the session (409 if it differs), or the whole conversation as `messages`.
+    """
     session_id: str
+    query: Optional[str] = None
+    revision: Optional[int] = None
+    messages: list = []
+    priority: int = 0
+    assistant_prefix: str = ""  # partial answer to continue (mid-stream failover from the gateway)
+    no_cache: bool = False
+    compact: bool = False
+    tier: Optional[str] = None
+
+    _clamp_priority = field_validator("priority")(clamp_priority)
+
+
+class TurnMessage(BaseModel):
+    role: Literal["user", "assistant"]
+    content: str = Field(min_length=1)
 
 
-def safe_online_stream_with_fallback(session_id: str, query: str):
+class HistoryMessage(BaseModel):
+    """A stored message as the gateway copies it: the rolling summary is a system message (source "summary")."""
+    role: Literal["user", "assistant", "system"]
+    content: str
+    source: Optional[str] = None
+
+
+class SessionHistory(BaseModel):
+    """A full copy of a session's history for resync, at the revision (and generation) its holder had."""
+    messages: list[HistoryMessage]
+    revision: Optional[int] = None
+    generation: Optional[int] = None
+
+
+class SessionTurn(BaseModel):
+    """Messages of a turn answered elsewhere (e.g. by Cerebras through the gateway), to append."""
+    messages: list[TurnMessage]
+    source: Literal["online"] = "online"  # the gateway only records the Cerebras (and cached Cerebras) turns it answers
+
+
+class BatchItem(BaseModel):
+    query: str
+    id: Optional[str] = None  # echoed back in results; defaults to the item's position
+
+
+class BatchChatRequest(BaseModel):
+    """Independent questions for the local model, answered without session history"""
+    items: list[BatchItem]
+    max_tokens: int = OFFLINE_MAX_TOKENS
+    temperature: float = OFFLINE_TEMPERATURE
+    stream: bool = False  # also send {"id", "delta"} lines as text is generated
+
+
+def reject_if_not_loaded():
+    if not is_model_ready():
+        if model_status["state"] == "failed":
+            raise HTTPException(status_code=503, detail=f"Local model unavailable: {model_status['error']}")
+        raise HTTPException(status_code=503, detail="Local model is warming up", headers={"Retry-After": "10"})
+
+
+def reject_if_unavailable():
+    """
+    Turn a local model that is still loading (503) or a full queue (429) into an immediate
+    error response instead of a stalled stream.
+    """
+    reject_if_not_loaded()
+    try:
+        tiers.check_capacity()
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+
+
+async def off_loop(function, *args):
+    """Call a session history function, in a thread when it may have to read the session back from SQLite."""
+    if session_store.persistent:
+        return await asyncio.to_thread(function, *args)
+    return function(*args)
+
+
+async def reject_if_stale(session_id: str, revision: Optional[int]):
+    """
+    409 with the current revision when the caller's copy of the history is not the server's.
+    Reading the state also brings an evicted session back (off the event loop), so the handler's
+    later history calls stay in memory.
+    """
+    state = await off_loop(history_state, session_id)
+    if revision is not None and revision != state["revision"]:
+        detail = {"message": "Session history has diverged; resync from /api/sessions/{id}/history", **state}
+        raise HTTPException(status_code=409, detail=detail)
+
+
+def decide(route: str):
+    """Count a routing decision and note it on the request's trace."""
+    route_decisions.labels(route).inc()
+    annotate(route=route)
+
+
+def reject_unknown_tier(name: Optional[str]):
+    if name is not None and tiers.get(name) is None:
+        names = ", ".join(tier.name for tier in tiers.tiers)
+        raise HTTPException(status_code=400, detail=f"Unknown model tier {name!r} (available: {names})")
+
+
+def event_stream(frames, compact: bool = False, session_id: str = None) -> StreamingResponse:
+    """
+    SSE response; X-SSE-Framing tells the client which framing it is getting. With `session_id`,
+    a last event carries the session's revision once the turn is recorded.
+    """
+    if session_id is not None:
+        frames = with_revision(frames, session_id)
+    return StreamingResponse(
+        frames, media_type="text/event-stream", headers={"X-SSE-Framing": "compact" if compact else "standard"}
+    )
+
+
+async def with_revision(frames, session_id: str):
+    if not hasattr(frames, "__aiter__"):
+        frames = iterate_in_threadpool(frames)
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        await frames.aclose()  # a client that left stops the turn (see stream_until_disconnect)
+    state = await off_loop(history_state, session_id)
+    yield event(revision=state["revision"], generation=state["generation"])
+
+
+_END = object()
+PUMP_QUEUE_FRAMES = 16  # frames the generator thread may run ahead of the client
+
+
+async def stream_until_disconnect(frames, cancel: threading.Event):
+    """
+    Forward frames from a blocking generator, driven by its own thread.
+
+    The thread blocks once PUMP_QUEUE_FRAMES frames wait for the client, so a slow reader
+    holds back generation instead of the whole reply piling up in memory.
+
+    When the client disconnects, Starlette cancels this async generator; `cancel` is then set,
+    so the model stops within one token (or the request leaves the queue) and its worker is
+    freed for queued work, instead of generating until max_tokens for nobody.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(PUMP_QUEUE_FRAMES)
+
+    def forward(item) -> bool:
+        """Hand an item to the event loop, waiting for room; False once nobody will take it."""
+        try:
+            future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        except RuntimeError:
+            return False  # event loop already closed
+        while True:
+            try:
+                future.result(timeout=0.1)
+                return True
+            except concurrent.futures.CancelledError:
+                return False  # event loop shutting down
+            except concurrent.futures.TimeoutError:
+                if cancel.is_set():
+                    future.cancel()
+                    return False
+
+    def pump():
+        try:
+            for frame in frames:
+                if not forward(frame) or cancel.is_set():
+                    break
+        except Exception as e:
+            forward(e)
+        finally:
+            frames.close()
+            forward(_END)
+
+    # In a copy of this context, so spans from the generator land in the request's trace
+    threading.Thread(target=contextvars.copy_context().run, args=(pump,), name="sse-pump", daemon=True).start()
+    finished = False
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END:
+                finished = True
+                return
+            if isinstance(item, Exception):
+                finished = True
+                raise item
+            yield item
+    finally:
+        if not finished:
+            cancel.set()
+
+
+def online_cache_key(session_id: str, query: str) -> str:
+    return cache_key(query, SYSTEM_PROMPT_ONLINE, get_history(session_id), CEREMODEL, ONLINE_TEMPERATURE)
+
+
+def offline_cache_key(session_id: str, query: str, model_name: str) -> str:
+    return cache_key(query, SYSTEM_PROMPT_OFFLINE, get_history(session_id), model_name, OFFLINE_TEMPERATURE)
+
+
+async def lookup_cached(session_id: str, query: str, online: bool, tier: str = None):
+    """
+    Cached (answer, source) for this question in this conversation, or None.
+    Online requests only accept online answers; offline requests prefer the local models' own
+    answers (best tier first, or only the requested tier's) but will happily replay a (better)
+    cached online one. SQLite lookups run off the event loop.
+    """
+    keys = [online_cache_key(session_id, query)]
+    if not online:
+        models = [tiers.get(tier).model_name] if tier is not None else [t.model_name for t in tiers.tiers]
+        keys[:0] = [offline_cache_key(session_id, query, model) for model in dict.fromkeys(models)]
+    if response_cache.persistent:
+        return await asyncio.to_thread(response_cache.get, *keys)
+    return response_cache.get(*keys)
+
+
+def replay_cached_response(session_id: str, query: str, answer: str, source: str, compact: bool = False):
+    """Stream a cached answer at a steady pace and record the turn like a generated one."""
+    timer = streams.timer("cache")
+    try:
+        for i, frame in enumerate(replay_frames(answer, source, RESPONSE_CACHE_REPLAY_CHARS, compact)):
+            if i and RESPONSE_CACHE_REPLAY_INTERVAL:
+                time.sleep(RESPONSE_CACHE_REPLAY_INTERVAL)
+            timer.token()
+            yield frame
+    finally:
+        timer.finish()
+    add_to_history(session_id, "user", query, source=source)
+    add_to_history(session_id, "assistant", answer, source=source)
+
+
+def cached_offline_stream(session_id: str, query: str, priority: int = 0, cancel: threading.Event = None,
+                          compact: bool = False, tier: str = None):
+    """Offline stream that caches the answer under the serving tier's model once it completes."""
+    history = get_history(session_id)
+    partial = []
+    served = {}
+    yield from generate_offline_response_stream(
+        session_id, query, priority, partial=partial, cancel=cancel, compact=compact, tier=tier, served=served
+    )
+    if partial and (cancel is None or not cancel.is_set()):
+        model_name = tiers.get(served["tier"]).model_name
+        key = cache_key(query, SYSTEM_PROMPT_OFFLINE, history, model_name, OFFLINE_TEMPERATURE)
+        response_cache.put(key, "".join(partial).strip(), "offline")
+
+
+def safe_online_stream_with_fallback(session_id: str, query: str, priority: int = 0,
+                                     cancel: threading.Event = None, compact: bool = False, reservation: tuple = None):
     """
     Wrapper generator that attempts online streaming but falls back to offline on any error.
-    This handles errors that occur during the streaming process itself.
+    This handles errors that occur during the streaming process itself: text the client already
+    received is kept, and the offline model continues the answer from it instead of restarting.
+    Only answers the online model finished on its own are cached.
     """
+    key = online_cache_key(session_id, query)
+    partial = []
     try:
-        # Try to get the online generator
-        online_gen = generate_online_response_stream(session_id, query)
-        
         # Try to start streaming from online model
-        for chunk in online_gen:
+        for chunk in generate_online_response_stream(session_id, query, partial, cancel, compact, reservation):
             yield chunk
+        if cancel is None or not cancel.is_set():
+            response_cache.put(key, "".join(partial).strip(), "online")
+        return
             
     except Exception as e:
-        # If any error occurs during online streaming, fall back to offline
-        logger.warning(f"Online model failed during streaming, falling back to offline: {e}")
-        
-        # Send a notification chunk about the fallback
-        yield f"data: {json.dumps({'content': '', 'fallback': True, 'source': 'offline'})}\n\n"
-        
-        # Stream from offline model
-        try:
-            offline_gen = generate_offline_response_stream(session_id, query)
-            for chunk in offline_gen:
-                yield chunk
-        except Exception as offline_error:
-            logger.error(f"Offline model also failed: {offline_error}")
-            yield f"data: {json.dumps({'error': 'Both models failed', 'content': 'Error: Could not generate response.'})}\n\n"
-            yield f"data: {json.dumps({'done': True})}\n\n"
+        logger.warning(f"Online model failed during streaming, continuing offline after {len(partial)} chunks: {e}")
+        # Still one "cerebras" routing decision: the fallback is counted (and traced) by its cause
+        cause = online_failure_cause(e)
+        fallbacks.labels(cause, "mid_stream" if partial else "before_first_token").inc()
+        annotate(fallback=cause)
+
+    prefix = "".join(partial)
+
+    # Send a notification chunk about the fallback
+    yield event(content="", fallback=True, source="offline", continuation=bool(prefix))
+
+    # Stream the rest of the answer from the offline model
+    served = {}
+    failed = False
+    try:
+        offline_gen = generate_offline_response_stream(
+            session_id, query, priority, assistant_prefix=prefix, cancel=cancel, compact=compact, served=served
+        )
+        for chunk in offline_gen:
+            yield chunk
+    except Exception as offline_error:
+        logger.error(f"Offline model also failed: {offline_error}")
+        failed = True
+    if prefix and not served.get("recorded") and (cancel is None or not cancel.is_set()):
+        # The continuation failed or was turned away (busy, warming up): keep what the user did see
+        add_to_history(session_id, "user", query, source="online")
+        add_to_history(session_id, "assistant", prefix.strip(), source="online")
+    if failed:
+        yield event(error="Both models failed", content="Error: Could not generate response.")
+        yield event(done=True)
 
 
 @router.post("/chat")
 async def chat(request: ChatRequest):
     try:
-        if request.online:
+        reject_unknown_tier(request.tier)
+        await reject_if_stale(request.session_id, request.revision)
+        prompt_tokens = estimate_prompt_tokens(request.session_id, request.query)
+        reject_if_rate_limited(rate_limiter, rate_limited, request.session_id, prompt_tokens + RATE_LIMIT_REPLY_TOKENS)
+        cached = None if request.no_cache else await lookup_cached(
+            request.session_id, request.query, request.online, request.tier
+        )
+        if cached:
+            decide("cache")
+            return event_stream(
+                replay_cached_response(request.session_id, request.query, *cached, compact=request.compact),
+                request.compact, request.session_id
+            )
+
+        cancel = threading.Event()
+        # Past the Cerebras quota, online requests go to the local model up front (unless it is not loaded yet);
+        # without an API key they go there without reserving quota nobody would use
+        online = request.online and online_configured()
+        reservation = admit_online(prompt_tokens) if online else None
+        if online and (reservation is not None or not is_model_ready()):
+            decide("cerebras")
             # Use the safe wrapper that handles fallback during streaming
-            return StreamingResponse(
-                safe_online_stream_with_fallback(request.session_id, request.query),
-                media_type="text/event-stream"
+            return event_stream(
+                stream_until_disconnect(
+                    safe_online_stream_with_fallback(
+                        request.session_id, request.query, request.priority, cancel, request.compact, reservation
+                    ),
+                    cancel
+                ),
+                request.compact, request.session_id
             )
         else:
             # Direct offline streaming
-            return StreamingResponse(
-                generate_offline_response_stream(request.session_id, request.query),
-                media_type="text/event-stream"
+            reject_if_unavailable()
+            decide("quota" if online else "local")
+            return event_stream(
+                stream_until_disconnect(
+                    cached_offline_stream(
+                        request.session_id, request.query, request.priority, cancel, request.compact, request.tier
+                    ),
+                    cancel
+                ),
+                request.compact, request.session_id
             )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Chat endpoint error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -77,6 +421,7 @@ async def chat(request: ChatRequest):
 @router.post("/chat/clear/{session_id}")
 async def reset_chat(session_id: str):
     clear_history(session_id)
+    discard_session_state(session_id)
     return {"message": "Chat history cleared."}
 
 
@@ -84,25 +429,216 @@ async def reset_chat(session_id: str):
 async def local_stream_endpoint(request: LocalStreamRequest):
     """
     Endpoint for MCP Gateway to call when routing to local model
-    Accepts standard messages format and streams response
+    Takes the new turn against the session's server-side history (or a full messages list) and streams response
     """
     try:
-        # Extract the user query from messages
-        user_message = None
-        for msg in reversed(request.messages):
-            if msg.get("role") == "user":
-                user_message = msg.get("content")
-                break
+        if request.query is not None:
+            user_message = request.query
+            await reject_if_stale(request.session_id, request.revision)
+        else:
+            # Extract the user query from messages
+            user_message = None
+            for index in range(len(request.messages) - 1, -1, -1):
+                if request.messages[index].get("role") == "user":
+                    user_message = request.messages[index].get("content")
+                    break
+            # A session new to this replica starts from the caller's copy
+            if user_message:
+                seed_history(request.session_id, request.messages[:index])
         
         if not user_message:
             raise HTTPException(status_code=400, detail="No user message found")
+        reject_unknown_tier(request.tier)
         
+        # The gateway drops this connection when its client leaves or a hedge loses
+        cancel = threading.Event()
+
+        # Continuations are never cached: the answer depends on the prefix
+        if request.assistant_prefix:
+            reject_if_unavailable()
+            decide("continuation")
+            return event_stream(
+                stream_until_disconnect(
+                    generate_offline_response_stream(
+                        request.session_id, user_message, request.priority,
+                        assistant_prefix=request.assistant_prefix, cancel=cancel, compact=request.compact,
+                        tier=request.tier
+                    ),
+                    cancel
+                ),
+                request.compact, request.session_id
+            )
+
+        cached = None if request.no_cache else await lookup_cached(
+            request.session_id, user_message, online=False, tier=request.tier
+        )
+        if cached:
+            decide("cache")
+            return event_stream(
+                replay_cached_response(request.session_id, user_message, *cached, compact=request.compact),
+                request.compact, request.session_id
+            )
+
         # Stream from local model
-        return StreamingResponse(
-            generate_offline_response_stream(request.session_id, user_message),
-            media_type="text/event-stream"
+        reject_if_unavailable()
+        decide("local")
+        return event_stream(
+            stream_until_disconnect(
+                cached_offline_stream(
+                    request.session_id, user_message, request.priority, cancel, request.compact, request.tier
+                ),
+                cancel
+            ),
+            request.compact, request.session_id
         )
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Local stream endpoint error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def batch_lines(request: BatchChatRequest, cancel: threading.Event):
+    """NDJSON: one line per finished item in completion order (plus deltas with `stream`), then a summary."""
+    ids = [item.id if item.id is not None else str(i) for i, item in enumerate(request.items)]
+    started = time.monotonic()
+    tokens = 0
+    failed = 0
+    queries = [item.query for item in request.items]
+    for kind, index, value in generate_batch(queries, request.max_tokens, request.temperature, cancel):
+        if kind == "delta":
+            if request.stream:
+                yield json.dumps({"id": ids[index], "delta": value}) + "\n"
+        elif kind == "done":
+            tokens += value["completion_tokens"]
+            yield json.dumps({"id": ids[index], **value}) + "\n"
+        else:
+            failed += 1
+            yield json.dumps({"id": ids[index], "error": value}) + "\n"
+
+    seconds = time.monotonic() - started
+    yield json.dumps({
+        "done": True,
+        "items": len(ids),
+        "failed": failed,
+        "completion_tokens": tokens,
+        "seconds": round(seconds, 3),
+        "tokens_per_second": round(tokens / seconds, 1) if seconds else 0.0,
+    }) + "\n"
+
+
+@router.post("/chat/batch")
+async def chat_batch(request: BatchChatRequest):
+    """
+    Bulk jobs (FAQ lists, report summaries): answer many independent questions on the local
+    model with continuous batching, streamed back as NDJSON as each item finishes.
+    """
+    if BATCH_MAX_SEQUENCES <= 0:
+        raise HTTPException(status_code=404, detail="Batch decoding is disabled")
+    if not request.items:
+        raise HTTPException(status_code=400, detail="No items")
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+    if not 1 <= request.max_tokens <= OFFLINE_MAX_TOKENS:
+        raise HTTPException(status_code=400, detail=f"max_tokens must be between 1 and {OFFLINE_MAX_TOKENS}")
+    reject_if_not_loaded()
+    try:
+        # First use allocates the batch context; keep that off the event loop
+        await asyncio.to_thread(get_batch_engine)
+    except Exception as e:
+        logger.error(f"Batch engine unavailable: {e}")
+        raise HTTPException(status_code=503, detail=f"Batch decoding unavailable: {e}")
+
+    decide("batch")
+    cancel = threading.Event()
+    return StreamingResponse(
+        stream_until_disconnect(batch_lines(request, cancel), cancel), media_type="application/x-ndjson"
+    )
+
+
+@router.get("/local/stats")
+async def local_stats():
+    """
+    Local model load state, tiers (queues, speed, memory), KV-cache reuse, speculative decoding,
+    batch engine, and the retrieval index over past answers
+    """
+    return {
+        "model": model_status,
+        "tiers": tiers.stats(),
+        "kv_cache": session_states.stats(),
+        "speculative": speculative_decoding_stats(),
+        "batch": batch_stats(),
+        "retrieval": answer_index.stats(),
+    }
+
+
+@router.get("/cache/stats")
+async def cache_stats():
+    """Response cache size, hit rate and evictions"""
+    return response_cache.stats()
+
+
+@router.get("/usage")
+async def usage_summary(session_id: str = None, authorization: Optional[str] = Header(None)):
+    """
+    Admin only, since it names sessions: rolling Cerebras token usage, with totals, per model,
+    per hour, top sessions and model mismatches
+    """
+    require_admin(authorization, ADMIN_TOKEN)
+    if session_id is not None:
+        usage = usage_recorder.session_usage(session_id)
+        if usage is None:
+            raise HTTPException(status_code=404, detail="No usage recorded for this session")
+        return {"session_id": session_id, **usage}
+    return usage_recorder.summary()
+
+
+@router.get("/limits/stats")
+async def limits_stats():
+    """Rate limits with what is left of the global allowance, and the Cerebras quota admission state"""
+    return {"rate_limits": rate_limiter.stats(), "cerebras_quota": cerebras_budget.stats()}
+
+
+def require_session_sync(authorization: Optional[str]):
+    """403 unless the caller is the gateway (see SESSION_SYNC_TOKEN): histories are not for clients to read or write."""
+    require_token(authorization, SESSION_SYNC_TOKEN, "Session sync", "SESSION_SYNC_TOKEN")
+
+
+@router.get("/sessions/{session_id}/history")
+async def session_history(session_id: str, revision: Optional[int] = None, generation: Optional[int] = None,
+                          authorization: Optional[str] = Header(None)):
+    """
+    The session's revision and generation, with the messages appended since the caller's
+    `revision` of the same `generation`; otherwise (`reset`) the whole stored history.
+    """
+    require_session_sync(authorization)
+    return await off_loop(history_since, session_id, revision, generation)
+
+
+@router.put("/sessions/{session_id}/history")
+async def resync_session_history(session_id: str, history: SessionHistory,
+                                 authorization: Optional[str] = Header(None)):
+    """Replace the session's history with the caller's copy (full resync)"""
+    require_session_sync(authorization)
+    messages = [message.model_dump(exclude_none=True) for message in history.messages]
+    return replace_history(session_id, messages, history.revision, history.generation)
+
+
+@router.post("/sessions/{session_id}/turns")
+async def record_session_turn(session_id: str, turn: SessionTurn, authorization: Optional[str] = Header(None)):
+    """Append a turn answered elsewhere; returns the new revision"""
+    require_session_sync(authorization)
+
+    def record():
+        for message in turn.messages:
+            add_to_history(session_id, message.role, message.content, source=turn.source)
+        return history_state(session_id)
+
+    return await off_loop(record)
+
+
+@router.get("/sessions/stats")
+async def session_stats():
+    """Session store size, memory use and evictions, and history compaction"""
+    return {**session_store.stats(), "compaction": compactor.stats()}
@@ -0,0 +1,6 @@
+"""Trace and profiler endpoints, mounted under /api/debug (see shared/debug.py)."""
+from shared.debug import debug_router
+from ..config import ADMIN_TOKEN, PROFILE_INTERVAL, PROFILE_MAX_SECONDS
+from ..services.metrics import tracer
+
+router = debug_router(tracer, ADMIN_TOKEN, PROFILE_INTERVAL, PROFILE_MAX_SECONDS)
@@ -0,0 +1,305 @@
+#type:ignore
+import codecs
+import collections
+import logging
+import queue
+import threading
+import time
+
+import llama_cpp
+
+logger = logging.getLogger(__name__)
+
+
+class BatchJob:
+    """
+    One batch request's settings, and a queue of result events for the caller.
+
+    Events are ("delta", index, text), ("done", index, result) and ("error", index, message).
+    Setting `cancelled` drops the job's queued prompts and stops its running sequences.
+    """
+
+    def __init__(self, max_tokens: int, temperature: float):
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+
+
+class _Sequence:
+    """A prompt being decoded in one llama.cpp sequence slot."""
+
+    def __init__(self, job: BatchJob, index: int, tokens: list):
+        self.job = job
+        self.index = index
+        self.tokens = tokens
+        self.seq_id = None
+        self.n_past = 0
+        self.last_token = None
+        self.generated = 0
+        self.text = ""
+        self.sent = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")("ignore")
+        self.sampler = None
+        self.started_at = None
+
+    @property
+    def reserved(self) -> int:
+        return len(self.tokens) + self.job.max_tokens
+
+
+class BatchEngine:
+    """
+    Continuous batching on the local model.
+
+    A dedicated llama.cpp context (sharing the loaded model's weights) holds up to
+    `max_sequences` independent sequences in its KV cache. Every step decodes one llama_batch
+    with the next token of each generating sequence plus prompt chunks of newly admitted ones;
+    on a CPU that step costs little more than decoding a single sequence, so aggregate tokens/s
+    grows with the number of sequences in flight. Sequences are admitted as soon as one
+    finishes and its slot and KV cells are free, rather than waiting for the whole batch.
+
+    The context decodes on `n_threads` (default: the model's own). While `paused()` is true
+    (e.g. interactive requests are queued for the model), the engine holds its next step.
+    """
+
+    def __init__(self, llm, max_sequences: int, n_ctx: int, n_batch: int = 512,
+                 stop: tuple = ("User:", "Assistant:"), n_threads: int = None, paused=None,
+                 pause_interval: float = 0.01):
+        self.llm = llm
+        self.max_sequences = max_sequences
+        self.n_ctx = n_ctx
+        self.n_batch = n_batch
+        self.stop = stop
+        self.paused = paused
+        self.pause_interval = pause_interval
+        self._holdback = max(len(s) for s in stop) - 1 if stop else 0
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx
+        params.n_batch = n_batch
+        params.n_ubatch = n_batch
+        params.n_seq_max = max_sequences
+        params.kv_unified = True  # KV cells are shared, so short prompts leave room for long ones
+        params.n_threads = n_threads or llm.context_params.n_threads
+        params.n_threads_batch = n_threads or llm.context_params.n_threads_batch
+        self._ctx = llama_cpp.llama_init_from_model(llm.model, params)
+        if self._ctx is None:
+            raise RuntimeError(f"Failed to create a batch context for {max_sequences} sequences")
+        self._memory = llama_cpp.llama_get_memory(self._ctx)
+        self._vocab = llama_cpp.llama_model_get_vocab(llm.model)
+        self._batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+
+        self._cond = threading.Condition()
+        self._pending = collections.deque()
+        self._active = {}  # seq_id -> _Sequence
+        self._free_ids = list(range(max_sequences))
+        self._reserved = 0  # KV cells promised to active sequences
+        self._closed = False
+
+        self._completed = 0
+        self._cancelled = 0
+        self._generated = 0
+        self._decode_calls = 0
+        self._batched_tokens = 0
+        self._busy_seconds = 0.0
+        self._paused_seconds = 0.0
+        self._peak_active = 0
+
+        self._thread = threading.Thread(target=self._run, name="batch-engine", daemon=True)
+        self._thread.start()
+
+    # ----- Callers -----
+
+    def submit(self, job: BatchJob, tokenized: list):
+        """Queue a job's tokenized prompts; results arrive on `job.events`. Each must fit n_ctx with max_tokens."""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Batch engine is shut down")
+            for index, tokens in enumerate(tokenized):
+                self._pending.append(_Sequence(job, index, tokens))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=10)
+        for seq in list(self._active.values()):
+            self._release(seq)
+        llama_cpp.llama_batch_free(self._batch)
+        llama_cpp.llama_free(self._ctx)
+
+    def stats(self) -> dict:
+        with self._cond:
+            decodes = self._decode_calls
+            return {
+                "max_sequences": self.max_sequences,
+                "n_ctx": self.n_ctx,
+                "active": len(self._active),
+                "pending": len(self._pending),
+                "peak_active": self._peak_active,
+                "completed": self._completed,
+                "cancelled": self._cancelled,
+                "generated_tokens": self._generated,
+                "decode_calls": decodes,
+                "avg_tokens_per_decode": round(self._batched_tokens / decodes, 2) if decodes else 0.0,
+                "busy_seconds": round(self._busy_seconds, 3),
+                "paused_seconds": round(self._paused_seconds, 3),
+                "tokens_per_second": round(self._generated / self._busy_seconds, 1) if self._busy_seconds else 0.0,
+            }
+
+    # ----- Engine thread -----
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._active and not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                self._admit()
+            if self._active and self.paused is not None and self.paused():
+                # Interactive work is waiting: give it the cores until it is served
+                time.sleep(self.pause_interval)
+                self._paused_seconds += self.pause_interval
+                continue
+            if self._active:
+                started = time.perf_counter()
+                try:
+                    self._step()
+                except Exception as e:
+                    logger.error(f"Batch decode failed: {e}")
+                    for seq in list(self._active.values()):
+                        seq.job.events.put(("error", seq.index, str(e)))
+                        self._release(seq)
+                self._busy_seconds += time.perf_counter() - started
+
+    def _admit(self):
+        """Move queued prompts into free sequence slots while their KV cells fit."""
+        while self._pending and self._free_ids:
+            seq = self._pending[0]
+            if seq.job.cancelled.is_set():
+                self._pending.popleft()
+                self._cancelled += 1
+                continue
+            if self._reserved + seq.reserved > self.n_ctx:
+                break
+            self._pending.popleft()
+            seq.seq_id = self._free_ids.pop()
+            seq.sampler = self._make_sampler(seq.job.temperature)
+            seq.started_at = time.monotonic()
+            self._reserved += seq.reserved
+            self._active[seq.seq_id] = seq
+        self._peak_active = max(self._peak_active, len(self._active))
+
+    def _make_sampler(self, temperature: float):
+        # Same sampling as the streaming path's llama() defaults
+        sampler = llama_cpp.llama_sampler_chain_init(llama_cpp.llama_sampler_chain_default_params())
+        if temperature <= 0:
+            llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_greedy())
+            return sampler
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_top_k(40))
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_top_p(0.95, 1))
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_min_p(0.05, 1))
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_temp(temperature))
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_dist(llama_cpp.LLAMA_DEFAULT_SEED))
+        return sampler
+
+    def _add(self, token: int, pos: int, seq_id: int, logits: bool):
+        batch = self._batch
+        i = batch.n_tokens
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.n_seq_id[i] = 1
+        batch.seq_id[i][0] = seq_id
+        batch.logits[i] = logits
+        batch.n_tokens = i + 1
+        return i
+
+    def _step(self):
+        """Decode one batch: a token for every generating sequence, then prompt chunks."""
+        self._batch.n_tokens = 0
+        sampled = []  # (batch row, sequence)
+
+        for seq in list(self._active.values()):
+            if seq.job.cancelled.is_set():
+                self._cancelled += 1
+                self._release(seq)
+            elif seq.last_token is not None:
+                sampled.append((self._add(seq.last_token, seq.n_past, seq.seq_id, True), seq))
+                seq.n_past += 1
+
+        budget = self.n_batch - self._batch.n_tokens
+        for seq in self._active.values():
+            if budget <= 0:
+                break
+            if seq.last_token is None:
+                chunk = seq.tokens[seq.n_past:seq.n_past + budget]
+                for offset, token in enumerate(chunk):
+                    last = seq.n_past + offset == len(seq.tokens) - 1
+                    row = self._add(token, seq.n_past + offset, seq.seq_id, last)
+                    if last:
+                        sampled.append((row, seq))
+                seq.n_past += len(chunk)
+                budget -= len(chunk)
+
+        if not self._batch.n_tokens:
+            return
+        code = llama_cpp.llama_decode(self._ctx, self._batch)
+        if code != 0:
+            raise RuntimeError(f"llama_decode returned {code}")
+        self._decode_calls += 1
+        self._batched_tokens += self._batch.n_tokens
+
+        for row, seq in sampled:
+            token = llama_cpp.llama_sampler_sample(seq.sampler, self._ctx, row)
+            if llama_cpp.llama_vocab_is_eog(self._vocab, token):
+                self._finish(seq, "stop")
+                continue
+            seq.last_token = token
+            seq.generated += 1
+            self._generated += 1
+            if self._append(seq, seq.decoder.decode(self.llm.detokenize([token]))):
+                self._finish(seq, "stop")
+            elif seq.generated >= seq.job.max_tokens:
+                self._finish(seq, "length")
+
+    def _append(self, seq: _Sequence, text: str) -> bool:
+        """Add generated text and send what can no longer turn into a stop string; True on a stop string."""
+        seq.text += text
+        search_from = max(seq.sent - self._holdback, 0)
+        for stop in self.stop:
+            at = seq.text.find(stop, search_from)
+            if at != -1:
+                seq.text = seq.text[:at]
+                return True
+        safe = len(seq.text) - self._holdback
+        if safe > seq.sent:
+            seq.job.events.put(("delta", seq.index, seq.text[seq.sent:safe]))
+            seq.sent = safe
+        return False
+
+    def _finish(self, seq: _Sequence, reason: str):
+        if len(seq.text) > seq.sent:
+            seq.job.events.put(("delta", seq.index, seq.text[seq.sent:]))
+        seq.job.events.put(("done", seq.index, {
+            "content": seq.text.strip(),
+            "finish_reason": reason,
+            "prompt_tokens": len(seq.tokens),
+            "completion_tokens": seq.generated,
+            "seconds": round(time.monotonic() - seq.started_at, 3),
+        }))
+        self._completed += 1
+        self._release(seq)
+
+    def _release(self, seq: _Sequence):
+        """Free the sequence's KV cells, sampler and slot for the next queued prompt."""
+        llama_cpp.llama_memory_seq_rm(self._memory, seq.seq_id, -1, -1)
+        llama_cpp.llama_sampler_free(seq.sampler)
+        with self._cond:
+            del self._active[seq.seq_id]
+            self._free_ids.append(seq.seq_id)
+            self._reserved -= seq.reserved
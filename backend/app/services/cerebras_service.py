@@ -1,13 +1,26 @@
 # type: ignore
 import os
-import json
 import logging
+import time
+from contextlib import closing
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import List, Any
 from dotenv import load_dotenv
-from cerebras.cloud.sdk import Cerebras
-from ..config import SYSTEM_PROMPT_ONLINE
-from .memory import get_history, add_to_history
+from cerebras.cloud.sdk import Cerebras, RateLimitError
+from shared.cerebras_errors import fallback_cause, retry_after
+from shared.rate_limit import TokenBudget
+from shared.sse import TextFrames, event, with_deadlines
+from shared.tracing import record, span
+from ..config import (
+    CEREBRAS_HEADROOM, CEREBRAS_TOKENS_PER_MINUTE, CEREBRAS_TPM_SHARE, COMPACTION_PROMPT, ONLINE_MAX_TOKENS,
+    ONLINE_MODEL_CTX, ONLINE_TEMPERATURE, SSE_FRAME_INTERVAL, SSE_FRAME_MAX_CHARS, SYSTEM_PROMPT_ONLINE,
+    USAGE_FLUSH_BATCH, USAGE_FLUSH_INTERVAL, USAGE_LOG_BACKUPS, USAGE_LOG_MAX_BYTES, USAGE_LOG_PATH
+)
+from .memory import add_to_history, compactor, estimate_tokens, get_history
+from .metrics import (
+    cancellations, online_admissions, online_quota_tokens, prompt_tokens as prompt_tokens_histogram, streams
+)
+from .usage_recorder import UsageRecorder
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,8 +39,26 @@ else:
 
 CEREMODEL = "llama-3.3-70b"
 
+usage_recorder = UsageRecorder(
+    USAGE_LOG_PATH,
+    max_file_bytes=USAGE_LOG_MAX_BYTES,
+    backups=USAGE_LOG_BACKUPS,
+    flush_interval=USAGE_FLUSH_INTERVAL,
+    batch_size=USAGE_FLUSH_BATCH,
+)
+
+# Tokens-per-minute admission, fed by the usage each stream reports (see shared/rate_limit.py)
+cerebras_budget = TokenBudget(
+    round(CEREBRAS_TOKENS_PER_MINUTE * CEREBRAS_TPM_SHARE), CEREBRAS_HEADROOM, reply_tokens=ONLINE_MAX_TOKENS / 4
+)
+online_quota_tokens.set_function(cerebras_budget.used)
+
+def online_failure_cause(error: Exception) -> str:
+    """Metric label for why an online call failed: "not_configured" without an API key, else see fallback_cause."""
+    return "not_configured" if cerebras_client is None else fallback_cause(error)
+
 def log_api_usage(session_id: str, usage_info: Any, model_used: str):
-    """Log API usage to a file for later analysis."""
+    """Record API usage for later analysis (written to the usage log in the background)."""
     log_entry = {
         "timestamp": datetime.now().isoformat(),
         "session_id": session_id,
@@ -37,60 +68,130 @@ def log_api_usage(session_id: str, usage_info: Any, model_used: str):
         "completion_tokens": usage_info.completion_tokens,
         "total_tokens": usage_info.total_tokens
     }
-    
-    with open("cerebras_usage.jsonl", "a") as f:
-        f.write(json.dumps(log_entry) + "\n")
+    usage_recorder.record(log_entry)
 
-def generate_online_response_stream(session_id: str, user_input: str):
-    """Generator function for streaming Cerebras responses."""
-    global cerebras_client
-    
+def online_messages(session_id: str, user_input: str) -> list:
+    """System prompt, the history that fits the context, and the new query."""
+    # History gets whatever the context has left after the reply, system prompt and new query
+    budget = ONLINE_MODEL_CTX - ONLINE_MAX_TOKENS - estimate_tokens(SYSTEM_PROMPT_ONLINE) - estimate_tokens(user_input) - 8
+    messages: List[Any] = [
+        {"role": "system", "content": SYSTEM_PROMPT_ONLINE}
+    ]
+    messages.extend(get_history(session_id, budget))
+    messages.append({"role": "user", "content": user_input})
+    return messages
+
+def estimate_prompt_tokens(session_id: str, user_input: str) -> int:
+    # Chat-format overhead is ~4 tokens per message (as in memory.py)
+    return sum(estimate_tokens(m["content"]) + 4 for m in online_messages(session_id, user_input))
+
+def online_configured() -> bool:
+    """Whether an API key is set; without one, online requests go straight to the local model (no quota taken)."""
+    return cerebras_client is not None
+
+def admit_online(prompt_tokens: int):
+    """Cerebras quota reservation for a request of `prompt_tokens`, or None to send it to the local model."""
+    reservation = cerebras_budget.admit(prompt_tokens)
+    online_admissions.labels("deferred" if reservation is None else "admitted").inc()
+    return reservation
+
+def generate_online_response_stream(session_id: str, user_input: str, partial: list = None, cancel=None,
+                                    compact: bool = False, reservation: tuple = None):
+    """Generator function for streaming Cerebras responses.
+
+    Cerebras deltas arrive far faster than a client needs them, so they are coalesced into
+    frames (see shared/sse.py). Text is appended to `partial` (if given) once its frame is sent, so
+    a caller that catches a mid-stream failure knows exactly what the client already received.
+    Setting `cancel` (a threading.Event) closes the upstream stream at the next chunk, so we
+    stop paying for tokens nobody will read; a cancelled turn is not recorded in history.
+    A quota `reservation` (see admit_online) is settled with the usage the stream reports.
+    """
     # Check if client is available
     if cerebras_client is None:
         logger.error("Cerebras client not initialized - API key missing")
         raise ValueError("Cerebras API key not configured. Please set CEREBRAS_API_KEY environment variable.")
     
-    history = get_history(session_id)
-    
-    messages: List[Any] = [
-        {"role": "system", "content": SYSTEM_PROMPT_ONLINE}
-    ]
-    messages.extend(history)
-    messages.append({"role": "user", "content": user_input})
+    with span("prompt_build") as attrs:
+        messages = online_messages(session_id, user_input)
+        attrs["messages"] = len(messages)
 
+    timer = streams.timer("online")
+    usage_info = None
     try:
-        response = cerebras_client.chat.completions.create(
-            model=CEREMODEL,
-            messages=messages,  # type: ignore
-            temperature=0.8,
-            max_tokens=1024,
-            stream=True
-        )
+        with span("cerebras_connect"):
+            response = cerebras_client.chat.completions.create(
+                model=CEREMODEL,
+                messages=messages,  # type: ignore
+                temperature=ONLINE_TEMPERATURE,
+                max_tokens=ONLINE_MAX_TOKENS,
+                stream=True
+            )
         
+        streaming = time.perf_counter()
+        first_token_at = None
         full_response = ""
-        usage_info = None
         model_used = None
+        frames = TextFrames("online", compact, SSE_FRAME_INTERVAL, SSE_FRAME_MAX_CHARS)
+        unsent = []
         
-        for chunk in response:
-            if hasattr(chunk, 'model'):
-                model_used = chunk.model
+        # Ticks flush text held back while the upstream stalls; closing them stops their reader thread.
+        # Every way out (done, cancelled, failed, or this generator closed by the pump) closes the upstream stream.
+        with closing(response), closing(with_deadlines(response, frames)) as chunks:
+            for chunk in chunks:
+                if cancel is not None and cancel.is_set():
+                    logger.info(f"Client disconnected, closed Cerebras stream after {len(full_response)} chars")
+                    cancellations.labels("online", "generating").inc()
+                    return
+
+                if chunk is None:
+                    # Upstream stalled with text held back: send it instead of waiting for the next delta
+                    frame = frames.flush()
+                    if frame:
+                        if partial is not None:
+                            partial.extend(unsent)
+                        unsent = []
+                        yield frame
+                    continue
+
+                if hasattr(chunk, 'model'):
+                    model_used = chunk.model
             
-            if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                delta = chunk.choices[0].delta
-                if hasattr(delta, 'content') and delta.content:
-                    full_response += delta.content
-                    # Yield chunk to client
-                    yield f"data: {json.dumps({'content': delta.content, 'source': 'online'})}\n\n"
+                if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
+                    delta = chunk.choices[0].delta
+                    if hasattr(delta, 'content') and delta.content:
+                        timer.token()
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                            record("cerebras_first_token", streaming)
+                        full_response += delta.content
+                        unsent.append(delta.content)
+                        frame = frames.push(delta.content)
+                        if frame:
+                            if partial is not None:
+                                partial.extend(unsent)
+                            unsent = []
+                            # Yield chunk to client
+                            yield frame
             
-            if hasattr(chunk, 'usage') and chunk.usage:
-                usage_info = chunk.usage
+                if hasattr(chunk, 'usage') and chunk.usage:
+                    usage_info = chunk.usage
+        
+        frame = frames.flush()
+        if frame:
+            if partial is not None:
+                partial.extend(unsent)
+            yield frame
         
+        record("cerebras_stream", first_token_at or streaming, chunks=timer.tokens,
+               completion_tokens=getattr(usage_info, "completion_tokens", None))
+
         # Send completion signal
-        yield f"data: {json.dumps({'done': True})}\n\n"
+        yield event(done=True)
         
         # Log usage and check for model mismatch
         if usage_info and model_used:
             log_api_usage(session_id, usage_info, model_used)
+            prompt_tokens_histogram.labels("online").observe(usage_info.prompt_tokens)
             logger.info(
                 f"Cerebras API Call | Model: {model_used} | "
                 f"Session: {session_id[:8]}... | "
@@ -109,7 +210,38 @@ def generate_online_response_stream(session_id: str, user_input: str):
 
     except Exception as e:
         logger.error(f"Cerebras API error: {e}")
+        if isinstance(e, RateLimitError):
+            cerebras_budget.throttle(retry_after(e))
         raise ValueError(f"Failed to generate response: {str(e)}")
+    finally:
+        timer.finish()
+        if reservation is not None and usage_info:
+            cerebras_budget.settle(reservation, usage_info.total_tokens, usage_info.completion_tokens)
+
+def summarize_online(transcript: str, max_tokens: int):
+    """History summary on Cerebras (see compaction.py); None when no API key is configured."""
+    if cerebras_client is None:
+        return None
+    # Background work only spends quota that chat requests leave over
+    reservation = cerebras_budget.admit(estimate_tokens(COMPACTION_PROMPT) + estimate_tokens(transcript))
+    if reservation is None:
+        return None
+    try:
+        response = cerebras_client.chat.completions.create(
+            model=CEREMODEL,
+            messages=[{"role": "system", "content": COMPACTION_PROMPT}, {"role": "user", "content": transcript}],
+            temperature=0.2,
+            max_tokens=max_tokens,
+        )
+    except RateLimitError as e:
+        cerebras_budget.throttle(retry_after(e))
+        raise
+    if response.usage is not None:
+        cerebras_budget.settle(reservation, response.usage.total_tokens)
+        log_api_usage("history-compaction", response.usage, response.model)
+    return response.choices[0].message.content
+
+compactor.register_summarizer("online", summarize_online)
 
 # def generate_online_response(session_id: str, user_input: str) -> str:
 #     """Generate a non-streaming response using the Cerebras API (for backward compatibility)."""
@@ -0,0 +1,184 @@
+import collections
+import logging
+import threading
+import time
+
+from .metrics import compaction_seconds, compaction_tokens_saved, compactions
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SOURCE = "summary"
+SUMMARY_HEADER = "Summary of the earlier conversation: "
+
+
+def is_summary(message: dict) -> bool:
+    return message.get("source") == SUMMARY_SOURCE
+
+
+class HistoryCompactor:
+    """
+    Folds the older turns of long sessions into one rolling summary message, off the request path.
+
+    `schedule()` runs after each completed turn and queues sessions whose stored history has
+    passed `trigger_tokens` for a background thread. A pass keeps the newest `keep_tokens` of
+    turns verbatim and summarizes up to `max_input_tokens` of the turns before them, merged with
+    the previous summary, into a system message at the head of the history. Long backlogs take
+    several passes.
+
+    Summarizers are `summarize(transcript, max_tokens) -> str | None` callables tried in `order`;
+    None means "not now" (e.g. the local model is busy). A deferred pass is retried up to
+    `retries` times with doubling delays from `retry_delay`, then after the session's next turn.
+    A pass whose turns changed meanwhile (trimmed or cleared) is dropped.
+    """
+
+    def __init__(self, store, count, trigger_tokens: int, keep_tokens: int, max_input_tokens: int,
+                 summary_tokens: int, order: tuple = ("local", "online"), enabled: bool = True,
+                 retries: int = 3, retry_delay: float = 2.0):
+        self.store = store
+        self.count = count  # count(message) -> tokens
+        self.trigger_tokens = trigger_tokens
+        self.keep_tokens = keep_tokens
+        self.max_input_tokens = max_input_tokens
+        self.summary_tokens = summary_tokens
+        self.order = order
+        self.enabled = enabled
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._summarizers = {}
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._queued = set()
+        self._worker = None
+        self._stats = {"compacted": 0, "deferred": 0, "stale": 0, "error": 0}
+        self._tokens_saved = 0
+        self._seconds = 0.0
+
+    def register_summarizer(self, name: str, summarize):
+        self._summarizers[name] = summarize
+
+    def _tokens(self, messages: list) -> int:
+        return sum(self.count(m) for m in messages)
+
+    def schedule(self, session_id: str, attempt: int = 0):
+        """Queue the session for a compaction pass if its history has grown past the trigger."""
+        if not self.enabled or self._tokens(self.store.get(session_id)) < self.trigger_tokens:
+            return
+        with self._cond:
+            if session_id in self._queued:
+                return
+            self._queued.add(session_id)
+            self._queue.append((session_id, attempt))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="history-compactor", daemon=True)
+                self._worker.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                session_id, attempt = self._queue.popleft()
+            try:
+                outcome = self.compact(session_id)
+            except Exception as e:
+                logger.error(f"History compaction failed for session {session_id[:8]}...: {e}")
+                outcome = "error"
+            with self._cond:
+                self._queued.discard(session_id)
+            if outcome == "compacted":
+                self.schedule(session_id)
+            elif outcome == "deferred" and attempt < self.retries:
+                retry = threading.Timer(self.retry_delay * 2 ** attempt, self.schedule, (session_id, attempt + 1))
+                retry.daemon = True
+                retry.start()
+
+    def _split(self, messages: list) -> tuple:
+        """(head, end): messages[head:end] are the turns to fold; messages[:head] is the old summary."""
+        head = 1 if messages and is_summary(messages[0]) else 0
+
+        # Keep the newest turns verbatim, starting at a user message
+        keep = len(messages)
+        kept = 0
+        while keep > head and kept + self.count(messages[keep - 1]) <= self.keep_tokens:
+            kept += self.count(messages[keep - 1])
+            keep -= 1
+        while head < keep < len(messages) and messages[keep]["role"] != "user":
+            keep -= 1
+
+        # Fold the oldest turns first, ending on a whole turn
+        end = head
+        folded = 0
+        while end < keep and (end == head or folded + self.count(messages[end]) <= self.max_input_tokens):
+            folded += self.count(messages[end])
+            end += 1
+        while end < keep and messages[end]["role"] != "user":
+            end += 1
+        return head, end
+
+    @staticmethod
+    def _transcript(summary: list, turns: list) -> str:
+        lines = [f"Earlier summary: {m['content'].removeprefix(SUMMARY_HEADER)}" for m in summary]
+        lines += [f"{m['role'].capitalize()}: {m['content']}" for m in turns]
+        return "\n".join(lines)
+
+    def compact(self, session_id: str):
+        """One compaction pass: its outcome (see metrics.compactions), or None if there was nothing to fold."""
+        messages = list(self.store.get(session_id))
+        if self._tokens(messages) < self.trigger_tokens:
+            return None
+        head, end = self._split(messages)
+        if end - head < 2:
+            return None
+        transcript = self._transcript(messages[:head], messages[head:end])
+
+        for name in self.order:
+            summarize = self._summarizers.get(name)
+            if summarize is None:
+                continue
+            started = time.monotonic()
+            try:
+                text = summarize(transcript, self.summary_tokens)
+            except Exception as e:
+                logger.warning(f"History compaction with the {name} summarizer failed: {e}")
+                self._record(name, "error")
+                continue
+            if not text or not text.strip():
+                continue
+            seconds = time.monotonic() - started
+
+            summary = {"role": "system", "content": SUMMARY_HEADER + text.strip(), "source": SUMMARY_SOURCE}
+            if not self.store.replace_prefix(session_id, messages[:end], summary):
+                self._record(name, "stale")
+                return "stale"
+            saved = max(self._tokens(messages[:end]) - self.count(summary), 0)
+            compaction_seconds.labels(name).observe(seconds)
+            compaction_tokens_saved.inc(saved)
+            self._record(name, "compacted", saved, seconds)
+            logger.info(
+                f"Compacted {end - head} messages of session {session_id[:8]}... with the {name} summarizer "
+                f"in {seconds:.2f}s, {saved} tokens saved"
+            )
+            return "compacted"
+
+        self._record("none", "deferred")
+        return "deferred"
+
+    def _record(self, summarizer: str, outcome: str, saved: int = 0, seconds: float = 0.0):
+        compactions.labels(summarizer, outcome).inc()
+        with self._cond:
+            self._stats[outcome] += 1
+            self._tokens_saved += saved
+            self._seconds += seconds
+
+    def stats(self) -> dict:
+        with self._cond:
+            compacted = self._stats["compacted"]
+            return {
+                "enabled": self.enabled,
+                **self._stats,
+                "tokens_saved": self._tokens_saved,
+                "avg_seconds": round(self._seconds / compacted, 3) if compacted else None,
+                "pending": len(self._queue),
+                "summarizers": [name for name in self.order if name in self._summarizers],
+            }
@@ -0,0 +1,104 @@
+import threading
+from collections import OrderedDict
+
+
+def common_prefix_length(a, b) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def state_bytes(state) -> int:
+    """Memory held by a snapshot: llama.cpp's state plus the saved logits."""
+    return state.llama_state_size + state.scores.nbytes
+
+
+class SessionStateCache:
+    """
+    Per-session llama.cpp state snapshots (KV cache + token ids), LRU-evicted under a byte budget.
+
+    After a turn finishes, the worker's state is saved under the session id. On the next turn the
+    snapshot is loaded back into whichever worker serves the request, and llama.cpp's own prefix
+    matching in `Llama.generate` then only evaluates the tokens after the shared prefix. If the
+    snapshot was evicted (or no longer shares a prefix), generation falls back to a full evaluation.
+    """
+
+    def __init__(self, capacity_bytes: int):
+        self.capacity_bytes = capacity_bytes
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._tokens_reused = 0
+
+    def restore(self, session_id: str, llm, prompt_tokens: list) -> int:
+        """Prime `llm` for `prompt_tokens`. Returns how many prompt tokens will not be re-evaluated."""
+        with self._lock:
+            state = self._states.get(session_id)
+            if state is not None:
+                self._states.move_to_end(session_id)
+
+        warm = common_prefix_length(llm.input_ids[:llm.n_tokens], prompt_tokens[:-1])
+        reusable = 0
+        if state is not None:
+            reusable = common_prefix_length(state.input_ids[:state.n_tokens], prompt_tokens[:-1])
+
+        if reusable > warm:
+            llm.load_state(state)
+        reused = max(reusable, warm)
+
+        with self._lock:
+            if state is not None and reusable > 0:
+                self._hits += 1
+            else:
+                self._misses += 1
+            self._tokens_reused += reused
+        return reused
+
+    def store(self, session_id: str, llm):
+        """Snapshot the worker's current state for the session's next turn."""
+        if self.capacity_bytes <= 0:
+            return
+        state = llm.save_state()
+        # load_state only restores the logits rows of the cached tokens; the rest of the score matrix (n_ctx rows
+        # when speculative decoding keeps logits for every position) would be dead weight
+        state.scores = state.scores[:state.n_tokens].copy()
+        size = state_bytes(state)
+        if size > self.capacity_bytes:
+            return
+
+        with self._lock:
+            previous = self._states.pop(session_id, None)
+            if previous is not None:
+                self._bytes -= state_bytes(previous)
+            self._states[session_id] = state
+            self._bytes += size
+            while self._bytes > self.capacity_bytes:
+                _, evicted = self._states.popitem(last=False)
+                self._bytes -= state_bytes(evicted)
+                self._evictions += 1
+
+    def discard(self, session_id: str):
+        with self._lock:
+            state = self._states.pop(session_id, None)
+            if state is not None:
+                self._bytes -= state_bytes(state)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "sessions": len(self._states),
+                "bytes": self._bytes,
+                "capacity_bytes": self.capacity_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "tokens_reused": self._tokens_reused,
+            }
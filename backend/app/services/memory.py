@@ -1,44 +1,182 @@
-from collections import defaultdict
-from ..config import MAX_HISTORY
+from ..config import (
+    COMPACTION_ENABLED, COMPACTION_KEEP_TOKENS, COMPACTION_MAX_INPUT_TOKENS, COMPACTION_SUMMARIZERS,
+    COMPACTION_SUMMARY_TOKENS, COMPACTION_TRIGGER_TOKENS, MAX_STORED_MESSAGES, RETRIEVAL_COMPACT_RATIO, RETRIEVAL_DIM,
+    RETRIEVAL_ENABLED, RETRIEVAL_MAX_ENTRIES, RETRIEVAL_MIN_SCORE, RETRIEVAL_PATH, RETRIEVAL_SHARED,
+    RETRIEVAL_SOURCES, RETRIEVAL_TOP_K, SESSION_DB_PATH, SESSION_IDLE_TTL, SESSION_MAX_BYTES, SESSION_MAX_COUNT
+)
+from .compaction import HistoryCompactor, is_summary
+from .retrieval import AnswerIndex
+from .session_store import SessionStore
+
+session_store = SessionStore(
+    max_sessions=SESSION_MAX_COUNT,
+    idle_ttl=SESSION_IDLE_TTL,
+    max_bytes=SESSION_MAX_BYTES,
+    db_path=SESSION_DB_PATH,
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Conservative token estimate for models whose tokenizer is not available locally (~3 chars/token)."""
+    return len(text) // 3 + 1
+
+
+def _online_token_count(role: str, content: str) -> int:
+    # Chat-format overhead (role header + end-of-turn markers) is ~4 tokens per message
+    return estimate_tokens(content) + 4
+
+
+# Token counters per prompt target. "offline" is registered by model_service with the real
+# Llama tokenizer once the model is loaded; Cerebras' tokenizer is not available, so online
+# counts are estimated.
+token_counters = {"online": _online_token_count}
+
+
+def register_token_counter(target: str, counter):
+    """Register `counter(role, content) -> int` for a prompt target."""
+    token_counters[target] = counter
+
+
+def count_tokens(message: dict, target: str) -> int:
+    """Token count of a stored message for `target`, computed once and cached on the message."""
+    counts = message.setdefault("tokens", {})
+    if target not in counts:
+        counter = token_counters.get(target, _online_token_count)
+        counts[target] = counter(message["role"], message["content"])
+    return counts[target]
+
+
+# Older turns of long sessions are folded into a summary in the background (see compaction.py).
+# Summarizers are registered by model_service ("local") and cerebras_service ("online").
+compactor = HistoryCompactor(
+    session_store,
+    lambda message: count_tokens(message, "online"),
+    trigger_tokens=COMPACTION_TRIGGER_TOKENS,
+    keep_tokens=COMPACTION_KEEP_TOKENS,
+    max_input_tokens=COMPACTION_MAX_INPUT_TOKENS,
+    summary_tokens=COMPACTION_SUMMARY_TOKENS,
+    order=COMPACTION_SUMMARIZERS,
+    enabled=COMPACTION_ENABLED,
+)
+
+# Completed online answers are also kept in a retrieval index (see retrieval.py), so offline prompts can draw
+# on them after they have left (or never were in) the session's history. model_service registers the embedder.
+answer_index = AnswerIndex(
+    RETRIEVAL_PATH,
+    dim=RETRIEVAL_DIM,
+    top_k=RETRIEVAL_TOP_K,
+    min_score=RETRIEVAL_MIN_SCORE,
+    sources=RETRIEVAL_SOURCES,
+    shared=RETRIEVAL_SHARED,
+    max_entries=RETRIEVAL_MAX_ENTRIES,
+    compact_ratio=RETRIEVAL_COMPACT_RATIO,
+    enabled=RETRIEVAL_ENABLED,
+)
+
+
+def _window(messages: list, target: str, budget: int = None):
+    """Newest-first selection of whole messages that fits within `budget` tokens, after any summary."""
+    # The rolling summary of older turns (see compaction.py) goes first, if it fits at all
+    summary = []
+    if messages and is_summary(messages[0]):
+        summary, messages = messages[:1], messages[1:]
+        if budget is not None:
+            if count_tokens(summary[0], target) <= budget:
+                budget -= count_tokens(summary[0], target)
+            else:
+                summary = []
+
+    if budget is None:
+        selected = messages
+    else:
+        start = len(messages)
+        used = 0
+        while start > 0:
+            cost = count_tokens(messages[start - 1], target)
+            if used + cost > budget:
+                break
+            used += cost
+            start -= 1
+        selected = messages[start:]
+
+    # Never open the window on an orphaned assistant reply
+    if selected and selected[0]["role"] == "assistant":
+        selected = selected[1:]
+    return [{"role": m["role"], "content": m["content"]} for m in summary + selected]
 
-chat_hist = defaultdict(list)
-offline_hist = defaultdict(list)  # Separate history for offline model
 
 def add_to_history(session_id: str, role: str, content: str, source: str = "mixed"):
-    """Add to main history (used by online model)"""
-    chat_hist[session_id].append({"role": role, "content": content})
-    
-    if len(chat_hist[session_id]) > MAX_HISTORY * 2:
-        chat_hist[session_id] = chat_hist[session_id][-MAX_HISTORY*2:]
-    
-    # Add to offline history with smart truncation
-    # ALWAYS add user queries in full
-    if role == "user":
-        offline_hist[session_id].append({"role": role, "content": content})
-    # For assistant responses, check length and source
-    elif role == "assistant":
-        if len(content) > 300:
-            # Truncate long responses (likely from online model) for offline context
-            truncated_content = content[:250] + "... [response continues]"
-            offline_hist[session_id].append({"role": role, "content": truncated_content})
-        else:
-            # Keep short responses in full (already concise)
-            offline_hist[session_id].append({"role": role, "content": content})
-    
-    # Keep offline history manageable
-    if len(offline_hist[session_id]) > MAX_HISTORY * 2:
-        offline_hist[session_id] = offline_hist[session_id][-MAX_HISTORY*2:]
-
-def get_history(session_id: str):
-    """Get full history (for online model)"""
-    return chat_hist[session_id]
-
-def get_offline_history(session_id: str):
-    """Get truncated history optimized for offline model"""
-    return offline_hist[session_id]
+    """Add a message to the session history (shared by online and offline models)"""
+    # Hard cap on what we keep per session; prompts are windowed by token budget below
+    session_store.append(session_id, {"role": role, "content": content, "source": source}, MAX_STORED_MESSAGES)
+    if role == "assistant":
+        compactor.schedule(session_id)
+        if answer_index.accepts(source):
+            messages = session_store.get(session_id)
+            if len(messages) >= 2 and messages[-2]["role"] == "user":
+                answer_index.add(session_id, messages[-2]["content"], content, source)
+
+
+def seed_history(session_id: str, messages: list):
+    """
+    Start a session this process has never seen from a client-held copy of its earlier turns
+    (e.g. the gateway moved it here from another backend replica). Known sessions are left alone.
+    """
+    if session_store.get(session_id):
+        return
+    for message in messages:
+        if message.get("role") in ("user", "assistant") and message.get("content"):
+            session_store.append(
+                session_id, {"role": message["role"], "content": message["content"], "source": "seeded"},
+                MAX_STORED_MESSAGES
+            )
+    compactor.schedule(session_id)
+
+
+def _export(message: dict) -> dict:
+    return {k: message[k] for k in ("role", "content", "source") if k in message}
+
+
+def history_state(session_id: str) -> dict:
+    """The session's revision, generation and stored message count (see SessionStore)"""
+    return session_store.state(session_id)
+
+
+def history_since(session_id: str, revision: int = None, generation: int = None) -> dict:
+    """What a copy of the history at (`revision`, `generation`) needs to catch up (see SessionStore.since)"""
+    state = session_store.since(session_id, revision, generation)
+    return {**state, "messages": [_export(m) for m in state["messages"]]}
+
+
+def replace_history(session_id: str, messages: list, revision: int = None, generation: int = None) -> dict:
+    """
+    Full resync: make a client-held copy (e.g. the gateway's, for a session this replica lost or
+    never had) the session's history. Messages keep their role, content and source.
+    """
+    kept = [
+        {"role": m["role"], "content": m["content"], "source": m.get("source", "seeded")}
+        for m in messages if (m.get("role") in ("user", "assistant") or is_summary(m)) and m.get("content")
+    ][-MAX_STORED_MESSAGES:]
+    state = session_store.replace(session_id, kept, len(kept) if revision is None else revision, generation)
+    compactor.schedule(session_id)
+    return state
+
+
+def get_history(session_id: str, budget: int = None):
+    """Get the newest history that fits in `budget` tokens of the online model's context"""
+    return _window(session_store.get(session_id), "online", budget)
+
+
+def get_offline_history(session_id: str, budget: int = None, target: str = "offline"):
+    """Get the newest history that fits in `budget` tokens of an offline model tier's context"""
+    return _window(session_store.get(session_id), target, budget)
+
+
+def history_tokens(session_id: str, target: str) -> int:
+    """Tokens the whole stored conversation takes in `target`'s prompt format"""
+    return sum(count_tokens(message, target) for message in session_store.get(session_id))
+
 
 def clear_history(session_id: str):
-    if session_id in chat_hist:
-        del chat_hist[session_id]
-    if session_id in offline_hist:
-        del offline_hist[session_id]
\ No newline at end of file
+    session_store.delete(session_id)
+    answer_index.forget(session_id)
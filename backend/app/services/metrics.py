@@ -0,0 +1,89 @@
+from shared.prometheus import SIZE_BUCKETS, Registry, StreamMetrics
+from shared.tracing import Tracer
+from ..config import TRACE_BUFFER_SIZE, TRACE_MAX_SPANS
+
+registry = Registry()
+
+# Streams, labelled by source ("offline", "online", "cache")
+streams = StreamMetrics(registry, "bridgeai")
+prompt_tokens = registry.histogram(
+    "bridgeai_prompt_tokens", "Prompt size in tokens", ("source",), buckets=SIZE_BUCKETS
+)
+
+# Local model queue
+queue_wait_seconds = registry.histogram(
+    "bridgeai_queue_wait_seconds", "Time a request waited for a local model worker"
+)
+
+# Routing
+route_decisions = registry.counter(
+    "bridgeai_route_decisions_total", "Requests by where they were answered", ("route",)
+)
+fallbacks = registry.counter(
+    "bridgeai_fallbacks_total", "Online requests continued on the local model", ("cause", "stage")
+)
+
+# Local model tiers. reason: "override", "preferred", "fit" or "load" (see services/tiers.py)
+tier_requests = registry.counter(
+    "bridgeai_tier_requests_total", "Offline requests by the model tier that served them", ("tier", "reason")
+)
+tier_swaps = registry.counter("bridgeai_tier_swaps_total", "Model tiers loaded on demand", ("tier",))
+
+# Client disconnects. stage: "queued" (waiting for a worker) or "generating"
+cancellations = registry.counter(
+    "bridgeai_cancelled_streams_total", "Streams stopped because the client disconnected", ("source", "stage")
+)
+
+# Batch endpoint. finish_reason: "stop", "length" or "error"
+batch_items = registry.counter("bridgeai_batch_items_total", "Batch prompts answered", ("finish_reason",))
+batch_tokens = registry.counter("bridgeai_batch_tokens_total", "Tokens generated for batch prompts")
+
+# Speculative decoding. outcome: "drafted" or "accepted"
+speculative_tokens = registry.counter(
+    "bridgeai_speculative_tokens_total", "Draft tokens proposed to the local model, and kept", ("outcome",)
+)
+speculative_pauses = registry.counter(
+    "bridgeai_speculative_pauses_total", "Times drafting paused because too few draft tokens were kept"
+)
+
+# History compaction. outcome: "compacted", "deferred" (no summarizer free), "stale" (history changed
+# meanwhile) or "error"
+compactions = registry.counter(
+    "bridgeai_history_compactions_total", "History compaction passes", ("summarizer", "outcome")
+)
+compaction_seconds = registry.histogram(
+    "bridgeai_history_compaction_seconds", "Time to summarize and fold older turns", ("summarizer",)
+)
+compaction_tokens_saved = registry.counter(
+    "bridgeai_history_compaction_tokens_saved_total", "Stored-history tokens removed by compaction (net of summaries)"
+)
+
+# Rate limits. scope: "session" or "global"; unit: "requests" or "tokens"
+rate_limited = registry.counter(
+    "bridgeai_rate_limited_total", "Requests refused by a rate limit", ("scope", "unit")
+)
+
+# Cerebras quota admission. outcome: "admitted" or "deferred" (sent to the local model)
+online_admissions = registry.counter(
+    "bridgeai_online_admissions_total", "Online requests by Cerebras quota admission", ("outcome",)
+)
+online_quota_tokens = registry.gauge(
+    "bridgeai_online_quota_tokens", "Cerebras tokens charged over the last minute (requests in flight at their estimate)"
+)
+
+# Retrieval over past answers (see retrieval.py). outcome: "hit" (context injected) or "miss"; stage: "embed"
+# (the query) or "search"
+retrieval_lookups = registry.counter(
+    "bridgeai_retrieval_lookups_total", "Offline prompts by whether past answers were found for them", ("outcome",)
+)
+retrieval_seconds = registry.histogram(
+    "bridgeai_retrieval_seconds", "Time to embed the query and to search the past answers", ("stage",)
+)
+retrieval_entries = registry.gauge("bridgeai_retrieval_entries", "Past answers in the retrieval index")
+
+# Sessions
+session_count = registry.gauge("bridgeai_sessions", "Sessions held in memory")
+session_bytes = registry.gauge("bridgeai_session_bytes", "Approximate memory held by session histories")
+
+# Request traces (see shared/tracing.py), served at /api/debug/traces
+tracer = Tracer(TRACE_BUFFER_SIZE, TRACE_MAX_SPANS)
@@ -1,66 +1,652 @@
 #type:ignore
-from llama_cpp import Llama
-from ..config import MODEL_PATH, N_CTX, SYSTEM_PROMPT_OFFLINE
-from .memory import add_to_history, get_offline_history
-import json
+from llama_cpp import LLAMA_POOLING_TYPE_MEAN, Llama
+from shared.sse import TextFrames, event
+from shared.tracing import record, span
+from ..config import (
+    BATCH_MAX_SEQUENCES, BATCH_N_CTX, BATCH_THREADS, COMPACTION_PROMPT, DRAFT_MODEL_PATH, KV_CACHE_BYTES,
+    MAX_QUEUE_DEPTH, MODEL_TIERS, MODEL_USE_MLOCK, MODEL_USE_MMAP, MODEL_WARMUP, N_BATCH, OFFLINE_MAX_TOKENS,
+    OFFLINE_TEMPERATURE, QUEUE_TIMEOUT, RETRIEVAL_CONTEXT_TOKENS, RETRIEVAL_EMBED_CTX, RETRIEVAL_EMBED_MODEL_PATH, RETRIEVAL_ENABLED,
+    RETRIEVAL_PASSAGE_TOKENS, RETRIEVAL_PROMPT, SNAPSHOT_LOGITS_ROW_BYTES, SPECULATIVE_DRAFT_TOKENS,
+    SPECULATIVE_MIN_ACCEPTANCE, SPECULATIVE_MODE, SPECULATIVE_NGRAM, SSE_FRAME_INTERVAL, SSE_FRAME_MAX_CHARS,
+    SYSTEM_PROMPT_OFFLINE, TIER_KV_BYTES_PER_TOKEN, TIER_MAX_WAIT, TIER_MEMORY_BUDGET, TIER_MIN_IDLE
+)
+from .batch_engine import BatchEngine, BatchJob
+from .kv_cache import SessionStateCache
+from .memory import (
+    add_to_history, answer_index, compactor, count_tokens, get_offline_history, history_tokens, register_token_counter
+)
+from .metrics import (
+    batch_items, batch_tokens, cancellations, prompt_tokens as prompt_tokens_histogram, queue_wait_seconds,
+    retrieval_lookups, retrieval_seconds, streams, tier_requests, tier_swaps
+)
+from .scheduler import QueueFullError, QueueTimeoutError
+from .speculative import make_drafter, speculative_stats
+from .tiers import ModelTier, TierRegistry
+import functools
+import logging
+import os
+import queue
+import threading
 import time
 
-llm = Llama(model_path=MODEL_PATH, n_ctx=N_CTX)
+logger = logging.getLogger(__name__)
 
-def generate_offline_response_stream(session_id: str, user_query: str):
-    """Generator function that yields response chunks for streaming with buffering for smoother output."""
-    # Use offline-optimized history instead of full history
-    history = get_offline_history(session_id)
-    messages = [{"role": "system", "content": SYSTEM_PROMPT_OFFLINE}] + history + [{"role": "user", "content": user_query}]
+# Local model tiers, best first. Each tier has its own workers (one Llama context each) and queue; a tier's
+# scheduler guarantees a context is only used by one request at a time. Tiers are loaded in the background
+# (start_model_loading) so the app serves online traffic meanwhile.
+def _tier(spec: dict, default: bool) -> ModelTier:
+    return ModelTier(
+        spec["name"], spec["model_path"], spec["n_ctx"], workers=spec.get("workers", 1),
+        max_prompt_tokens=spec.get("max_prompt_tokens"), tokens_per_s=spec.get("tokens_per_s", 10.0),
+        memory_bytes=spec.get("memory_bytes"),
+        kv_bytes_per_token=spec.get("kv_bytes_per_token", TIER_KV_BYTES_PER_TOKEN),
+        max_queue_depth=MAX_QUEUE_DEPTH, target="offline" if default else None,
+    )
+
+
+tiers = TierRegistry(
+    [_tier(spec, i == 0) for i, spec in enumerate(MODEL_TIERS)],
+    max_wait=TIER_MAX_WAIT,
+    memory_budget=TIER_MEMORY_BUDGET,
+    min_idle=TIER_MIN_IDLE,
+)
+session_states = SessionStateCache(KV_CACHE_BYTES)  # keyed by (tier, session): a snapshot only fits its own model
+
+model_status = {
+    "state": "not_loaded",  # not_loaded -> loading -> ready (first worker of any tier warmed up) | failed
+    "model_path": tiers.default.model_path,
+    "workers": tiers.default.worker_count,
+    "workers_ready": 0,
+    "load_seconds": None,
+    "warmup_seconds": None,
+    "speculative": SPECULATIVE_MODE,
+    "error": None,
+}
+_loader = None
+_swap_lock = threading.Lock()  # one tier swap at a time
+TIER_DRAIN_TIMEOUT = 30  # seconds an evicted tier may take to finish its requests before the swap is abandoned
+
+# Continuous-batching engine for /chat/batch, created on first use (get_batch_engine)
+batch_engine = None
+_batch_engine_lock = threading.Lock()
+
+
+def format_turn(role: str, content: str) -> str:
+    return f"{role.capitalize()}: {content}\n"
+
+
+def count_prompt_tokens(llm: Llama, role: str, content: str) -> int:
+    """Exact token count of one formatted prompt line, as `llm` will see it."""
+    return len(llm.tokenize(format_turn(role, content).encode("utf-8"), add_bos=False, special=True))
+
+
+def is_model_ready() -> bool:
+    return model_status["state"] == "ready"
+
+
+def start_model_loading():
+    """Load the local model tiers in a background thread (idempotent)."""
+    global _loader
+    if _loader is None:
+        _loader = threading.Thread(target=_load_models, name="model-loader", daemon=True)
+        _loader.start()
+
+
+def _load_models():
+    model_status["state"] = "loading"
+    for tier in tiers.tiers:
+        full_snapshot = _snapshot_bytes(tier)
+        if 0 < KV_CACHE_BYTES < full_snapshot:
+            logger.warning(
+                f"KV_CACHE_BYTES ({KV_CACHE_BYTES}) is below one full-context snapshot of tier {tier.name} "
+                f"(about {full_snapshot} bytes); its longer sessions will not reuse their state"
+            )
+        if tier is tiers.default or tiers.fits_budget(tier):
+            _load_tier(tier)
+        else:
+            logger.info(f"Model tier {tier.name} left unloaded: over the {TIER_MEMORY_BUDGET} byte budget")
+    if model_status["state"] != "ready":
+        model_status["state"] = "failed"
+    elif RETRIEVAL_ENABLED:
+        _load_embedder()
+
+
+def _snapshot_bytes(tier: ModelTier) -> int:
+    """Estimated size of a full-context state snapshot of one of `tier`'s workers."""
+    # A drafter makes llama.cpp keep logits for every position; otherwise it keeps one batch's worth
+    logits_rows = tier.n_ctx if SPECULATIVE_MODE != "off" else min(N_BATCH, tier.n_ctx)
+    return tier.n_ctx * tier.kv_bytes_per_token + logits_rows * SNAPSHOT_LOGITS_ROW_BYTES
+
+
+def embed_text(llm: Llama, text: str):
+    return llm.embed(text, truncate=True)
+
+
+def _load_embedder():
+    """
+    The retrieval index's embedder: the default tier's model (or RETRIEVAL_EMBED_MODEL_PATH) in
+    embedding mode, a small extra context over the same memory-mapped weights.
+    """
+    path = RETRIEVAL_EMBED_MODEL_PATH or tiers.default.model_path
+    try:
+        llm = Llama(
+            model_path=path, n_ctx=RETRIEVAL_EMBED_CTX, n_batch=RETRIEVAL_EMBED_CTX, n_ubatch=RETRIEVAL_EMBED_CTX,
+            embedding=True, pooling_type=LLAMA_POOLING_TYPE_MEAN, use_mmap=MODEL_USE_MMAP, use_mlock=MODEL_USE_MLOCK
+        )
+    except Exception as e:
+        logger.error(f"Retrieval over past answers unavailable: embedding model {path} failed to load: {e}")
+        return
+    answer_index.register_embedder(f"{os.path.basename(path)}:{llm.n_embd()}", functools.partial(embed_text, llm),
+                                   llm.n_embd())
+    logger.info(f"Retrieval embedder ready: {path}")
+
+
+def _load_tier(tier: ModelTier):
+    tier.state = "loading"
+    tier.error = None
+    try:
+        for _ in range(tier.worker_count):
+            started = time.monotonic()
+            drafter = _make_drafter(tier.n_ctx)
+            llm = Llama(
+                model_path=tier.model_path, n_ctx=tier.n_ctx, n_batch=N_BATCH, use_mmap=MODEL_USE_MMAP,
+                use_mlock=MODEL_USE_MLOCK, draft_model=drafter
+            )
+            if drafter is not None:
+                try:
+                    drafter.check_vocab(llm)
+                except ValueError as e:
+                    logger.error(f"Speculative decoding disabled: {e}")
+                    model_status["speculative"] = "off"
+                    llm.draft_model = None
+            if not tier.workers:
+                tier.load_seconds = round(time.monotonic() - started, 3)
+                if tier is tiers.default:
+                    model_status["load_seconds"] = tier.load_seconds
+                register_token_counter(tier.target, functools.partial(count_prompt_tokens, llm))
+
+            if MODEL_WARMUP:
+                started = time.monotonic()
+                _warm_up(llm)
+                if tier is tiers.default:
+                    model_status["warmup_seconds"] = round(time.monotonic() - started, 3)
+
+            tier.workers.append(llm)
+            tier.scheduler.add_worker(llm)
+            tier.state = "ready"
+            model_status["workers_ready"] += 1
+            model_status["state"] = "ready"
+            logger.info(f"Model tier {tier.name}: worker {len(tier.workers)}/{tier.worker_count} ready")
+    except Exception as e:
+        logger.error(f"Failed to load model tier {tier.name} from {tier.model_path}: {e}")
+        tier.error = str(e)
+        if tier is tiers.default:
+            model_status["error"] = str(e)
+        if not tier.workers:
+            tier.state = "failed"
+
+
+def request_tier(tier: ModelTier):
+    """Swap `tier` in (in the background), unloading least recently used idle tiers to fit the memory budget."""
+    if tier.state == "unloaded" and not _swap_lock.locked():
+        threading.Thread(target=_swap_in, args=(tier,), name="tier-swap", daemon=True).start()
+
+
+def _swap_in(tier: ModelTier):
+    if not _swap_lock.acquire(blocking=False):
+        return
+    try:
+        if tier.state != "unloaded":
+            return
+        victims = tiers.eviction_candidates(tier)
+        if victims is None:
+            # Too big for the budget, or every tier that could make room was used recently
+            logger.debug(f"Model tier {tier.name} does not fit the {TIER_MEMORY_BUDGET} byte budget now")
+            return
+        for victim in victims:
+            if not _unload_tier(victim):
+                return
+        logger.info(f"Swapping in model tier {tier.name}" + (f" for {[v.name for v in victims]}" if victims else ""))
+        tier_swaps.labels(tier.name).inc()
+        _load_tier(tier)
+    finally:
+        _swap_lock.release()
+
+
+def _unload_tier(tier: ModelTier) -> bool:
+    """Stop routing to the tier, let its queue drain, then free its workers. False if it stayed busy."""
+    tiers.begin_unload(tier)
+    deadline = time.monotonic() + TIER_DRAIN_TIMEOUT
+    while True:
+        stats = tier.scheduler.stats()
+        if not stats["busy"] and not stats["queued"]:
+            break
+        if time.monotonic() >= deadline:
+            logger.warning(f"Model tier {tier.name} still busy after {TIER_DRAIN_TIMEOUT}s; keeping it loaded")
+            tier.state = "ready"
+            return False
+        time.sleep(0.1)
+    for llm in tier.workers:
+        llm.close()
+    model_status["workers_ready"] -= len(tier.workers)
+    tier.reset_workers()
+    tier.state = "unloaded"
+    logger.info(f"Model tier {tier.name} unloaded")
+    return True
+
+
+def _make_drafter(n_ctx: int):
+    """This worker's speculative drafter; a draft model that fails to load leaves plain decoding on."""
+    try:
+        return make_drafter(SPECULATIVE_MODE, SPECULATIVE_DRAFT_TOKENS, SPECULATIVE_NGRAM, SPECULATIVE_MIN_ACCEPTANCE,
+                            DRAFT_MODEL_PATH, n_ctx)
+    except Exception as e:
+        logger.error(f"Speculative decoding ({SPECULATIVE_MODE}) unavailable, decoding without it: {e}")
+        model_status["speculative"] = "off"
+        return None
+
+
+def speculative_decoding_stats():
+    drafters = [llm.draft_model for llm in tiers.workers() if llm.draft_model is not None]
+    return speculative_stats(drafters, model_status["speculative"])
+
+
+def discard_session_state(session_id: str):
+    for tier in tiers.tiers:
+        session_states.discard((tier.name, session_id))
+
+
+def _warm_up(llm: Llama):
+    """
+    One-token generation over the system prompt: pages in the weights and leaves the
+    system-prompt prefix in the KV cache, so first requests only evaluate their own turns.
+    """
+    prompt = format_turn("system", SYSTEM_PROMPT_OFFLINE) + format_turn("user", "Hello") + "Assistant:"
+    if llm.draft_model is not None:
+        llm.draft_model.begin()
+    llm(llm.tokenize(prompt.encode("utf-8"), special=True), max_tokens=1, temperature=0.0)
+
+
+def fit_tail(llm: Llama, text: str, budget: int) -> str:
+    """Keep only the last `budget` tokens of text."""
+    tokens = llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+    if len(tokens) <= budget:
+        return text
+    return llm.detokenize(tokens[-max(budget, 1):]).decode("utf-8", errors="ignore").lstrip()
+
+
+def fit_query(llm: Llama, user_query: str, budget: int) -> str:
+    """Trim a user message that on its own would not fit in the remaining context."""
+    tokens = llm.tokenize(user_query.encode("utf-8"), add_bos=False, special=True)
+    if len(tokens) <= budget:
+        return user_query
+    logger.warning(f"User message of {len(tokens)} tokens trimmed to {budget} to fit the context")
+    return llm.detokenize(tokens[:max(budget, 0)]).decode("utf-8", errors="ignore")
+
+
+def fit_head(llm: Llama, text: str, budget: int) -> str:
+    """Keep only the first `budget` tokens of text, marking a cut with "..."."""
+    tokens = llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+    if len(tokens) <= budget:
+        return text
+    return llm.detokenize(tokens[:budget]).decode("utf-8", errors="ignore").rstrip() + " ..."
+
+
+def find_past_answers(session_id: str, user_query: str) -> list:
+    """Past answers similar to the query (see retrieval.py), or [] while the index is off, empty or not ready."""
+    if not answer_index.ready() or not len(answer_index):
+        return []
+    started = time.perf_counter()
+    try:
+        vector = answer_index.embed(user_query)
+        searching = time.perf_counter()
+        notes = answer_index.nearest(vector, session_id)
+    except Exception as e:
+        logger.error(f"Retrieval over past answers failed, answering without them: {e}")
+        return []
+    ended = time.perf_counter()
+    record("retrieval_embed", started, searching)
+    record("retrieval_search", searching, ended, hits=len(notes))
+    retrieval_seconds.labels("embed").observe(searching - started)
+    retrieval_seconds.labels("search").observe(ended - searching)
+    retrieval_lookups.labels("hit" if notes else "miss").inc()
+    return notes
+
+
+def past_answers_context(llm: Llama, notes: list, history: list, budget: int) -> tuple:
+    """
+    Retrieved pairs as the content of one system message within `budget` tokens, each answer cut
+    to RETRIEVAL_PASSAGE_TOKENS, and how many pairs it holds. Answers already in the prompt's
+    history are left out. ("", 0) if none fit.
+    """
+    seen = {message["content"] for message in history}
+    used = count_prompt_tokens(llm, "system", RETRIEVAL_PROMPT)
+    parts = []
+    for note in notes:
+        if note["answer"] in seen:
+            continue
+        question = fit_head(llm, note["question"], RETRIEVAL_PASSAGE_TOKENS // 4)
+        answer = fit_head(llm, note["answer"], RETRIEVAL_PASSAGE_TOKENS)
+        part = f"\nQ: {question}\nA: {answer}"
+        cost = len(llm.tokenize(part.encode("utf-8"), add_bos=False, special=True))
+        if used + cost > budget:
+            break
+        parts.append(part)
+        used += cost
+    return (RETRIEVAL_PROMPT + "".join(parts) if parts else ""), len(parts)
+
+
+def summarize_locally(transcript: str, max_tokens: int):
+    """
+    History summary on the default tier (see compaction.py), only while it has nothing else to do.
+    None if it is busy, or if a request arrives mid-summary: users never wait behind compaction.
+    """
+    tier = tiers.default
+    if tier.state != "ready":
+        return None
+    stats = tier.scheduler.stats()
+    if stats["busy"] or stats["queued"]:
+        return None
+    try:
+        ticket = tier.scheduler.submit()
+    except QueueFullError:
+        return None
+    try:
+        llm = ticket.worker
+        if llm is None:
+            return None
+        budget = tier.n_ctx - max_tokens - count_prompt_tokens(llm, "system", COMPACTION_PROMPT) - 8
+        prompt = (format_turn("system", COMPACTION_PROMPT) + format_turn("user", fit_tail(llm, transcript, budget))
+                  + "Assistant:")
+        if llm.draft_model is not None:
+            llm.draft_model.begin()
+        stream = llm(
+            llm.tokenize(prompt.encode("utf-8"), special=True),
+            max_tokens=max_tokens,
+            temperature=0.0,
+            stop=["User:", "Assistant:"],
+            stream=True
+        )
+        text = ""
+        for output in stream:
+            if tier.scheduler.stats()["queued"]:
+                stream.close()
+                return None
+            text += output["choices"][0]["text"]
+        return text
+    finally:
+        tier.scheduler.release(ticket)
+
+
+compactor.register_summarizer("local", summarize_locally)
+
+
+def generate_offline_response_stream(session_id: str, user_query: str, priority: int = 0,
+                                     assistant_prefix: str = "", partial: list = None,
+                                     cancel: threading.Event = None, compact: bool = False,
+                                     tier: str = None, served: dict = None):
+    """Generator function that yields response chunks for streaming with buffering for smoother output.
+
+    With `assistant_prefix` (a partial answer from another model), the local model continues that
+    answer instead of starting over; only the continuation is streamed, and history records the
+    stitched answer. Generated text is also appended to `partial` if given.
+
+    Setting `cancel` (the client went away) leaves the queue or stops generation within one
+    token, freeing the worker. A cancelled turn is not recorded in history.
+    `compact` selects the client's negotiated framing (see shared/sse.py).
+
+    The model tier is picked per request (see tiers.py), or named by `tier`; the done event names
+    the tier that served the reply, which is also stored in `served["tier"]` if given. `served["recorded"]`
+    says whether the turn made it into history (not when the model was busy, unavailable or cancelled).
+    """
+    if not is_model_ready():
+        logger.warning(f"Offline request while the local model is {model_status['state']}")
+        if model_status["state"] == "failed":
+            yield event(error="model_unavailable", content="The local model could not be loaded.")
+        else:
+            yield event(error="warming_up", content="The local model is still warming up. Please try again shortly.")
+        yield event(done=True)
+        return
+
+    # Looked up before queueing, so a worker is not held while the query is embedded. A continuation
+    # already has its answer under way.
+    notes = [] if assistant_prefix else find_past_answers(session_id, user_query)
+
+    queued = time.perf_counter()
+    try:
+        model_tier, ticket, reason, wanted = tiers.acquire(
+            estimate_prompt_tokens(session_id, user_query, assistant_prefix), OFFLINE_MAX_TOKENS, priority, tier
+        )
+    except QueueFullError as e:
+        logger.warning(f"Offline request rejected: {e}")
+        yield event(error="queue_full", content="The local model is busy. Please try again shortly.")
+        yield event(done=True)
+        return
+    tier_requests.labels(model_tier.name, reason).inc()
+    if wanted is not None:
+        request_tier(wanted)
+    if served is not None:
+        served["tier"] = model_tier.name
+
+    timer = streams.timer("offline")
+    try:
+        try:
+            # Tell the client where it stands while it waits for a free model worker
+            for position in model_tier.scheduler.wait(ticket, timeout=QUEUE_TIMEOUT, cancel=cancel):
+                yield event(queue_position=position, source="offline", tier=model_tier.name)
+        except QueueTimeoutError as e:
+            logger.warning(f"Offline request timed out in queue: {e}")
+            yield event(error="queue_timeout", content="The local model is busy. Please try again shortly.")
+            yield event(done=True)
+            return
+        if ticket.worker is None:
+            logger.info(f"Client disconnected while queued, session {session_id[:8]}...")
+            cancellations.labels("offline", "queued").inc()
+            return
+        queue_wait_seconds.observe(ticket.queue_wait)
+        record("queue", queued, tier=model_tier.name, reason=reason)
+
+        recorded = yield from _stream_with_model(
+            ticket.worker, model_tier, session_id, user_query, assistant_prefix, partial, timer, cancel, compact, notes
+        )
+        if served is not None:
+            served["recorded"] = bool(recorded)
+    finally:
+        # Also runs when the client disconnects mid-queue, so the slot is never leaked
+        model_tier.scheduler.release(ticket)
+        timer.finish()
+
+
+def estimate_prompt_tokens(session_id: str, user_query: str, assistant_prefix: str = "") -> int:
+    """The full prompt's size (the whole conversation, unwindowed) in the default tier's tokens, for tier choice."""
+    turns = [{"role": "system", "content": SYSTEM_PROMPT_OFFLINE}, {"role": "user", "content": user_query}]
+    if assistant_prefix:
+        turns.append({"role": "assistant", "content": assistant_prefix})
+    return history_tokens(session_id, "offline") + sum(count_tokens(turn, "offline") for turn in turns) + 4
+
+
+def _stream_with_model(llm: Llama, tier: ModelTier, session_id: str, user_query: str, assistant_prefix: str = "",
+                       partial: list = None, timer=None, cancel: threading.Event = None, compact: bool = False,
+                       notes: list = ()):
+    building = time.perf_counter()
+    # Token budget for history: the context minus the reply, system prompt, new query and "Assistant:"
+    budget = tier.n_ctx - OFFLINE_MAX_TOKENS - 1 - count_prompt_tokens(llm, "system", SYSTEM_PROMPT_OFFLINE) - 4
+    user_query = fit_query(llm, user_query, budget - 4)
+    budget -= count_prompt_tokens(llm, "user", user_query)
+
+    # Continuing a partial answer: the model only needs its tail to pick up where it stopped
+    continuation = ""
+    if assistant_prefix:
+        continuation = " " + fit_tail(llm, assistant_prefix.strip(), budget // 2)
+        budget -= len(llm.tokenize(continuation.encode("utf-8"), add_bos=False, special=True))
+
+    # Past answers get up to a third of the history budget. They go right before the new query, so
+    # the system prompt and history stay a prefix of the next turn's prompt (see kv_cache.py).
+    reserved = min(RETRIEVAL_CONTEXT_TOKENS, budget // 3) if notes else 0
+    history = get_offline_history(session_id, budget - reserved, tier.target)
+    context, used = past_answers_context(llm, notes, history, reserved) if notes else ("", 0)
+    messages = [{"role": "system", "content": SYSTEM_PROMPT_OFFLINE}] + history
+    if context:
+        messages.append({"role": "system", "content": context})
+    messages.append({"role": "user", "content": user_query})
     
     prompt = ""
     for msg in messages:
-        prompt += f"{msg['role'].capitalize()}: {msg['content']}\n"
-    prompt += "Assistant:"
+        prompt += format_turn(msg["role"], msg["content"])
+    prompt += "Assistant:" + continuation
+    record("prompt_build", building, history_messages=len(history), past_answers=used)
+
+    # Reuse this session's KV cache from its previous turn so only the new tokens are evaluated
+    with span("tokenize") as attrs:
+        prompt_tokens = llm.tokenize(prompt.encode("utf-8"), special=True)
+        attrs["tokens"] = len(prompt_tokens)
+    with span("kv_restore") as attrs:
+        reused = session_states.restore((tier.name, session_id), llm, prompt_tokens)
+        attrs["reused_tokens"] = reused
+    logger.info(f"Offline prompt on tier {tier.name}: {len(prompt_tokens)} tokens, {reused} reused from cache")
+    prompt_tokens_histogram.labels("offline").observe(len(prompt_tokens))
 
     full_response = ""
-    buffer = ""
-    buffer_size = 3
-    last_send_time = time.time()
-    min_time_between_sends = 0.05
+    generated = 0
+    frames = TextFrames("offline", compact, SSE_FRAME_INTERVAL, SSE_FRAME_MAX_CHARS)
+    if llm.draft_model is not None:
+        llm.draft_model.begin()
+    started = time.monotonic()
+    started_eval = time.perf_counter()
     
     stream = llm(
-        prompt, 
-        max_tokens=512, 
-        temperature=0.5,
+        prompt_tokens, 
+        max_tokens=OFFLINE_MAX_TOKENS, 
+        temperature=OFFLINE_TEMPERATURE,
         stop=["User:", "Assistant:"], 
         echo=False,
         stream=True
     )
     
-    # -----Streaming Response with Buffering (Offline Layer)-----
+    # -----Streaming Response with Adaptive Coalescing (Offline Layer)-----
     
-    # Yield each chunk with buffering
+    # The client already has the prefix's trailing whitespace; don't send a second one
+    trim_leading_space = assistant_prefix[-1:].isspace()
+
+    decoding = None
     for output in stream:
+        if cancel is not None and cancel.is_set():
+            # Closing the completion generator stops llama.cpp before the next token
+            stream.close()
+            logger.info(f"Client disconnected, stopped offline generation after {len(full_response)} chars")
+            cancellations.labels("offline", "generating").inc()
+            record("decode", decoding or time.perf_counter(), tokens=generated, cancelled=True)
+            return
         chunk = output["choices"][0]["text"]
+        generated += 1
+        if decoding is None:
+            # The first token comes once llama.cpp has evaluated the (uncached part of the) prompt
+            decoding = time.perf_counter()
+            record("prompt_eval", started_eval, tokens=len(prompt_tokens) - reused)
+        if timer is not None:
+            timer.token()
+        if trim_leading_space:
+            chunk = chunk.lstrip()
+            trim_leading_space = not chunk
         full_response += chunk
-        buffer += chunk
-        
-        current_time = time.time()
-        time_since_last_send = current_time - last_send_time
+        if partial is not None:
+            partial.append(chunk)
         
-        # Send buffer if it's large enough OR enough time has passed
-        if len(buffer) >= buffer_size or time_since_last_send >= min_time_between_sends:
-            if buffer:  # Only send if buffer has content
-                yield f"data: {json.dumps({'content': buffer, 'source': 'offline'})}\n\n"
-                buffer = ""
-                last_send_time = current_time
+        frame = frames.push(chunk)
+        if frame:
+            yield frame
     
     # Send any remaining buffered content
-    if buffer:
-        yield f"data: {json.dumps({'content': buffer, 'source': 'offline'})}\n\n"
+    frame = frames.flush()
+    if frame:
+        yield frame
     
-    # Send completion signal
-    yield f"data: {json.dumps({'done': True})}\n\n"
+    tiers.record(tier, generated, time.monotonic() - started)
+    record("decode", decoding or time.perf_counter(), tokens=generated, tier=tier.name)
+    
+    # Send completion signal (naming the tier once for the whole stream)
+    yield event(done=True, tier=tier.name)
     
     # Save to history with 'offline' source marker
-    add_to_history(session_id, "user", user_query, source="offline")
-    add_to_history(session_id, "assistant", full_response.strip(), source="offline")
+    if assistant_prefix:
+        # One history entry for the stitched online + offline answer
+        add_to_history(session_id, "user", user_query, source="mixed")
+        add_to_history(session_id, "assistant", (assistant_prefix + full_response).strip(), source="mixed")
+    else:
+        add_to_history(session_id, "user", user_query, source="offline")
+        add_to_history(session_id, "assistant", full_response.strip(), source="offline")
+
+    with span("kv_store"):
+        session_states.store((tier.name, session_id), llm)
+    return True  # the turn is recorded
+
+
+def get_batch_engine() -> BatchEngine:
+    """The batch engine over the default tier's model; its context and KV cache are allocated on first use."""
+    global batch_engine
+    with _batch_engine_lock:
+        if batch_engine is None:
+            if tiers.default.state != "ready":
+                raise RuntimeError(f"Model tier {tiers.default.name} is {tiers.default.state}")
+            batch_engine = BatchEngine(
+                tiers.default.workers[0], BATCH_MAX_SEQUENCES, BATCH_N_CTX, n_threads=BATCH_THREADS,
+                paused=lambda: tiers.default.scheduler.stats()["queued"] > 0
+            )
+            logger.info(f"Batch engine ready: {BATCH_MAX_SEQUENCES} sequences over {BATCH_N_CTX} KV cells, "
+                        f"{BATCH_THREADS} threads")
+    return batch_engine
+
+
+def batch_stats():
+    return batch_engine.stats() if batch_engine is not None else None
+
+
+def close_batch_engine():
+    if batch_engine is not None:
+        batch_engine.close()
+
+
+def generate_batch(queries: list, max_tokens: int, temperature: float, cancel: threading.Event = None):
+    """
+    Answer independent questions (no session history) with continuous batching.
+
+    Yields ("delta", index, text), ("done", index, result) and ("error", index, message) in the
+    order sequences progress; every query ends with exactly one "done" or "error". Stopping
+    early (or setting `cancel`) drops the queries not yet answered.
+    """
+    engine = get_batch_engine()
+    llm = engine.llm
+    system = format_turn("system", SYSTEM_PROMPT_OFFLINE)
+    n_ctx = min(tiers.default.n_ctx, BATCH_N_CTX)
+    budget = n_ctx - max_tokens - count_prompt_tokens(llm, "system", SYSTEM_PROMPT_OFFLINE) - 4
+    tokenized = []
+    for query in queries:
+        query = fit_query(llm, query, budget - 4)
+        prompt = system + format_turn("user", query) + "Assistant:"
+        tokenized.append(llm.tokenize(prompt.encode("utf-8"), special=True))
+
+    job = BatchJob(max_tokens, temperature)
+    engine.submit(job, tokenized)
+    remaining = len(queries)
+    try:
+        while remaining:
+            try:
+                kind, index, value = job.events.get(timeout=0.1)
+            except queue.Empty:
+                if cancel is not None and cancel.is_set():
+                    return
+                continue
+            if kind == "done":
+                remaining -= 1
+                batch_items.labels(value["finish_reason"]).inc()
+                batch_tokens.inc(value["completion_tokens"])
+            elif kind == "error":
+                remaining -= 1
+                batch_items.labels("error").inc()
+            yield kind, index, value
+    finally:
+        # Frees the slots of anything still queued or generating (e.g. the client went away)
+        job.cancelled.set()
 
 
 # # ----- Non-streaming function (backward compatibility) -----
@@ -0,0 +1,460 @@
+"""
+Retrieval index over past answers, used as context for offline prompts.
+
+Completed question/answer pairs are embedded off the request path by a background thread. The
+embedder is registered by model_service and is the local GGUF model in embedding mode. Each pair
+becomes a unit vector appended to a memory-mapped float32 matrix. Files under `path`:
+
+    vectors.f32     one row of `dim` float32 per pair, the file grown by doubling
+    coarse.f32      the first `coarse_dim` columns of each row, stored contiguously
+    ids.bin         per row: passage offset and length, live flag, pair key and session hash
+    passages.jsonl  the pairs themselves, append-only
+    index.json      row count, dimension and the embedder the vectors came from
+
+Embeddings wider than `dim` go through a fixed random orthonormal projection, which roughly
+preserves cosine similarity. A search is two matrix-vector products. The first scans the coarse
+matrix and keeps the best `candidates` rows with a partial sort. The second rescores those rows
+on all `dim` columns. At 100k rows the scan reads under 40 MB, a few milliseconds on one core.
+Scoring every row on all columns would read almost three times as much.
+
+Removed rows (forgotten sessions, the oldest past `max_entries`) are masked out of searches. The
+worker rewrites the files without them once they make up `compact_ratio` of the rows. Vectors
+made by a different embedder are re-embedded by the same rewrite, and searches are off until it
+finishes.
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from shared.response_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+ROW = np.dtype([("offset", "<u8"), ("length", "<u4"), ("alive", "<u4"), ("key", "<u8"), ("session", "<u8")])
+FILES = ("vectors.f32", "coarse.f32", "ids.bin", "passages.jsonl")
+MIN_CAPACITY = 1024  # rows
+COPY_ROWS = 8192  # rows per chunk when the files are rewritten; searches run between chunks
+
+
+def _hash64(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def passage_text(question: str, answer: str) -> str:
+    """What gets embedded for a pair"""
+    return f"Q: {question}\nA: {answer}"
+
+
+def projection(model_dim: int, dim: int, seed: int = 0):
+    """Fixed random orthonormal map from `model_dim` down to `dim` dimensions (None if no reduction is needed)."""
+    if model_dim <= dim:
+        return None
+    matrix = np.random.default_rng(seed).standard_normal((model_dim, dim))
+    return np.linalg.qr(matrix)[0].astype(np.float32)
+
+
+class AnswerIndex:
+    """
+    Embedding index of past question/answer pairs. `add()` and `forget()` only queue work.
+    A background thread embeds the queued pairs, appends them in batches and compacts the
+    files. Searches read a snapshot of the matrix and do not wait for that thread.
+
+    With `shared`, searches cover every session's pairs. Otherwise each session only sees
+    its own pairs.
+    """
+
+    def __init__(self, path: str, dim: int = 256, top_k: int = 3, min_score: float = 0.5,
+                 sources: tuple = ("online", "mixed"), shared: bool = False, max_entries: int = 200000,
+                 compact_ratio: float = 0.25, coarse_dim: int = 96, candidates: int = 1024,
+                 max_pending: int = 10000, batch_size: int = 32, enabled: bool = True):
+        self.path = path
+        self.dim = dim
+        self.coarse_dim = coarse_dim
+        self.candidates = candidates
+        self.top_k = top_k
+        self.min_score = min_score
+        self.sources = sources
+        self.shared = shared
+        self.max_entries = max_entries
+        self.compact_ratio = compact_ratio
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.enabled = enabled
+
+        self._lock = threading.Lock()  # the open files and row count, which a rewrite swaps
+        self._cond = threading.Condition()  # operations queued for the worker
+        self._embed_lock = threading.Lock()  # the embedder is one llama.cpp context
+        self._pending = collections.deque()
+        self._queries_waiting = 0  # searches waiting to embed; the worker gives way to them
+        self._worker = None
+        self._closed = False
+        self._embedder = None
+        self._embedder_name = None
+        self._projection = None
+        self._vector_dim = dim
+        self._rebuilding = False
+        self._vectors = self._coarse = self._ids = self._reader = self._writer = None
+        self._count = 0
+        self._passage_bytes = 0
+        self._keys = {}  # pair key -> row, live rows only (worker thread)
+        self._stats = {
+            "appended": 0, "duplicates": 0, "removed": 0, "dropped": 0, "errors": 0,
+            "searches": 0, "hits": 0, "compactions": 0,
+        }
+        self._search_seconds = 0.0
+        self._last_compaction_seconds = None
+
+        if enabled:
+            self._open()
+
+    # ----- Files -----
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _map(self, path: str, dtype, rows: int, width: int = None):
+        """A writable memory map of `rows` rows over `path`, extending the file if needed."""
+        shape = (rows,) if width is None else (rows, width)
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def _open(self):
+        os.makedirs(self.path, exist_ok=True)
+        meta = {}
+        if os.path.exists(self._file("index.json")):
+            with open(self._file("index.json")) as f:
+                meta = json.load(f)
+        dim = meta.get("dim", self.dim)
+        self._embedder_name = meta.get("embedder")
+        existing = 0
+        if os.path.exists(self._file("vectors.f32")):
+            existing = os.path.getsize(self._file("vectors.f32")) // (dim * 4)
+        count = meta.get("count", 0)
+        if count > existing:
+            logger.error(f"Retrieval index at {self.path} is missing rows; starting it over")
+            count = 0
+        capacity = max(MIN_CAPACITY, existing, count)
+        self._vectors = self._map(self._file("vectors.f32"), np.float32, capacity, dim)
+        self._coarse = self._map(self._file("coarse.f32"), np.float32, capacity, min(self.coarse_dim, dim))
+        self._ids = self._map(self._file("ids.bin"), ROW, capacity)
+        self._writer = open(self._file("passages.jsonl"), "ab")
+        self._reader = open(self._file("passages.jsonl"), "rb")
+        self._passage_bytes = self._writer.tell()
+        self._count = count
+
+        rows = self._ids[:count]
+        live = np.flatnonzero(rows["alive"] != 0)
+        self._keys = dict(zip(rows["key"][live].tolist(), live.tolist()))
+        logger.info(f"Retrieval index at {self.path}: {len(self._keys)} answers ({count} rows, {dim} dims)")
+
+    def _sync(self, *names: str):
+        """
+        Write the files' dirty pages to disk. Not memmap.flush(): msync holds the GIL, and searches
+        would stall behind it. Writes to the maps are in the page cache at once, so a crashed
+        process loses nothing even before this runs.
+        """
+        for name in names:
+            fd = os.open(self._file(name), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _flush(self, sync: bool = False):
+        with self._lock:
+            self._writer.flush()
+            meta = {"count": self._count, "dim": self._vectors.shape[1], "embedder": self._embedder_name}
+        if sync:
+            self._sync(*FILES)
+        tmp = self._file("index.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._file("index.json"))
+
+    def _grow(self):
+        """Double the row capacity (caller holds the lock). Searches still holding the old maps keep working."""
+        capacity = 2 * len(self._vectors)
+        self._vectors = self._map(self._file("vectors.f32"), np.float32, capacity, self._vectors.shape[1])
+        self._coarse = self._map(self._file("coarse.f32"), np.float32, capacity, self._coarse.shape[1])
+        self._ids = self._map(self._file("ids.bin"), ROW, capacity)
+
+    # ----- Embedding -----
+
+    def register_embedder(self, name: str, embed, model_dim: int):
+        """
+        Set `embed(text)`, which returns the model's `model_dim` embedding of `text` (pooled, or
+        per token). A different `name` than the one the stored vectors came from makes the
+        worker re-embed every stored pair.
+        """
+        if not self.enabled:
+            return
+        with self._embed_lock:
+            self._embedder = embed
+            self._projection = projection(model_dim, self.dim)
+            self._vector_dim = min(model_dim, self.dim)
+        with self._cond:
+            stored_dim = self._vectors.shape[1]
+            if (self._embedder_name not in (None, name) and self._count) or stored_dim != self._vector_dim:
+                logger.info(f"Retrieval index made by {self._embedder_name} ({stored_dim} dims), re-embedding: {name}")
+                self._rebuilding = True
+                self._pending.appendleft(("rebuild", None))  # before queued pairs, which need the new dimension
+            self._embedder_name = name
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="retrieval-index", daemon=True)
+                self._worker.start()
+            self._cond.notify()
+
+    def ready(self) -> bool:
+        return self.enabled and self._embedder is not None and not self._rebuilding
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def embed(self, text: str) -> np.ndarray:
+        """Unit vector for `text` in the index's space. Blocks while an embedding is running."""
+        with self._cond:
+            self._queries_waiting += 1
+        try:
+            return self._embed(text)
+        finally:
+            with self._cond:
+                self._queries_waiting -= 1
+
+    def _embed_in_background(self, text: str) -> np.ndarray:
+        while self._queries_waiting:
+            time.sleep(0.005)
+        return self._embed(text)
+
+    def _embed(self, text: str) -> np.ndarray:
+        with self._embed_lock:
+            vector = np.asarray(self._embedder(text), dtype=np.float32)
+            if vector.ndim == 2:
+                vector = vector.mean(axis=0)  # per-token embeddings (a model without pooling)
+            if self._projection is not None:
+                vector = vector @ self._projection
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    # ----- Request path -----
+
+    def accepts(self, source: str) -> bool:
+        return self.enabled and source in self.sources
+
+    def add(self, session_id: str, question: str, answer: str, source: str):
+        """Queue a completed pair for indexing. Never blocks; dropped if the worker has fallen far behind."""
+        question, answer = question.strip(), answer.strip()
+        if not self.accepts(source) or not question or not answer:
+            return
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                self._stats["dropped"] += 1
+                return
+            self._pending.append(("add", (session_id, question, answer, source, time.time())))
+            self._cond.notify()
+
+    def forget(self, session_id: str):
+        """Queue the removal of a session's pairs"""
+        if not self.enabled:
+            return
+        with self._cond:
+            self._pending.append(("forget", _hash64(session_id)))
+            self._cond.notify()
+
+    def nearest(self, vector: np.ndarray, session_id: str = None, k: int = None) -> list:
+        """
+        Up to `k` live pairs (default `top_k`) with cosine similarity to `vector` of at least
+        `min_score`, best first: dicts with question, answer, source, created_at and score.
+        """
+        if not self.ready():
+            return []
+        k = k or self.top_k
+        started = time.perf_counter()
+        with self._lock:
+            vectors, coarse, ids, count, reader = self._vectors, self._coarse, self._ids, self._count, self._reader
+        results = []
+        if count:
+            rows = ids[:count]
+            scores = np.asarray(coarse[:count]) @ vector[:coarse.shape[1]]
+            np.putmask(scores, rows["alive"] == 0, -np.inf)
+            if not self.shared and session_id is not None:
+                np.putmask(scores, rows["session"] != _hash64(session_id), -np.inf)
+            kept = min(max(self.candidates, k), count)
+            top = np.argpartition(scores, count - kept)[count - kept:]
+            top = top[np.isfinite(scores[top])]
+            exact = np.asarray(vectors[top]) @ vector
+            for i in np.argsort(exact)[::-1][:k]:
+                if not exact[i] >= self.min_score:
+                    break
+                entry = rows[top[i]]
+                passage = json.loads(os.pread(reader.fileno(), int(entry["length"]), int(entry["offset"])))
+                results.append({**passage, "score": round(float(exact[i]), 4)})
+        self._stats["searches"] += 1
+        self._stats["hits"] += bool(results)
+        self._search_seconds += time.perf_counter() - started
+        return results
+
+    # ----- Worker thread -----
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            try:
+                self._apply(batch)
+            except Exception as e:
+                logger.error(f"Retrieval index update failed: {e}")
+                self._stats["errors"] += 1
+
+    def _apply(self, batch: list):
+        for op, args in batch:
+            try:
+                if op == "add":
+                    self._append(*args)
+                elif op == "forget":
+                    with self._lock:
+                        rows = self._ids[:self._count]
+                    self._remove(np.flatnonzero((rows["session"] == args) & (rows["alive"] != 0)))
+                elif op == "rebuild":
+                    self._rewrite(reembed=True)
+            except Exception as e:
+                logger.error(f"Retrieval index {op} failed: {e}")
+                self._stats["errors"] += 1
+        if len(self._keys) > self.max_entries:
+            with self._lock:
+                live = np.flatnonzero(self._ids["alive"][:self._count] != 0)
+            self._remove(live[:len(self._keys) - self.max_entries])  # oldest first
+        self._flush()
+        removed = self._count - len(self._keys)
+        if removed and removed >= self.compact_ratio * self._count:
+            self._rewrite()
+
+    def _append(self, session_id: str, question: str, answer: str, source: str, created_at: float):
+        key = _hash64(normalize_query(question) + "\x1f" + answer)
+        if key in self._keys:
+            self._stats["duplicates"] += 1  # e.g. a cached answer replayed
+            return
+        vector = self._embed_in_background(passage_text(question, answer))
+        record = json.dumps(
+            {"question": question, "answer": answer, "source": source, "created_at": round(created_at, 3)}
+        ).encode("utf-8") + b"\n"
+        offset = self._passage_bytes
+        self._writer.write(record)
+        self._writer.flush()  # searches read passages through their own handle
+        self._passage_bytes += len(record)
+        with self._lock:
+            row = self._count
+            if row == len(self._vectors):
+                self._grow()
+            self._vectors[row] = vector
+            self._coarse[row] = vector[:self._coarse.shape[1]]
+            self._ids[row] = (offset, len(record), 1, key, _hash64(session_id))
+            self._count += 1
+        self._keys[key] = row
+        self._stats["appended"] += 1
+
+    def _remove(self, rows: np.ndarray):
+        if not len(rows):
+            return
+        with self._lock:
+            ids = self._ids
+        ids["alive"][rows] = 0
+        for key in ids["key"][rows].tolist():
+            self._keys.pop(key, None)
+        self._stats["removed"] += len(rows)
+
+    def _rewrite(self, reembed: bool = False):
+        """Write the live rows to new files and swap them in (re-embedding each pair if `reembed`)."""
+        started = time.perf_counter()
+        with self._lock:
+            vectors, ids, count, reader = self._vectors, self._ids, self._count, self._reader
+        live = np.flatnonzero(ids["alive"][:count] != 0)
+        dim = self._vector_dim if reembed else vectors.shape[1]
+        capacity = max(MIN_CAPACITY, 1 << len(live).bit_length())
+        for name in FILES:
+            if os.path.exists(self._file(name + ".tmp")):
+                os.remove(self._file(name + ".tmp"))
+        new_vectors = self._map(self._file("vectors.f32.tmp"), np.float32, capacity, dim)
+        new_coarse = self._map(self._file("coarse.f32.tmp"), np.float32, capacity, min(self.coarse_dim, dim))
+        new_ids = self._map(self._file("ids.bin.tmp"), ROW, capacity)
+        offset = 0
+        with open(self._file("passages.jsonl.tmp"), "wb") as out:
+            for start in range(0, len(live), COPY_ROWS):
+                rows = live[start:start + COPY_ROWS]
+                chunk = ids[rows]
+                # Rows are in passage order, so a chunk's passages (and the removed ones between them) are one read
+                first = int(chunk["offset"][0])
+                data = os.pread(reader.fileno(), int(chunk["offset"][-1] + chunk["length"][-1]) - first, first)
+                spans = zip((chunk["offset"] - first).tolist(), chunk["length"].tolist())
+                records = [data[o:o + n] for o, n in spans]
+                out.write(b"".join(records))
+                lengths = chunk["length"].astype(np.uint64)
+                chunk["offset"] = offset + np.cumsum(lengths) - lengths
+                offset += int(lengths.sum())
+                if reembed:
+                    for i, record in enumerate(records):
+                        passage = json.loads(record)
+                        text = passage_text(passage["question"], passage["answer"])
+                        new_vectors[start + i] = self._embed_in_background(text)
+                else:
+                    new_vectors[start:start + len(rows)] = vectors[rows]
+                new_coarse[start:start + len(rows)] = new_vectors[start:start + len(rows), :new_coarse.shape[1]]
+                new_ids[start:start + len(rows)] = chunk
+                time.sleep(0)
+        self._sync(*(name + ".tmp" for name in FILES))
+
+        with self._lock:
+            for name in FILES:
+                os.replace(self._file(name + ".tmp"), self._file(name))
+            self._vectors, self._coarse, self._ids = new_vectors, new_coarse, new_ids
+            self._writer.close()
+            self._writer = open(self._file("passages.jsonl"), "ab")
+            self._reader = open(self._file("passages.jsonl"), "rb")  # the old one closes with the last search using it
+            self._passage_bytes = offset
+            self._count = len(live)
+            self._rebuilding = False
+        self._keys = dict(zip(new_ids["key"][:len(live)].tolist(), range(len(live))))
+        self._flush()
+        self._stats["compactions"] += 1
+        self._last_compaction_seconds = round(time.perf_counter() - started, 3)
+        logger.info(f"Retrieval index rewritten: {len(live)} of {count} rows kept in {self._last_compaction_seconds}s")
+
+    def close(self):
+        if not self.enabled:
+            return
+        with self._cond:
+            self._closed = True
+            self._pending.clear()
+            self._cond.notify()
+        if self._worker is not None:
+            self._worker.join(timeout=5)
+        self._flush(sync=True)
+
+    def stats(self) -> dict:
+        searches = self._stats["searches"]
+        return {
+            "enabled": self.enabled,
+            "ready": self.ready(),
+            "embedder": self._embedder_name,
+            "rebuilding": self._rebuilding,
+            "entries": len(self),
+            "rows": self._count,
+            "dim": self._vectors.shape[1] if self._vectors is not None else self.dim,
+            "pending": len(self._pending),
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / searches, 4) if searches else 0.0,
+            "avg_search_ms": round(1000 * self._search_seconds / searches, 3) if searches else 0.0,
+            "last_compaction_seconds": self._last_compaction_seconds,
+        }
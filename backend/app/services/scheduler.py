@@ -0,0 +1,152 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class QueueFullError(Exception):
+    """Raised when the request queue is already at its configured depth."""
+
+
+class QueueTimeoutError(Exception):
+    """Raised when a queued request waited longer than its timeout."""
+
+
+class Ticket:
+    """A single request's place in the scheduler queue."""
+
+    def __init__(self, priority: int, seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.worker = None
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+
+    def __lt__(self, other: "Ticket"):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    @property
+    def queue_wait(self) -> float:
+        end = self.started_at if self.started_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+
+class InferenceScheduler:
+    """
+    Bounded priority queue in front of a pool of model workers.
+
+    Each worker (e.g. a Llama instance) is handed to exactly one request at a time,
+    so llama.cpp contexts are never driven from two threads at once. Requests are
+    admitted by (priority, arrival order): lower priority values are served first,
+    equal priorities are FIFO.
+    """
+
+    def __init__(self, workers: list, max_queue_depth: int, poll_interval: float = 1.0):
+        self._cond = threading.Condition()
+        self._idle = list(workers)
+        self._size = len(self._idle)
+        self._waiting = []
+        self._seq = itertools.count()
+        self.max_queue_depth = max_queue_depth
+        self.poll_interval = poll_interval
+        self._admitted = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._completed = 0
+
+    def add_worker(self, worker):
+        """Bring another worker into service (e.g. once a model instance has finished loading)."""
+        with self._cond:
+            self._idle.append(worker)
+            self._size += 1
+            self._dispatch()
+
+    def _is_full(self) -> bool:
+        return not self._idle and len(self._waiting) >= self.max_queue_depth
+
+    def check_capacity(self):
+        """Fail fast (without queueing) if a new request would be rejected."""
+        with self._cond:
+            if self._is_full():
+                self._rejected += 1
+                raise QueueFullError(f"Local model queue is full ({self.max_queue_depth} waiting)")
+
+    def submit(self, priority: int = 0) -> Ticket:
+        """Queue a request. Raises QueueFullError instead of blocking when the queue is full."""
+        with self._cond:
+            if self._is_full():
+                self._rejected += 1
+                raise QueueFullError(f"Local model queue is full ({self.max_queue_depth} waiting)")
+            ticket = Ticket(priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            self._admitted += 1
+            self._dispatch()
+            return ticket
+
+    def _dispatch(self):
+        while self._idle and self._waiting:
+            ticket = heapq.heappop(self._waiting)
+            ticket.worker = self._idle.pop()
+        self._cond.notify_all()
+
+    def _position(self, ticket: Ticket) -> int:
+        return 1 + sum(1 for other in self._waiting if other < ticket)
+
+    def wait(self, ticket: Ticket, timeout: float = None, cancel: threading.Event = None):
+        """
+        Block until the ticket is assigned a worker.
+
+        Yields the ticket's 1-based queue position every time it changes, so callers
+        can forward progress to the client while they wait. Returns early, without a
+        worker, once `cancel` is set; the caller still releases the ticket.
+        """
+        deadline = None if timeout is None else ticket.enqueued_at + timeout
+        poll_interval = self.poll_interval if cancel is None else min(self.poll_interval, 0.1)
+        last_position = None
+        while True:
+            if cancel is not None and cancel.is_set():
+                return
+            with self._cond:
+                if ticket.worker is None and last_position is not None:
+                    if self._position(ticket) == last_position:
+                        wait_for = poll_interval
+                        if deadline is not None:
+                            wait_for = max(0.0, min(wait_for, deadline - time.monotonic()))
+                        self._cond.wait(wait_for)
+                if ticket.worker is not None:
+                    ticket.started_at = time.monotonic()
+                    return
+                if deadline is not None and time.monotonic() >= deadline:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._timed_out += 1
+                    raise QueueTimeoutError(f"Waited {timeout:.0f}s for the local model")
+                position = self._position(ticket)
+            if position != last_position:
+                last_position = position
+                yield position
+
+    def release(self, ticket: Ticket):
+        """Return the ticket's worker to the pool, or drop the ticket if it never ran."""
+        with self._cond:
+            if ticket.worker is not None:
+                self._idle.append(ticket.worker)
+                ticket.worker = None
+                self._completed += 1
+            elif ticket in self._waiting:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+            self._dispatch()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "workers": self._size,
+                "busy": self._size - len(self._idle),
+                "queued": len(self._waiting),
+                "max_queue_depth": self.max_queue_depth,
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+                "completed": self._completed,
+            }
@@ -0,0 +1,336 @@
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .compaction import is_summary
+
+logger = logging.getLogger(__name__)
+
+# Rough per-message bookkeeping overhead (dict, strings, token cache) on top of the content itself
+MESSAGE_OVERHEAD_BYTES = 200
+
+
+def message_bytes(message: dict) -> int:
+    return len(message["content"]) + MESSAGE_OVERHEAD_BYTES
+
+
+def new_generation() -> int:
+    # Random, so a session deleted and started again (or started on another replica) never reuses one
+    return secrets.randbits(52)
+
+
+class _Session:
+    __slots__ = ("messages", "bytes", "last_access", "revision", "generation")
+
+    def __init__(self, messages: list, revision: int = None, generation: int = None):
+        self.messages = messages
+        self.bytes = sum(message_bytes(m) for m in messages)
+        self.last_access = time.monotonic()
+        self.revision = len(messages) if revision is None else revision
+        self.generation = new_generation() if generation is None else generation
+
+
+class SessionStore:
+    """
+    Chat histories keyed by session id.
+
+    Each session has a `revision`, the number of messages ever appended to it (trimming and
+    compaction do not change it), and a `generation` that changes whenever its stored messages
+    are rewritten other than at the tail (compaction, replacement). Holders of a copy can then
+    catch up with just the messages appended since their revision (see `since()`).
+
+    The in-memory tier is an LRU bounded by session count, idle TTL and total bytes. When a
+    SQLite path is configured, changed sessions are written behind by a background thread
+    (WAL mode) so evicted or pre-restart sessions are reloaded on their next access.
+    """
+
+    def __init__(self, max_sessions: int, idle_ttl: float, max_bytes: int,
+                 db_path: str = None, flush_interval: float = 1.0):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._dirty = {}
+        self._flushing = {}  # rows taken by a flush, until they are committed
+        self._flushes = 0  # flushes finished, so a row read outside the lock knows if it may be stale
+        self._evictions = {"count": 0, "ttl": 0, "bytes": 0}
+        self._loads = 0
+
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._writer = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions "
+                "(session_id TEXT PRIMARY KEY, messages TEXT NOT NULL, updated_at REAL NOT NULL, "
+                "revision INTEGER, generation INTEGER)"
+            )
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(sessions)")}
+            for column in ("revision", "generation"):
+                if column not in columns:
+                    self._db.execute(f"ALTER TABLE sessions ADD COLUMN {column} INTEGER")
+            self._db.commit()
+            self._writer = threading.Thread(target=self._write_behind, name="session-store-writer", daemon=True)
+            self._writer.start()
+
+    @property
+    def persistent(self) -> bool:
+        """Whether a lookup may read SQLite (async callers should run it in a thread)."""
+        return self._db is not None
+
+    # ----- In-memory tier -----
+
+    def _fetch(self, session_id: str):
+        """
+        Read an evicted session's row before the caller takes the store lock, so a slow SQLite read
+        holds up only this caller, not every other session (nor the event loop of an async handler
+        waiting on the lock). Returns what `_touch` needs to use the row, or None if it has no use for it.
+        """
+        if self._db is None:
+            return None
+        with self._lock:
+            if session_id in self._sessions or session_id in self._dirty or session_id in self._flushing:
+                return None
+            flushes = self._flushes
+        return flushes, self._load(session_id)
+
+    def _touch(self, session_id: str, fetched: tuple = None):
+        """Return the live session, reloading it from SQLite if it was evicted (`fetched` by `_fetch`)."""
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._sessions.move_to_end(session_id)
+        else:
+            # A row still on its way to SQLite is newer than the stored one
+            row = self._dirty.get(session_id) or self._flushing.get(session_id)
+            if row is None:
+                if fetched is not None and fetched[0] == self._flushes:
+                    row = fetched[1]  # nothing was written since it was read
+                else:
+                    row = self._load(session_id)
+            if row is None or not row[0]:
+                return None
+            messages, revision, generation = row
+            session = _Session(list(messages), revision, generation)
+            self._sessions[session_id] = session
+            self._bytes += session.bytes
+            self._loads += 1
+        session.last_access = time.monotonic()
+        return session
+
+    def _evict(self, now: float):
+        """Drop idle sessions, then least-recently-used ones until under the count and byte caps."""
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_access > self.idle_ttl:
+                reason = "ttl"
+            elif len(self._sessions) > self.max_sessions:
+                reason = "count"
+            elif self._bytes > self.max_bytes and len(self._sessions) > 1:
+                reason = "bytes"
+            else:
+                break
+            del self._sessions[session_id]
+            self._bytes -= session.bytes
+            self._evictions[reason] += 1
+
+    def get(self, session_id: str) -> list:
+        """Messages of a session (empty if unknown). Callers must not mutate the returned list."""
+        fetched = self._fetch(session_id)
+        with self._lock:
+            session = self._touch(session_id, fetched)
+            self._evict(time.monotonic())
+            return session.messages if session is not None else []
+
+    def append(self, session_id: str, message: dict, max_messages: int):
+        fetched = self._fetch(session_id)
+        with self._lock:
+            session = self._touch(session_id, fetched)
+            if session is None:
+                session = _Session([])
+                self._sessions[session_id] = session
+            session.messages.append(message)
+            session.revision += 1
+            session.bytes += message_bytes(message)
+            self._bytes += message_bytes(message)
+
+            if len(session.messages) > max_messages:
+                # A rolling summary at the head (see compaction.py) outlives the turns after it
+                pinned = 1 if is_summary(session.messages[0]) else 0
+                cut = pinned + len(session.messages) - max_messages
+                dropped = session.messages[pinned:cut]
+                session.messages = session.messages[:pinned] + session.messages[cut:]
+                freed = sum(message_bytes(m) for m in dropped)
+                session.bytes -= freed
+                self._bytes -= freed
+
+            self._mark_dirty(session_id, session)
+            self._evict(time.monotonic())
+
+    def replace_prefix(self, session_id: str, prefix: list, message: dict) -> bool:
+        """
+        Replace the session's first messages, if they are still exactly `prefix`, with one message
+        (e.g. a summary of them). Returns False if the session changed meanwhile.
+        """
+        fetched = self._fetch(session_id)
+        with self._lock:
+            session = self._touch(session_id, fetched)
+            if session is None or len(session.messages) < len(prefix):
+                return False
+            if any(a is not b for a, b in zip(session.messages, prefix)):
+                return False
+            session.messages = [message] + session.messages[len(prefix):]
+            session.generation = new_generation()
+            delta = message_bytes(message) - sum(message_bytes(m) for m in prefix)
+            session.bytes += delta
+            self._bytes += delta
+            self._mark_dirty(session_id, session)
+            return True
+
+    def replace(self, session_id: str, messages: list, revision: int, generation: int = None):
+        """
+        Make `messages` the session's history at `revision` (e.g. a copy another replica held);
+        `generation` keeps that copy's, so its other holders stay in step. Returns the state.
+        """
+        with self._lock:
+            old = self._sessions.pop(session_id, None)
+            if old is not None:
+                self._bytes -= old.bytes
+            session = _Session(list(messages), revision, generation)
+            self._sessions[session_id] = session
+            self._bytes += session.bytes
+            self._mark_dirty(session_id, session)
+            self._evict(time.monotonic())
+            return self._state(session)
+
+    def _mark_dirty(self, session_id: str, session: _Session):
+        if self._db is not None:
+            self._dirty[session_id] = (session.messages, session.revision, session.generation)
+
+    @staticmethod
+    def _state(session) -> dict:
+        if session is None:
+            return {"revision": 0, "generation": 0, "length": 0}
+        return {"revision": session.revision, "generation": session.generation, "length": len(session.messages)}
+
+    def state(self, session_id: str) -> dict:
+        """Revision, generation and stored message count (all 0 for an unknown session)."""
+        fetched = self._fetch(session_id)
+        with self._lock:
+            return self._state(self._touch(session_id, fetched))
+
+    def since(self, session_id: str, revision: int = None, generation: int = None) -> dict:
+        """
+        The state plus what a copy at (`revision`, `generation`) is missing: the messages appended
+        since, or every stored message with `reset` when that copy cannot just be extended.
+        """
+        fetched = self._fetch(session_id)
+        with self._lock:
+            session = self._touch(session_id, fetched)
+            state = self._state(session)
+            messages = session.messages if session is not None else []
+            missing = state["revision"] - revision if revision is not None else -1
+            pinned = 1 if messages and is_summary(messages[0]) else 0
+            if generation == state["generation"] and 0 <= missing <= len(messages) - pinned:
+                return {**state, "reset": False, "messages": messages[len(messages) - missing:]}
+            return {**state, "reset": True, "messages": list(messages)}
+
+    def delete(self, session_id: str):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self._bytes -= session.bytes
+            if self._db is not None:
+                # No messages marks the row for deletion on the next flush
+                self._dirty[session_id] = ([], 0, 0)
+
+    # ----- SQLite tier -----
+
+    def _load(self, session_id: str):
+        if self._db is None:
+            return None
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT messages, revision, generation FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return (json.loads(row[0]), row[1], row[2]) if row else None
+
+    def flush(self):
+        """Write every changed session to SQLite."""
+        if self._db is None:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            pending, self._dirty = self._dirty, {}
+            self._flushing.update(pending)
+            now = time.time()
+            rows = [
+                (sid, json.dumps([{k: m[k] for k in ("role", "content", "source") if k in m} for m in msgs]), now,
+                 revision, generation)
+                for sid, (msgs, revision, generation) in pending.items() if msgs
+            ]
+            deleted = [(sid,) for sid, (msgs, _, _) in pending.items() if not msgs]
+        try:
+            with self._db_lock:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO sessions (session_id, messages, updated_at, revision, generation) "
+                    "VALUES (?, ?, ?, ?, ?)", rows
+                )
+                self._db.executemany("DELETE FROM sessions WHERE session_id = ?", deleted)
+                self._db.commit()
+        except Exception:
+            with self._lock:
+                # Retried on the next flush, unless the session changed again meanwhile
+                for session_id, row in pending.items():
+                    self._dirty.setdefault(session_id, row)
+            raise
+        finally:
+            with self._lock:
+                self._flushes += 1
+                for session_id, row in pending.items():
+                    if self._flushing.get(session_id) is row:
+                        del self._flushing[session_id]
+
+    def _write_behind(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Session store flush failed: {e}")
+
+    def close(self):
+        if self._db is None:
+            return
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join(timeout=5)
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+        self._db = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self._bytes,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "evictions": dict(self._evictions),
+                "reloads": self._loads,
+                "pending_writes": len(self._dirty.keys() | self._flushing.keys()),
+                "persistent": self._db is not None,
+            }
@@ -0,0 +1,153 @@
+#type:ignore
+import collections
+import logging
+import threading
+
+import numpy as np
+from llama_cpp import Llama, LlamaDraftModel, LlamaPromptLookupDecoding
+
+from .kv_cache import common_prefix_length
+from .metrics import speculative_pauses, speculative_tokens
+
+logger = logging.getLogger(__name__)
+
+_NO_DRAFT = np.array([], dtype=np.intc)
+
+
+class DraftModelDecoding(LlamaDraftModel):
+    """Greedy drafts from a small GGUF model that shares the target model's vocabulary."""
+
+    def __init__(self, model_path: str, n_ctx: int, num_pred_tokens: int, **kwargs):
+        # Room for a full draft past an input that fills the target model's context
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx + num_pred_tokens, verbose=False, **kwargs)
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, /, **kwargs):
+        limit = min(self.num_pred_tokens, self.llm.n_ctx() - len(input_ids))
+        if limit <= 0:
+            return _NO_DRAFT
+        draft = []
+        try:
+            # generate() reuses the draft context's KV cache for the prefix the two models still share
+            for token in self.llm.generate(input_ids.tolist(), top_k=1, temp=0.0):
+                if token == self.llm.token_eos():
+                    break
+                draft.append(token)
+                if len(draft) >= limit:
+                    break
+        except Exception as e:
+            # A failed draft only costs its speedup; the reply goes on with plain decoding
+            logger.warning(f"Draft model failed at {len(input_ids)} tokens: {e}")
+            return _NO_DRAFT
+        return np.array(draft, dtype=np.intc)
+
+
+class SpeculativeDrafter(LlamaDraftModel):
+    """
+    Passed to `Llama(draft_model=...)`: proposes draft tokens, measures how many the model keeps,
+    and pauses drafting while that stops paying.
+
+    llama-cpp-python evaluates the last sampled token plus the draft in one decode, samples every
+    position from the target model's own logits as usual, and keeps draft tokens only while they
+    match what it sampled. The output is therefore distributed exactly as with plain decoding; a
+    good draft just yields several tokens per decode.
+
+    A draft's acceptance is known on the next call, whose input holds the tokens sampled since.
+    When fewer than `min_acceptance` of the last `window` drafted tokens were kept, drafting
+    pauses for `pause` calls (plain decoding, one token per decode), then probes again.
+    """
+
+    def __init__(self, drafter: LlamaDraftModel, min_acceptance: float, window: int = 128, pause: int = 64):
+        self.drafter = drafter
+        self.min_acceptance = min_acceptance
+        self.pause = pause
+        self._recent = collections.deque(maxlen=window)  # 1 per kept draft token, 0 per rejected one
+        self._pending = None  # (input length, draft) awaiting its outcome
+        self._paused_for = 0
+        self._lock = threading.Lock()
+        self._drafts = 0
+        self._drafted = 0
+        self._accepted = 0
+        self._pauses = 0
+
+    def check_vocab(self, llm: Llama):
+        """A draft model must tokenize exactly like the model it drafts for."""
+        draft_llm = getattr(self.drafter, "llm", None)
+        if draft_llm is not None and draft_llm.n_vocab() != llm.n_vocab():
+            raise ValueError(
+                f"Draft model vocabulary ({draft_llm.n_vocab()}) differs from the model's ({llm.n_vocab()})"
+            )
+
+    def begin(self):
+        """Call before each completion: a draft left over from the last one has no outcome to measure."""
+        self._pending = None
+
+    def __call__(self, input_ids, /, **kwargs):
+        if self._pending is not None:
+            self._record(input_ids)
+        if self._paused_for:
+            self._paused_for -= 1
+            return _NO_DRAFT
+
+        draft = self.drafter(input_ids)
+        if len(draft):
+            self._pending = (len(input_ids), draft.tolist())
+        return draft
+
+    def _record(self, input_ids):
+        start, draft = self._pending
+        self._pending = None
+        accepted = common_prefix_length(input_ids[start:start + len(draft)].tolist(), draft)
+        self._recent.extend([1] * accepted + [0] * (len(draft) - accepted))
+        speculative_tokens.labels("drafted").inc(len(draft))
+        speculative_tokens.labels("accepted").inc(accepted)
+        with self._lock:
+            self._drafts += 1
+            self._drafted += len(draft)
+            self._accepted += accepted
+
+        if len(self._recent) == self._recent.maxlen and sum(self._recent) < self.min_acceptance * len(self._recent):
+            self._recent.clear()
+            self._paused_for = self.pause
+            speculative_pauses.inc()
+            with self._lock:
+                self._pauses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "drafts": self._drafts,
+                "drafted_tokens": self._drafted,
+                "accepted_tokens": self._accepted,
+                "pauses": self._pauses,
+                "paused_workers": 1 if self._paused_for else 0,
+            }
+
+
+def make_drafter(mode: str, draft_tokens: int, ngram: int, min_acceptance: float, draft_model_path: str = None,
+                 n_ctx: int = 0):
+    """The draft model for one Llama worker, or None when speculative decoding is off."""
+    if mode == "off":
+        return None
+    if mode == "prompt_lookup":
+        drafter = LlamaPromptLookupDecoding(max_ngram_size=ngram, num_pred_tokens=draft_tokens)
+    elif mode == "draft":
+        drafter = DraftModelDecoding(draft_model_path, n_ctx, draft_tokens)
+    else:
+        raise ValueError(f"Unknown speculative decoding mode {mode!r} (expected off, prompt_lookup or draft)")
+    return SpeculativeDrafter(drafter, min_acceptance)
+
+
+def speculative_stats(drafters: list, mode: str) -> dict:
+    """Acceptance across all workers' drafters."""
+    totals = {"drafts": 0, "drafted_tokens": 0, "accepted_tokens": 0, "pauses": 0, "paused_workers": 0}
+    for drafter in drafters:
+        for key, value in drafter.stats().items():
+            totals[key] += value
+    drafted = totals["drafted_tokens"]
+    return {
+        "mode": mode,
+        **totals,
+        "acceptance_rate": round(totals["accepted_tokens"] / drafted, 3) if drafted else None,
+        "accepted_per_draft": round(totals["accepted_tokens"] / totals["drafts"], 2) if totals["drafts"] else None,
+    }
@@ -0,0 +1,231 @@
+import os
+import threading
+import time
+
+from .scheduler import InferenceScheduler, QueueFullError
+
+
+class ModelTier:
+    """One local model profile (weights file and context size) with its own workers, queue and recent speed."""
+
+    def __init__(self, name: str, model_path: str, n_ctx: int, workers: int = 1, max_prompt_tokens: int = None,
+                 tokens_per_s: float = 10.0, memory_bytes: int = None, kv_bytes_per_token: int = 512 * 1024,
+                 max_queue_depth: int = 8, target: str = None):
+        self.name = name
+        self.model_path = model_path
+        self.model_name = os.path.basename(model_path)
+        self.n_ctx = n_ctx
+        self.worker_count = workers
+        self.max_prompt_tokens = max_prompt_tokens
+        self.memory_bytes = memory_bytes
+        self.kv_bytes_per_token = kv_bytes_per_token
+        self.max_queue_depth = max_queue_depth
+        self.target = target or f"offline:{name}"  # token counter name (see memory.register_token_counter)
+        self.scheduler = InferenceScheduler([], max_queue_depth)
+        self.workers = []
+        self.state = "unloaded"  # unloaded -> loading -> ready -> unloading -> unloaded | failed
+        self.error = None
+        self.load_seconds = None
+        self.tokens_per_s = tokens_per_s  # moving average, starting from the configured guess
+        self.served = 0
+        self.last_used = 0.0
+
+    def memory_estimate(self) -> int:
+        """Configured `memory_bytes`, else the weights file plus each worker's KV cache."""
+        if self.memory_bytes:
+            return self.memory_bytes
+        try:
+            weights = os.path.getsize(self.model_path)
+        except OSError:
+            weights = 0
+        return weights + self.worker_count * self.n_ctx * self.kv_bytes_per_token
+
+    def fits(self, prompt_tokens: int, reply_tokens: int) -> bool:
+        """True if the whole prompt and a full reply fit this tier's context (and its prompt limit)."""
+        if self.max_prompt_tokens is not None and prompt_tokens > self.max_prompt_tokens:
+            return False
+        return prompt_tokens + reply_tokens <= self.n_ctx
+
+    def estimated_wait(self, reply_tokens: float) -> float:
+        """Seconds a new request would wait for a worker, for replies of `reply_tokens` at the recent speed."""
+        stats = self.scheduler.stats()
+        if stats["busy"] < stats["workers"]:
+            return 0.0
+        if not stats["workers"]:
+            return float("inf")
+        return (stats["queued"] + 1) / stats["workers"] * reply_tokens / max(self.tokens_per_s, 0.1)
+
+    def reset_workers(self):
+        """Forget this tier's workers (after they were closed); a fresh queue serves the next load."""
+        self.workers = []
+        self.scheduler = InferenceScheduler([], self.max_queue_depth)
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "model": self.model_name,
+            "n_ctx": self.n_ctx,
+            "state": self.state,
+            "workers": len(self.workers),
+            "memory_estimate": self.memory_estimate(),
+            "tokens_per_s": round(self.tokens_per_s, 1),
+            "served": self.served,
+            "load_seconds": self.load_seconds,
+            "error": self.error,
+            "scheduler": self.scheduler.stats(),
+        }
+
+
+class TierRegistry:
+    """
+    The local model tiers, best first, and the policy that picks one per request.
+
+    A request goes to the first tier whose context holds its whole conversation plus a reply
+    (and that allows a prompt that long) as long as that tier's estimated queue wait is at
+    most `max_wait`; otherwise to the next such tier that is quick enough, or failing that the
+    one with the shortest wait. A per-request override picks a tier outright while it is loaded.
+
+    The first tier is the default and always stays loaded. Others are loaded up front while
+    their memory estimates fit `memory_budget` (0: no limit); the rest are swapped in when the
+    policy would have picked them, evicting the least recently used tiers that have been idle
+    for `min_idle` seconds to make room (so two tiers cannot keep evicting each other).
+    """
+
+    def __init__(self, tiers: list, max_wait: float, memory_budget: int = 0, min_idle: float = 60.0,
+                 reply_tokens: float = 128):
+        if not tiers:
+            raise ValueError("At least one model tier is required")
+        self.tiers = tiers
+        self.max_wait = max_wait
+        self.memory_budget = memory_budget
+        self.min_idle = min_idle
+        self.reply_tokens = reply_tokens  # moving average of reply length, across tiers
+        self._lock = threading.Lock()
+        self._by_name = {tier.name: tier for tier in tiers}
+        if len(self._by_name) != len(tiers):
+            raise ValueError("Model tier names must be unique")
+
+    @property
+    def default(self) -> ModelTier:
+        return self.tiers[0]
+
+    def get(self, name: str) -> ModelTier:
+        return self._by_name.get(name)
+
+    def workers(self) -> list:
+        return [llm for tier in self.tiers for llm in tier.workers]
+
+    # ----- Policy -----
+
+    def acquire(self, prompt_tokens: int, max_tokens: int, priority: int = 0, preferred: str = None):
+        """
+        Pick a tier and queue the request on it: returns (tier, ticket, reason, wanted).
+
+        `reason` is "override", "preferred" (the best tier that fits), "fit" (better tiers do not
+        fit or are not loaded) or "load" (better tiers are busy). `wanted` is an unloaded tier the
+        policy would rather have used (a better fit, or spare capacity), for the caller to swap in.
+        Raises QueueFullError when every candidate's queue is full.
+        """
+        with self._lock:
+            fitting = [t for t in self.tiers if t.fits(prompt_tokens, max_tokens) and t.state != "failed"]
+            ready = [t for t in self.tiers if t.state == "ready"]
+            wanted = fitting[0] if fitting and fitting[0].state == "unloaded" else None
+
+            override = self.get(preferred) if preferred is not None else None
+            if override is not None and override.state != "ready":
+                wanted = override if override.state == "unloaded" else wanted
+                override = None
+
+            candidates = [t for t in fitting if t.state == "ready"]
+            if not candidates:
+                # Nothing holds the whole conversation: the largest context keeps the most of it
+                candidates = sorted(ready, key=lambda t: -t.n_ctx)[:1]
+            if not candidates and override is None:
+                raise QueueFullError("No local model tier is loaded")
+
+            waits = {t.name: t.estimated_wait(self.reply_tokens) for t in candidates}
+            quick = [t for t in candidates if waits[t.name] <= self.max_wait]
+            if wanted is None and not quick:
+                # Every loaded tier is backed up: bring in one that is not loaded yet
+                wanted = next((t for t in fitting if t.state == "unloaded"), None)
+            order = quick + sorted((t for t in candidates if t not in quick), key=lambda t: waits[t.name])
+            if override is not None:
+                order = [override] + [t for t in order if t is not override]
+
+            for tier in order:
+                try:
+                    ticket = tier.scheduler.submit(priority)
+                except QueueFullError:
+                    continue
+                if tier is override:
+                    reason = "override"
+                elif fitting and tier is fitting[0]:
+                    reason = "preferred"
+                elif tier is candidates[0]:
+                    reason = "fit"
+                else:
+                    reason = "load"
+                tier.served += 1
+                tier.last_used = time.monotonic()
+                return tier, ticket, reason, wanted
+            raise QueueFullError("Every local model tier's queue is full")
+
+    def record(self, tier: ModelTier, tokens: int, seconds: float):
+        """Fold one finished reply into the tier's speed and the reply-length average."""
+        if tokens and seconds > 0:
+            tier.tokens_per_s += 0.2 * (tokens / seconds - tier.tokens_per_s)
+        self.reply_tokens += 0.2 * (tokens - self.reply_tokens)
+
+    def check_capacity(self):
+        """Fail fast (without queueing) if no loaded tier could take a new request."""
+        with self._lock:
+            ready = [t for t in self.tiers if t.state == "ready"]
+            errors = []
+            for tier in ready:
+                try:
+                    tier.scheduler.check_capacity()
+                    return
+                except QueueFullError as e:
+                    errors.append(e)
+            if errors:
+                raise errors[0]
+
+    # ----- Memory budget -----
+
+    def resident_bytes(self) -> int:
+        return sum(t.memory_estimate() for t in self.tiers if t.state in ("loading", "ready", "unloading"))
+
+    def fits_budget(self, tier: ModelTier) -> bool:
+        return not self.memory_budget or self.resident_bytes() + tier.memory_estimate() <= self.memory_budget
+
+    def eviction_candidates(self, tier: ModelTier) -> list:
+        """Least recently used loaded tiers (never the default) to unload so `tier` fits; None if it cannot."""
+        if not self.memory_budget or tier.memory_estimate() > self.memory_budget:
+            return None if self.memory_budget else []
+        victims = []
+        free = self.memory_budget - self.resident_bytes()
+        idle_since = time.monotonic() - self.min_idle
+        loaded = sorted(
+            (t for t in self.tiers[1:] if t.state == "ready" and t is not tier and t.last_used <= idle_since),
+            key=lambda t: t.last_used
+        )
+        for victim in loaded:
+            if free >= tier.memory_estimate():
+                break
+            victims.append(victim)
+            free += victim.memory_estimate()
+        return victims if free >= tier.memory_estimate() else None
+
+    def begin_unload(self, tier: ModelTier):
+        """Stop routing to `tier`; it can be unloaded once its queue drains."""
+        with self._lock:
+            tier.state = "unloading"
+
+    def stats(self) -> dict:
+        return {
+            "max_wait": self.max_wait,
+            "reply_tokens": round(self.reply_tokens),
+            "memory_budget": self.memory_budget,
+            "resident_bytes": self.resident_bytes(),
+            "tiers": [tier.stats() for tier in self.tiers],
+        }
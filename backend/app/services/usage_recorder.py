@@ -0,0 +1,201 @@
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+def _token_totals() -> dict:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+def _add(totals: dict, event: dict):
+    totals["calls"] += 1
+    for field in ("prompt_tokens", "completion_tokens", "total_tokens"):
+        totals[field] += event.get(field) or 0
+
+
+class UsageRecorder:
+    """
+    API usage accounting off the request path.
+
+    `record()` only updates in-memory aggregates and enqueues the event; a background thread
+    appends queued events to a JSONL file in batches (every `batch_size` events or
+    `flush_interval` seconds) and rotates the file when it exceeds `max_file_bytes` or the
+    UTC date changes, keeping the newest `backups` rotated files.
+    """
+
+    def __init__(self, path: str, max_file_bytes: int, backups: int, flush_interval: float = 1.0,
+                 batch_size: int = 100, max_queue: int = 10000, hours_kept: int = 48, max_sessions: int = 10000):
+        self.path = path
+        self.max_file_bytes = max_file_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.hours_kept = hours_kept
+        self.max_sessions = max_sessions
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._totals = _token_totals()
+        self._by_model = defaultdict(_token_totals)
+        self._by_hour = OrderedDict()  # "YYYY-MM-DDTHH" -> totals, oldest first
+        self._by_session = OrderedDict()  # session_id -> totals, least recently active first
+        self._mismatches = 0
+        self._dropped = 0
+        self._written = 0
+        self._rotations = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file_day = self._day_of_existing_file()
+        self._stop = threading.Event()
+        self._writer = threading.Thread(target=self._run, name="usage-recorder", daemon=True)
+        self._writer.start()
+
+    # ----- Request path -----
+
+    def record(self, event: dict):
+        """Account for one API call. Never blocks: if the writer has fallen behind, the file line is dropped."""
+        with self._lock:
+            _add(self._totals, event)
+            _add(self._by_model[event.get("model_used") or "unknown"], event)
+            if event.get("model_used") != event.get("model_requested"):
+                self._mismatches += 1
+
+            hour = event["timestamp"][:13]
+            if hour not in self._by_hour:
+                self._by_hour[hour] = _token_totals()
+                while len(self._by_hour) > self.hours_kept:
+                    self._by_hour.popitem(last=False)
+            _add(self._by_hour[hour], event)
+
+            session_id = event.get("session_id", "")
+            session = self._by_session.pop(session_id, None) or _token_totals()
+            _add(session, event)
+            self._by_session[session_id] = session
+            while len(self._by_session) > self.max_sessions:
+                self._by_session.popitem(last=False)
+
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+    # ----- Writer thread -----
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        # close() also sets _stop, for when the queue is too full to take its sentinel
+        while not self._stop.is_set():
+            timeout = max(deadline - time.monotonic(), 0)
+            try:
+                event = self._queue.get(timeout=timeout)
+                if event is None:
+                    break
+                batch.append(event)
+            except queue.Empty:
+                pass
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._write(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+        # Drain whatever was queued before close()
+        while True:
+            try:
+                event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is not None:
+                batch.append(event)
+        self._write(batch)
+
+    def _write(self, batch: list):
+        if not batch:
+            return
+        data = "".join(json.dumps(event) + "\n" for event in batch)
+        try:
+            self._maybe_rotate(len(data))
+            with open(self.path, "a") as f:
+                f.write(data)
+            with self._lock:
+                self._written += len(batch)
+        except OSError as e:
+            logger.error(f"Failed to write {len(batch)} usage events: {e}")
+
+    # ----- Rotation -----
+
+    def _day_of_existing_file(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return None
+        return datetime.fromtimestamp(mtime, timezone.utc).date()
+
+    def _maybe_rotate(self, incoming: int):
+        today = datetime.now(timezone.utc).date()
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            self._file_day = today
+            return
+        if self._file_day == today and size + incoming <= self.max_file_bytes:
+            return
+
+        stem, ext = os.path.splitext(self.path)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S-%f")
+        os.replace(self.path, f"{stem}.{stamp}{ext}")
+        self._file_day = today
+        with self._lock:
+            self._rotations += 1
+
+        for old in sorted(glob.glob(f"{glob.escape(stem)}.*{ext}"))[:-self.backups or None]:
+            try:
+                os.remove(old)
+            except OSError as e:
+                logger.warning(f"Could not remove old usage log {old}: {e}")
+
+    def close(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        try:
+            self._queue.put_nowait(None)  # wakes the writer if it is waiting for events
+        except queue.Full:
+            pass
+        self._writer.join(timeout=5)
+
+    # ----- Aggregates -----
+
+    def summary(self, top_sessions: int = 20) -> dict:
+        with self._lock:
+            sessions = sorted(self._by_session.items(), key=lambda item: item[1]["total_tokens"], reverse=True)
+            return {
+                "totals": dict(self._totals),
+                "model_mismatches": self._mismatches,
+                "by_model": {model: dict(t) for model, t in self._by_model.items()},
+                "by_hour": {hour: dict(t) for hour, t in self._by_hour.items()},
+                "top_sessions": {sid: dict(t) for sid, t in sessions[:top_sessions]},
+                "tracked_sessions": len(self._by_session),
+                "log": {
+                    "path": self.path,
+                    "written": self._written,
+                    "pending": self._queue.qsize(),
+                    "dropped": self._dropped,
+                    "rotations": self._rotations,
+                },
+            }
+
+    def session_usage(self, session_id: str):
+        with self._lock:
+            totals = self._by_session.get(session_id)
+            return dict(totals) if totals is not None else None
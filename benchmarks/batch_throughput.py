@@ -0,0 +1,110 @@
+"""
+Aggregate local-model throughput: N questions one at a time through /api/chat versus one
+/api/chat/batch request (continuous batching), on the fake `llama_cpp` (see fake_modules).
+
+The batch speedup on the fake comes from its cost model (FAKE_LLAMA_BATCH_COST, the extra
+cost of each additional sequence in a decode step); on real hardware, measure with a GGUF model.
+Exits non-zero if the speedup is below --min-speedup.
+
+    python benchmarks/batch_throughput.py --items 32 --tokens 48
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fakes import serve
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BACKEND_PORT = 18400
+BASE = f"http://127.0.0.1:{BACKEND_PORT}/api"
+
+
+def start_backend(args):
+    os.environ.update({
+        "FAKE_LLAMA_PROMPT_MS": str(args.prompt_ms),
+        "FAKE_LLAMA_TOKEN_MS": str(args.token_ms),
+        "FAKE_LLAMA_TOKENS": str(args.tokens),
+        "FAKE_LLAMA_BATCH_COST": str(args.batch_cost),
+        "CEREBRAS_API_KEY": "",
+    })
+    sys.path[:0] = [os.path.join(HERE, "fake_modules"), os.path.join(ROOT, "backend"), ROOT]
+    os.chdir(tempfile.mkdtemp(prefix="bridgeai-batch-"))
+
+    from app.main import app
+
+    serve(app, BACKEND_PORT)
+    while httpx.get(f"http://127.0.0.1:{BACKEND_PORT}/readyz").status_code != 200:
+        time.sleep(0.05)
+
+
+def questions(count: int) -> list:
+    return [f"FAQ {i}: how do I keep answers available without a connection?" for i in range(count)]
+
+
+def sequential(client: httpx.Client, queries: list) -> float:
+    start = time.perf_counter()
+    for i, query in enumerate(queries):
+        payload = {"session_id": f"seq-{i}", "query": query, "no_cache": True}
+        with client.stream("POST", f"{BASE}/chat", json=payload) as response:
+            for _ in response.iter_lines():
+                pass
+    return time.perf_counter() - start
+
+
+def batched(client: httpx.Client, queries: list, max_tokens: int) -> tuple:
+    start = time.perf_counter()
+    payload = {"items": [{"query": q} for q in queries], "max_tokens": max_tokens}
+    results = []
+    with client.stream("POST", f"{BASE}/chat/batch", json=payload) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                results.append(json.loads(line))
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--items", type=int, default=32)
+    parser.add_argument("--tokens", type=int, default=48, help="tokens per answer")
+    parser.add_argument("--prompt-ms", type=float, default=0.5)
+    parser.add_argument("--token-ms", type=float, default=10.0)
+    parser.add_argument("--batch-cost", type=float, default=0.15)
+    parser.add_argument("--min-speedup", type=float, default=2.0)
+    args = parser.parse_args()
+
+    start_backend(args)
+    queries = questions(args.items)
+    with httpx.Client(timeout=600.0) as client:
+        sequential_s = sequential(client, queries)
+        batch_s, results = batched(client, queries, args.tokens)
+        stats = client.get(f"{BASE}/local/stats").json()["batch"]
+
+    summary = results[-1]
+    answered = [r for r in results if "finish_reason" in r]
+    tokens = args.items * args.tokens
+    report = {
+        "items": args.items,
+        "tokens_per_item": args.tokens,
+        "sequential_s": round(sequential_s, 3),
+        "sequential_tokens_per_s": round(tokens / sequential_s, 1),
+        "batch_s": round(batch_s, 3),
+        "batch_tokens_per_s": round(summary["completion_tokens"] / batch_s, 1),
+        "speedup": round(sequential_s / batch_s, 2),
+        "answered": len(answered),
+        "failed": summary["failed"],
+        "engine": stats,
+    }
+    print(json.dumps(report, indent=2))
+    if len(answered) != args.items or report["speedup"] < args.min_speedup:
+        sys.exit(f"Batch throughput check failed (speedup {report['speedup']}, answered {len(answered)}/{args.items})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Concurrency check for the gateway's online path against a local fake Cerebras SSE server.
+
+Runs N concurrent /chat streams routed to "Cerebras" and, meanwhile, polls the gateway's root endpoint.
+With a non-blocking online path the streams interleave (wall time close to one stream, not N) and
+the event loop stays responsive. Exits non-zero if either property fails.
+
+    python benchmarks/cerebras_concurrency.py --streams 8 --tokens 40 --token-delay 0.02
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+from fakes import make_fake_cerebras, serve
+
+CEREBRAS_PORT = 18100
+GATEWAY_PORT = 18180
+
+
+async def one_stream(client: httpx.AsyncClient, index: int) -> list:
+    arrivals = []
+    payload = {"messages": [{"role": "user", "content": "hello"}], "session_id": f"bench-{index}", "no_cache": True}
+    async with client.stream("POST", f"http://127.0.0.1:{GATEWAY_PORT}/chat", json=payload) as response:
+        async for line in response.aiter_lines():
+            if '"content"' in line:
+                arrivals.append(time.perf_counter())
+    return arrivals
+
+
+async def poll_root(client: httpx.AsyncClient, stop: asyncio.Event) -> list:
+    latencies = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.get(f"http://127.0.0.1:{GATEWAY_PORT}/")
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(0.02)
+    return latencies
+
+
+async def run(args) -> dict:
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        single_start = time.perf_counter()
+        await one_stream(client, -1)
+        single = time.perf_counter() - single_start
+
+        stop = asyncio.Event()
+        poller = asyncio.create_task(poll_root(client, stop))
+        start = time.perf_counter()
+        streams = await asyncio.gather(*(one_stream(client, i) for i in range(args.streams)))
+        wall = time.perf_counter() - start
+        stop.set()
+        latencies = sorted(await poller)
+
+    # Interleaving: every stream should have produced its first token before any stream finished
+    first_tokens = max(s[0] for s in streams)
+    earliest_finish = min(s[-1] for s in streams)
+    return {
+        "streams": args.streams,
+        "single_stream_s": round(single, 3),
+        "concurrent_wall_s": round(wall, 3),
+        "slowdown": round(wall / single, 2),
+        "interleaved": first_tokens < earliest_finish,
+        "root_latency_ms_p50": round(statistics.median(latencies), 2),
+        "root_latency_ms_max": round(latencies[-1], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--streams", type=int, default=8)
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--max-slowdown", type=float, default=2.0)
+    parser.add_argument("--max-root-latency-ms", type=float, default=100.0)
+    args = parser.parse_args()
+
+    os.environ["CEREBRAS_API_KEY"] = "fake-key"
+    os.environ["CEREBRAS_BASE_URL"] = f"http://127.0.0.1:{CEREBRAS_PORT}"
+    os.environ["NETWORK_PROBE_INTERVAL"] = "0"
+    root = os.path.join(os.path.dirname(__file__), "..")
+    sys.path[:0] = [os.path.join(root, "mcp-gateway"), root]
+    import gateway
+
+    # Pin routing to Cerebras without probing the internet
+    gateway.network_status = gateway.NetworkStatus(online=True, cerebras_available=True, last_check="pinned")
+
+    serve(make_fake_cerebras(args.tokens, args.token_delay), CEREBRAS_PORT)
+    serve(gateway.app, GATEWAY_PORT)
+
+    results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2))
+    if not results["interleaved"] or results["slowdown"] > args.max_slowdown:
+        sys.exit("Concurrent Cerebras streams were serialized")
+    if results["root_latency_ms_max"] > args.max_root_latency_ms:
+        sys.exit("Gateway event loop was blocked while streaming")
+
+
+if __name__ == "__main__":
+    main()
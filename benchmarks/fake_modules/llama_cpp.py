@@ -0,0 +1,338 @@
+"""
+Stand-in for `llama_cpp` so the backend can be benchmarked without a GGUF model.
+
+Put this directory first on sys.path before importing the backend. Latency is modelled on
+llama.cpp: loading takes FAKE_LLAMA_LOAD_S, prompt tokens not already in the context cost
+FAKE_LLAMA_PROMPT_MS per token, each generated token costs FAKE_LLAMA_TOKEN_MS, and at most
+FAKE_LLAMA_TOKENS are produced. FAKE_LLAMA_MODEL_TOKEN_MS (JSON, model file name -> ms) gives
+some models their own per-token cost, e.g. smaller model tiers.
+
+With `draft_model` (speculative decoding), each decode verifies the draft as llama.cpp does:
+a decode costs FAKE_LLAMA_TOKEN_MS * (1 + FAKE_LLAMA_VERIFY_COST * draft tokens) and yields
+one token plus the draft tokens matching the answer. Answers are a fixed function of the
+prompt; FAKE_LLAMA_ECHO is the share of FAKE_LLAMA_ECHO_RUN-token runs copied from the prompt
+(as answers quoting the conversation do), which is what prompt-lookup drafting can predict.
+`generate` (only used by draft models here) costs FAKE_LLAMA_DRAFT_MS per token and continues
+with consecutive token ids, so a fake draft model predicts the runs that are not copied.
+
+With `embedding=True`, `embed` returns a hashed bag of words (FAKE_LLAMA_EMBED_DIM wide, mean
+pooled with `pooling_type`, else one row per token), so texts sharing words score as similar;
+it costs the prompt rate per token.
+
+The low-level batch API (llama_decode over several sequences) is modelled on CPU decoding
+being memory-bound: a step that decodes one token for each of N sequences costs
+FAKE_LLAMA_TOKEN_MS * (1 + FAKE_LLAMA_BATCH_COST * (N - 1)).
+"""
+import abc
+import json
+import os
+import random
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+
+LLAMA_DEFAULT_SEED = 0xFFFFFFFF
+LLAMA_POOLING_TYPE_NONE = 0
+LLAMA_POOLING_TYPE_MEAN = 1
+_EOG_TOKEN = 2
+
+
+def _setting(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+class LlamaState:
+    def __init__(self, input_ids: list, n_tokens: int):
+        self.input_ids = list(input_ids)
+        self.n_tokens = n_tokens
+        self.scores = np.zeros((n_tokens, 0), dtype=np.single)
+        self.llama_state_size = 256 * 1024 + 4096 * n_tokens  # roughly proportional to the KV cache
+
+
+class LlamaDraftModel(abc.ABC):
+    @abc.abstractmethod
+    def __call__(self, input_ids, /, **kwargs):
+        raise NotImplementedError()
+
+
+class LlamaPromptLookupDecoding(LlamaDraftModel):
+    """Same matching as llama_cpp.llama_speculative.LlamaPromptLookupDecoding."""
+
+    def __init__(self, max_ngram_size: int = 2, num_pred_tokens: int = 10):
+        self.max_ngram_size = max_ngram_size
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, /, **kwargs):
+        length = input_ids.shape[0]
+        for size in range(min(self.max_ngram_size, length - 1), 0, -1):
+            windows = np.lib.stride_tricks.sliding_window_view(input_ids, (size,))
+            for idx in np.nonzero(np.all(windows == input_ids[-size:], axis=1))[0]:
+                start = idx + size
+                end = min(start + self.num_pred_tokens, length)
+                if start < end:
+                    return input_ids[start:end]
+        return np.array([], dtype=np.intc)
+
+
+class Llama:
+    def __init__(self, model_path: str = "", n_ctx: int = 512, draft_model: LlamaDraftModel = None, **kwargs):
+        self.model_path = model_path
+        self._n_ctx = n_ctx
+        self.draft_model = draft_model
+        self.kwargs = kwargs
+        self.input_ids = []
+        self.n_tokens = 0
+        self.prompt_ms = _setting("FAKE_LLAMA_PROMPT_MS", 0.5)
+        self.token_ms = json.loads(os.getenv("FAKE_LLAMA_MODEL_TOKEN_MS", "{}")).get(
+            os.path.basename(model_path), _setting("FAKE_LLAMA_TOKEN_MS", 20)
+        )
+        self.max_tokens = int(_setting("FAKE_LLAMA_TOKENS", 64))
+        self.batch_cost = _setting("FAKE_LLAMA_BATCH_COST", 0.15)
+        self.verify_cost = _setting("FAKE_LLAMA_VERIFY_COST", 0.05)
+        self.draft_ms = _setting("FAKE_LLAMA_DRAFT_MS", 2)
+        self.echo = _setting("FAKE_LLAMA_ECHO", 0)
+        self.echo_run = int(_setting("FAKE_LLAMA_ECHO_RUN", 12))
+        self.model = self
+        self.context_params = llama_context_default_params()
+        time.sleep(_setting("FAKE_LLAMA_LOAD_S", 0))
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def n_vocab(self) -> int:
+        return 32003
+
+    def n_embd(self) -> int:
+        return int(_setting("FAKE_LLAMA_EMBED_DIM", 4096))
+
+    def embed(self, input, normalize: bool = False, truncate: bool = True, return_count: bool = False):
+        words = [w.strip(".,;:!?\"'()").lower() for w in input.split()][:self._n_ctx if truncate else None]
+        time.sleep(len(words) * self.prompt_ms / 1000)
+        rows = np.zeros((max(len(words), 1), self.n_embd()), dtype=np.float32)
+        for i, word in enumerate(words):
+            crc = zlib.crc32(word.encode("utf-8"))
+            rows[i, crc % rows.shape[1]] = 1.0 if crc & 0x80000000 else -1.0
+        if self.kwargs.get("pooling_type", LLAMA_POOLING_TYPE_NONE) == LLAMA_POOLING_TYPE_NONE:
+            return rows.tolist()
+        return rows.mean(axis=0).tolist()
+
+    def token_eos(self) -> int:
+        return _EOG_TOKEN
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> list:
+        tokens = [zlib.crc32(word) % 32000 + 3 for word in text.split(b" ") if word]
+        return [1] + tokens if add_bos else tokens
+
+    def detokenize(self, tokens: list, prev_tokens: list = None, special: bool = False) -> bytes:
+        return b" w" * len(tokens)
+
+    def save_state(self) -> LlamaState:
+        return LlamaState(self.input_ids, self.n_tokens)
+
+    def load_state(self, state: LlamaState):
+        self.input_ids = list(state.input_ids)
+        self.n_tokens = state.n_tokens
+
+    def reset(self):
+        self.input_ids = []
+        self.n_tokens = 0
+
+    def close(self):
+        pass
+
+    def _evaluate_prompt(self, tokens: list):
+        reused = 0
+        for cached, new in zip(self.input_ids[:self.n_tokens], tokens):
+            if cached != new:
+                break
+            reused += 1
+        time.sleep((len(tokens) - reused) * self.prompt_ms / 1000)
+        self.input_ids = list(tokens)
+        self.n_tokens = len(tokens)
+
+    def _answer(self, prompt: list, count: int) -> list:
+        """The tokens this prompt is answered with, drafting or not."""
+        rng = random.Random(zlib.crc32(repr(prompt).encode()))
+        answer = []
+        while len(answer) < count:
+            if rng.random() < self.echo and len(prompt) > self.echo_run:
+                start = rng.randrange(len(prompt) - self.echo_run)
+                answer.extend(prompt[start:start + self.echo_run])
+            else:
+                answer.extend(range(100 + len(answer), 100 + len(answer) + self.echo_run))
+        return answer[:count]
+
+    def _decode(self, answer: list, produced: int) -> int:
+        """One decode step; returns how many answer tokens it yields."""
+        draft = []
+        if self.draft_model is not None and produced:
+            draft = list(self.draft_model(np.array(self.input_ids, dtype=np.intc)))[:len(answer) - produced - 1]
+        time.sleep(self.token_ms * (1 + self.verify_cost * len(draft)) / 1000)
+        accepted = 0
+        while accepted < len(draft) and draft[accepted] == answer[produced + accepted]:
+            accepted += 1
+        return 1 + accepted
+
+    def generate(self, tokens: list, **kwargs):
+        self._evaluate_prompt(tokens)
+        while True:
+            time.sleep(self.draft_ms / 1000)
+            token = self.input_ids[-1] + 1 if self.input_ids else 3
+            self.input_ids.append(token)
+            self.n_tokens += 1
+            yield token
+
+    def create_completion(self, prompt, max_tokens: int = 16, stream: bool = False, **kwargs):
+        tokens = prompt if isinstance(prompt, list) else self.tokenize(prompt.encode("utf-8"))
+        count = min(max_tokens or self.max_tokens, self.max_tokens)
+
+        def generate():
+            self._evaluate_prompt(tokens)
+            answer = self._answer(tokens, count)
+            i = 0
+            while i < count:
+                for _ in range(self._decode(answer, i)):
+                    self.input_ids.append(answer[i])
+                    self.n_tokens += 1
+                    finish = "length" if i == count - 1 else None
+                    yield {"choices": [{"text": f" tok{answer[i] - 100}", "index": 0, "finish_reason": finish}]}
+                    i += 1
+
+        if stream:
+            return generate()
+        text = "".join(chunk["choices"][0]["text"] for chunk in generate())
+        return {"choices": [{"text": text, "index": 0, "finish_reason": "length"}]}
+
+    __call__ = create_completion
+
+
+# ----- Low-level API (the subset the batch engine uses) -----
+
+class llama_context_params:
+    def __init__(self):
+        self.n_ctx = 512
+        self.n_batch = 512
+        self.n_ubatch = 512
+        self.n_seq_max = 1
+        self.n_threads = 4
+        self.n_threads_batch = 4
+        self.kv_unified = False
+
+
+def llama_context_default_params() -> llama_context_params:
+    return llama_context_params()
+
+
+class _Context:
+    def __init__(self, model: Llama, params: llama_context_params):
+        self.model = model
+        self.params = params
+        self.rows = []  # sequence id of each token in the last decoded batch
+        self.sampled = Counter()  # tokens sampled per sequence since it was last cleared
+
+
+class _Batch:
+    def __init__(self, n_tokens: int):
+        self.n_tokens = 0
+        self.token = [0] * n_tokens
+        self.pos = [0] * n_tokens
+        self.n_seq_id = [0] * n_tokens
+        self.seq_id = [[0] for _ in range(n_tokens)]
+        self.logits = [0] * n_tokens
+
+
+def llama_init_from_model(model: Llama, params: llama_context_params) -> _Context:
+    return _Context(model, params)
+
+
+def llama_free(ctx: _Context):
+    pass
+
+
+def llama_get_memory(ctx: _Context) -> _Context:
+    return ctx
+
+
+def llama_model_get_vocab(model: Llama) -> Llama:
+    return model
+
+
+def llama_batch_init(n_tokens: int, embd: int, n_seq_max: int) -> _Batch:
+    return _Batch(n_tokens)
+
+
+def llama_batch_free(batch: _Batch):
+    pass
+
+
+def llama_decode(ctx: _Context, batch: _Batch) -> int:
+    rows = [batch.seq_id[i][0] for i in range(batch.n_tokens)]
+    if any(seq >= ctx.params.n_seq_max for seq in rows) or batch.n_tokens > ctx.params.n_batch:
+        return -1
+    per_sequence = Counter(rows)
+    generating = sum(1 for count in per_sequence.values() if count == 1)
+    prompt_tokens = batch.n_tokens - generating
+    model = ctx.model
+    cost = prompt_tokens * model.prompt_ms
+    if generating:
+        cost += model.token_ms * (1 + model.batch_cost * (generating - 1))
+    time.sleep(cost / 1000)
+    ctx.rows = rows
+    return 0
+
+
+def llama_memory_seq_rm(mem: _Context, seq_id: int, p0: int, p1: int) -> bool:
+    mem.sampled.pop(seq_id, None)
+    return True
+
+
+def llama_vocab_is_eog(vocab: Llama, token: int) -> bool:
+    return token == _EOG_TOKEN
+
+
+def llama_sampler_chain_default_params():
+    return None
+
+
+def llama_sampler_chain_init(params) -> list:
+    return []
+
+
+def llama_sampler_chain_add(chain: list, sampler):
+    chain.append(sampler)
+
+
+def llama_sampler_init_greedy():
+    return ("greedy",)
+
+
+def llama_sampler_init_top_k(k: int):
+    return ("top_k", k)
+
+
+def llama_sampler_init_top_p(p: float, min_keep: int):
+    return ("top_p", p)
+
+
+def llama_sampler_init_min_p(p: float, min_keep: int):
+    return ("min_p", p)
+
+
+def llama_sampler_init_temp(t: float):
+    return ("temp", t)
+
+
+def llama_sampler_init_dist(seed: int):
+    return ("dist", seed)
+
+
+def llama_sampler_sample(sampler: list, ctx: _Context, idx: int) -> int:
+    seq = ctx.rows[idx]
+    ctx.sampled[seq] += 1
+    return _EOG_TOKEN if ctx.sampled[seq] > ctx.model.max_tokens else 100 + ctx.sampled[seq]
+
+
+def llama_sampler_free(sampler: list):
+    pass
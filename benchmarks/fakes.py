@@ -0,0 +1,159 @@
+"""
+Local stand-ins for the services BridgeAI talks to, and a helper to run any app on a port.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def serve(app, port: int) -> uvicorn.Server:
+    """Run an ASGI app on 127.0.0.1:`port` in a daemon thread; returns once it accepts connections."""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+def make_fake_cerebras(tokens: int, token_delay: float, first_token_delay: float = 0.0,
+                       fail_rate: float = 0.0, seed: int = 0, tokens_per_minute: int = 0) -> FastAPI:
+    """
+    Cerebras-compatible SSE server. A `fail_rate` fraction of streams break halfway with an
+    error event, which exercises the online -> local failover paths. With `tokens_per_minute`,
+    requests past that many tokens (prompt and reply, counted when a request starts) over the
+    last minute get a 429; `app.state.charged` holds (time, tokens) and `app.state.refused` counts 429s.
+    """
+    app = FastAPI()
+    rng = random.Random(seed)
+    app.state.charged = []
+    app.state.refused = 0
+
+    def chunk(model: str, delta: dict, usage: dict = None) -> str:
+        body = {
+            "id": "fake", "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": model, "system_fingerprint": "fp_fake",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}] if delta else [],
+        }
+        if usage:
+            body["usage"] = usage
+        return "data: " + json.dumps(body) + "\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        count = tokens if body.get("stream") else 1
+        fail_at = count // 2 if rng.random() < fail_rate else None
+        prompt_tokens = sum(len(m.get("content", "")) // 4 + 4 for m in body.get("messages", []))
+        if tokens_per_minute:
+            now = time.monotonic()
+            app.state.charged = [(t, n) for t, n in app.state.charged if t > now - 60]
+            if sum(n for _, n in app.state.charged) + prompt_tokens + count > tokens_per_minute:
+                app.state.refused += 1
+                error = {"message": "Tokens per minute limit exceeded", "type": "too_many_tokens_error"}
+                return JSONResponse({"error": error}, status_code=429, headers={"retry-after": "1"})
+            app.state.charged.append((now, prompt_tokens + count))
+
+        async def chunks():
+            await asyncio.sleep(first_token_delay)
+            for i in range(count):
+                if i == fail_at:
+                    yield "data: " + json.dumps({"error": {"message": "fake upstream failure"}}) + "\n\n"
+                    return
+                await asyncio.sleep(token_delay)
+                yield chunk(body["model"], {"role": "assistant", "content": f" tok{i}"})
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": count, "total_tokens": prompt_tokens + count}
+            yield chunk(body["model"], None, usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+    @app.api_route("/v1/{path:path}", methods=["GET", "POST", "HEAD"])
+    async def anything_else(path: str):
+        return {}
+
+    return app
+
+
+def make_fake_backend(tokens: int, token_delay: float) -> FastAPI:
+    """
+    Backend `/api/local/stream` that streams `tokens` offline frames, one per `token_delay`, and
+    the session history endpoints. A `query` turn is checked against its `revision` (409) and
+    recorded like the real backend does; `app.state.sessions` maps session id to
+    {"revision", "generation", "messages"}. With `app.state.busy`, streams answer like a replica
+    whose queue is full: an in-stream error event with content, and no text.
+    """
+    app = FastAPI()
+    app.state.sessions = {}
+    app.state.busy = False
+
+    def session(session_id: str) -> dict:
+        return app.state.sessions.setdefault(session_id, {"revision": 0, "generation": 0, "messages": []})
+
+    def state(entry: dict) -> dict:
+        return {"revision": entry["revision"], "generation": entry["generation"], "length": len(entry["messages"])}
+
+    def append(session_id: str, messages: list):
+        entry = session(session_id)
+        entry["messages"].extend(messages)
+        entry["revision"] += len(messages)
+        return state(entry)
+
+    @app.post("/api/local/stream")
+    async def local_stream(body: dict):
+        query = body.get("query")
+        if query is not None and body.get("revision") is not None:
+            entry = session(body["session_id"])
+            if body["revision"] != entry["revision"]:
+                return JSONResponse({"detail": {"message": "stale", **state(entry)}}, status_code=409)
+
+        async def frames():
+            if app.state.busy:
+                yield f"data: {json.dumps({'error': 'queue_full', 'content': 'The local model is busy.'})}\n\n"
+                yield f"data: {json.dumps({'done': True})}\n\n"
+                return
+            for i in range(tokens):
+                await asyncio.sleep(token_delay)
+                yield f"data: {json.dumps({'content': f' tok{i}', 'source': 'offline'})}\n\n"
+            yield f"data: {json.dumps({'done': True})}\n\n"
+            if query is not None:
+                answer = "".join(f" tok{i}" for i in range(tokens)).strip()
+                turn = [{"role": "user", "content": query}, {"role": "assistant", "content": answer}]
+                new = append(body["session_id"], turn)
+                yield f"data: {json.dumps({'revision': new['revision'], 'generation': new['generation']})}\n\n"
+        return StreamingResponse(frames(), media_type="text/event-stream")
+
+    @app.get("/api/sessions/{session_id}/history")
+    async def history(session_id: str, revision: int = None, generation: int = None):
+        entry = session(session_id)
+        missing = entry["revision"] - revision if revision is not None else -1
+        if generation == entry["generation"] and 0 <= missing <= len(entry["messages"]):
+            messages = entry["messages"][len(entry["messages"]) - missing:]
+            return {**state(entry), "reset": False, "messages": messages}
+        return {**state(entry), "reset": True, "messages": entry["messages"]}
+
+    @app.put("/api/sessions/{session_id}/history")
+    async def replace_history(session_id: str, body: dict):
+        messages = body["messages"]
+        revision = body.get("revision")
+        app.state.sessions[session_id] = {
+            "revision": len(messages) if revision is None else revision,
+            "generation": body.get("generation") or random.getrandbits(52),
+            "messages": list(messages),
+        }
+        return state(app.state.sessions[session_id])
+
+    @app.post("/api/sessions/{session_id}/turns")
+    async def record_turn(session_id: str, body: dict):
+        return append(session_id, body["messages"])
+
+    @app.get("/readyz")
+    async def ready():
+        return {"ready": True}
+
+    return app
@@ -0,0 +1,175 @@
+"""
+Gateway backend pool: local-model throughput across several backend replicas, session affinity,
+and failover when a replica dies mid-run.
+
+Each replica is the real backend on the fake `llama_cpp` (see fake_modules) in its own process,
+so replicas decode in parallel as separate machines would. The gateway (in-process, pinned to
+local routing) balances `--sessions` conversations of `--turns` turns each, first over one
+replica and then over `--replicas`. In the second run one replica is killed halfway through;
+the answers it was streaming fail, its other sessions move to the remaining replicas (seeded
+from the gateway's messages), and it is ejected. Exits non-zero if any other answer fails or
+the speedup is below --min-speedup.
+
+    python benchmarks/gateway_pool.py --replicas 3 --sessions 8 --turns 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fakes import serve
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BACKEND_PORT = 18700  # replica i listens on BACKEND_PORT + i
+GATEWAY_PORT = 18780
+
+
+def serve_backend(args):
+    """Child process: one backend replica on port args.serve until killed."""
+    os.environ.update({
+        "FAKE_LLAMA_PROMPT_MS": str(args.prompt_ms),
+        "FAKE_LLAMA_TOKEN_MS": str(args.token_ms),
+        "FAKE_LLAMA_TOKENS": str(args.tokens),
+        "CEREBRAS_API_KEY": "",
+    })
+    sys.path[:0] = [os.path.join(HERE, "fake_modules"), os.path.join(ROOT, "backend"), ROOT]
+    os.chdir(tempfile.mkdtemp(prefix="bridgeai-replica-"))
+
+    from app.main import app
+
+    serve(app, args.serve)
+    while True:
+        time.sleep(3600)
+
+
+def start_replicas(count: int, offset: int) -> list:
+    ports = [BACKEND_PORT + offset + i for i in range(count)]
+    processes = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(port)] + sys.argv[1:])
+        for port in ports
+    ]
+    for port in ports:
+        while True:
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/readyz").status_code == 200:
+                    break
+            except httpx.TransportError:
+                pass
+            time.sleep(0.05)
+    return processes
+
+
+async def conversation(client: httpx.AsyncClient, session: str, turns: int, outcomes: list):
+    messages = []
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"{session} turn {turn}: what did we say so far?"})
+        payload = {"messages": messages, "session_id": session, "no_cache": True}
+        text, error = "", None
+        async with client.stream("POST", f"http://127.0.0.1:{GATEWAY_PORT}/chat", json=payload) as response:
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    data = json.loads(line[6:])
+                    text += data.get("content", "") if not data.get("error") else ""
+                    error = error or data.get("error")
+        outcomes.append(bool(text) and error is None)
+        messages.append({"role": "assistant", "content": text.strip()})
+
+
+async def run(pool, args, replicas: int, kill=None) -> dict:
+    pool.update([f"http://127.0.0.1:{BACKEND_PORT + i}" for i in range(replicas)])
+    before = pool.stats()
+
+    outcomes = []
+    in_flight = 0
+    async with httpx.AsyncClient(timeout=600.0) as client:
+        start = time.perf_counter()
+        tasks = [
+            asyncio.create_task(conversation(client, f"r{replicas}-s{i}", args.turns, outcomes))
+            for i in range(args.sessions)
+        ]
+        if kill is not None:
+            while len(outcomes) < args.sessions * args.turns // 2:
+                await asyncio.sleep(0.01)
+            in_flight = pool.replicas[f"http://127.0.0.1:{BACKEND_PORT + replicas - 1}"].outstanding
+            kill.kill()
+        await asyncio.gather(*tasks)
+        seconds = time.perf_counter() - start
+
+    stats = pool.stats()
+    earlier = {r["url"]: r for r in before["replicas"]}
+
+    def delta(replica: dict, key: str) -> int:
+        return replica[key] - earlier.get(replica["url"], {}).get(key, 0)
+
+    return {
+        "replicas": replicas,
+        "seconds": round(seconds, 3),
+        "tokens_per_s": round(len(outcomes) * args.tokens / seconds, 1),
+        "answered": sum(outcomes),
+        "failed": len(outcomes) - sum(outcomes),
+        "in_flight_on_killed_replica": in_flight,
+        "requests_per_replica": [delta(r, "requests") for r in stats["replicas"]],
+        "ejections": sum(delta(r, "ejections") for r in stats["replicas"]),
+        "affinity": {key: value - before["affinity"][key] for key, value in stats["affinity"].items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--sessions", type=int, default=8, help="at most MAX_QUEUE_DEPTH + 1 for the single run")
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--tokens", type=int, default=32, help="tokens per answer")
+    parser.add_argument("--prompt-ms", type=float, default=0.5)
+    parser.add_argument("--token-ms", type=float, default=10.0)
+    parser.add_argument("--min-speedup", type=float, default=1.8)
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve_backend(args)
+        return
+
+    os.environ.update({
+        "LOCAL_MODEL_URLS": f"http://127.0.0.1:{BACKEND_PORT}",
+        "NETWORK_PROBE_INTERVAL": "0",
+        "BACKEND_HEALTH_INTERVAL": "0.5",
+        "BACKEND_EJECT_FAILURES": "1",
+    })
+    sys.path[:0] = [os.path.join(ROOT, "mcp-gateway"), ROOT]
+    import gateway
+
+    # Pin routing to the local model without probing the internet
+    gateway.network_status = gateway.NetworkStatus(online=False, cerebras_available=False, last_check="pinned")
+    serve(gateway.app, GATEWAY_PORT)
+
+    processes = start_replicas(args.replicas, 0)
+    try:
+        single = asyncio.run(run(gateway.backend_pool, args, 1))
+        pooled = asyncio.run(run(gateway.backend_pool, args, args.replicas, kill=processes[-1]))
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+    report = {
+        "sessions": args.sessions,
+        "turns": args.turns,
+        "single": single,
+        "pool": pooled,
+        "speedup": round(single["seconds"] / pooled["seconds"], 2),
+    }
+    print(json.dumps(report, indent=2))
+    failed = single["failed"] + pooled["failed"] - pooled["in_flight_on_killed_replica"]
+    if failed > 0 or report["speedup"] < args.min_speedup:
+        sys.exit(f"Backend pool check failed (speedup {report['speedup']}, {failed} unexpected failures)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Gateway pass-through benchmark: time-to-first-token through the MCP gateway vs. straight from the backend.
+
+A fake backend streams SSE frames with a fixed per-token delay; the gateway (in-process, forced into
+offline routing) proxies it. With true incremental proxying the two TTFTs differ by a few ms. Then the
+backend refuses one request in-stream (queue full): the gateway must record no first token for it and
+must not count it as a successful stream of that replica.
+
+    python benchmarks/gateway_ttft.py --requests 20 --tokens 50 --token-delay 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+from fakes import make_fake_backend, serve
+
+BACKEND_PORT = 18000
+GATEWAY_PORT = 18080
+
+
+async def measure(client: httpx.AsyncClient, url: str, payload: dict) -> dict:
+    start = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", url, json=payload) as response:
+        async for line in response.aiter_lines():
+            if ttft is None and '"content"' in line:
+                ttft = time.perf_counter() - start
+    return {"ttft": ttft, "total": time.perf_counter() - start}
+
+
+async def run(args):
+    payload = {"messages": [{"role": "user", "content": "hello"}], "session_id": "bench", "no_cache": True}
+    results = {}
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        for name, url in (
+            ("backend", f"http://127.0.0.1:{BACKEND_PORT}/api/local/stream"),
+            ("gateway", f"http://127.0.0.1:{GATEWAY_PORT}/chat"),
+        ):
+            samples = [await measure(client, url, payload) for _ in range(args.requests)]
+            ttfts = sorted(s["ttft"] * 1000 for s in samples)
+            results[name] = {
+                "ttft_ms_p50": round(statistics.median(ttfts), 2),
+                "ttft_ms_max": round(ttfts[-1], 2),
+                "total_ms_p50": round(statistics.median(s["total"] * 1000 for s in samples), 2),
+            }
+    results["gateway_overhead_ms_p50"] = round(
+        results["gateway"]["ttft_ms_p50"] - results["backend"]["ttft_ms_p50"], 2
+    )
+    return results
+
+
+def refusal(gateway, backend) -> dict:
+    """First tokens and ok streams the gateway records for one request the backend refuses in-stream."""
+    replica = f"http://127.0.0.1:{BACKEND_PORT}"
+
+    def counts():
+        return sum(gateway.streams.ttft.labels("local").counts), gateway.backend_pool.requests.labels(replica, "ok").value
+
+    before = counts()
+    backend.state.busy = True
+    payload = {"messages": [{"role": "user", "content": "are you busy?"}], "session_id": "bench", "no_cache": True}
+    with httpx.Client(timeout=60.0) as client:
+        body = client.post(f"http://127.0.0.1:{GATEWAY_PORT}/chat", json=payload).text
+    backend.state.busy = False
+    after = counts()
+    return {"refused": "queue_full" in body, "first_tokens": after[0] - before[0], "ok_streams": after[1] - before[1]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--token-delay", type=float, default=0.05)
+    parser.add_argument("--max-overhead-ms", type=float, default=20.0)
+    args = parser.parse_args()
+
+    os.environ["LOCAL_MODEL_URL"] = f"http://127.0.0.1:{BACKEND_PORT}"
+    os.environ["NETWORK_PROBE_INTERVAL"] = "0"
+    os.environ["RATE_LIMIT_SESSION_REQUESTS"] = "0"  # every request comes from one session
+    root = os.path.join(os.path.dirname(__file__), "..")
+    sys.path[:0] = [os.path.join(root, "mcp-gateway"), root]
+    import gateway
+
+    # Pin routing to the local model without probing the internet
+    gateway.network_status = gateway.NetworkStatus(online=False, cerebras_available=False, last_check="pinned")
+
+    backend = make_fake_backend(args.tokens, args.token_delay)
+    serve(backend, BACKEND_PORT)
+    serve(gateway.app, GATEWAY_PORT)
+
+    results = asyncio.run(run(args))
+    results["refusal"] = refusal(gateway, backend)
+    print(json.dumps(results, indent=2))
+    if results["gateway_overhead_ms_p50"] > args.max_overhead_ms:
+        sys.exit(f"Gateway adds {results['gateway_overhead_ms_p50']} ms to TTFT (limit {args.max_overhead_ms} ms)")
+    if not results["refusal"]["refused"] or results["refusal"]["first_tokens"] or results["refusal"]["ok_streams"]:
+        sys.exit(f"An in-stream refusal was counted as generated text: {results['refusal']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+End-to-end load test of the backend and gateway SSE paths against local stand-ins.
+
+Starts, in-process: a fake Cerebras server, the backend on a fake `llama_cpp` (see
+fake_modules/llama_cpp.py), and the gateway pointed at both. Each scenario sends `--requests`
+streamed chats at `--concurrency` and reports TTFT, inter-token and total latency percentiles,
+throughput, frames and bytes per answer, and error/fallback rates as JSON. With `--baseline`, results are compared against a
+stored run and the script exits non-zero on any regression beyond `--tolerance`.
+
+    python benchmarks/load_test.py --concurrency 4 --requests 40 --baseline benchmarks/baseline.json
+    python benchmarks/load_test.py --update-baseline benchmarks/baseline.json
+
+Scenarios:
+    offline  POST /api/chat            online=false  (local model)
+    online   POST /api/chat            online=true   (Cerebras, with fallback)
+    local    POST /api/local/stream                  (what the gateway calls)
+    gateway  POST gateway /chat                      (routed to Cerebras, or local with --gateway-route local)
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fakes import make_fake_cerebras, serve
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+CEREBRAS_PORT = 18300
+BACKEND_PORT = 18200
+GATEWAY_PORT = 18280
+
+SCENARIOS = ("offline", "online", "local", "gateway")
+
+# metric path -> (direction, absolute slack). "higher" means larger values are regressions.
+CHECKS = {
+    "ttft_ms.p50": ("higher", 5.0),
+    "ttft_ms.p95": ("higher", 10.0),
+    "inter_token_ms.p50": ("higher", 2.0),
+    "frames_per_answer": ("higher", 1.0),
+    "bytes_per_answer": ("higher", 64.0),
+    "total_ms.p50": ("higher", 10.0),
+    "total_ms.p95": ("higher", 20.0),
+    "throughput_rps": ("lower", 0.0),
+    "error_rate": ("higher", 0.01),
+    "fallback_rate": ("higher", 0.01),
+}
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def at(q: float) -> float:
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 2)
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99), "max": round(ordered[-1], 2)}
+
+
+def request_for(scenario: str, index: int, compact: bool = False) -> tuple:
+    session_id = f"load-{scenario}-{index}"
+    query = f"Question {index}: explain how a hybrid online/offline assistant stays responsive."
+    messages = [{"role": "user", "content": query}]
+    common = {"session_id": session_id, "no_cache": True, "compact": compact}
+    if scenario == "offline":
+        return f"http://127.0.0.1:{BACKEND_PORT}/api/chat", {**common, "query": query}
+    if scenario == "online":
+        return f"http://127.0.0.1:{BACKEND_PORT}/api/chat", {**common, "query": query, "online": True}
+    if scenario == "local":
+        return f"http://127.0.0.1:{BACKEND_PORT}/api/local/stream", {**common, "messages": messages}
+    return f"http://127.0.0.1:{GATEWAY_PORT}/chat", {**common, "messages": messages}
+
+
+async def one_request(client: httpx.AsyncClient, url: str, payload: dict) -> dict:
+    start = time.perf_counter()
+    token_times = []
+    received = 0
+    result = {"error": False, "fallback": False}
+    try:
+        async with client.stream("POST", url, json=payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                result["error"] = True
+            else:
+                async for line in response.aiter_lines():
+                    received += len(line) + 1
+                    if not line.startswith("data: "):
+                        continue
+                    frame = json.loads(line[6:])
+                    if isinstance(frame, str):
+                        # Compact framing: a text frame is a bare string
+                        frame = {"content": frame}
+                    if frame.get("error"):
+                        result["error"] = True
+                    if frame.get("fallback"):
+                        result["fallback"] = True
+                    if frame.get("content"):
+                        token_times.append(time.perf_counter())
+    except httpx.HTTPError:
+        result["error"] = True
+    end = time.perf_counter()
+
+    result["total"] = end - start
+    result["frames"] = len(token_times)
+    result["bytes"] = received
+    result["ttft"] = token_times[0] - start if token_times else None
+    result["gaps"] = [b - a for a, b in zip(token_times, token_times[1:])]
+    if not token_times:
+        result["error"] = True
+    return result
+
+
+async def run_scenario(scenario: str, args) -> dict:
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def bounded(client, index):
+        async with semaphore:
+            return await one_request(client, *request_for(scenario, index, args.compact))
+
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        # One warm-up request so connection setup and lazy clients don't skew the first samples
+        await one_request(client, *request_for(scenario, -1, args.compact))
+        start = time.perf_counter()
+        samples = await asyncio.gather(*(bounded(client, i) for i in range(args.requests)))
+        wall = time.perf_counter() - start
+
+    ok = [s for s in samples if not s["error"]]
+    frames = sum(s["frames"] for s in samples)
+    return {
+        "requests": len(samples),
+        "ttft_ms": percentiles([s["ttft"] * 1000 for s in ok if s["ttft"] is not None]),
+        "inter_token_ms": percentiles([g * 1000 for s in ok for g in s["gaps"]]),
+        "total_ms": percentiles([s["total"] * 1000 for s in ok]),
+        "throughput_rps": round(len(ok) / wall, 3),
+        "frames_per_s": round(frames / wall, 1),
+        "frames_per_answer": round(sum(s["frames"] for s in ok) / len(ok), 1) if ok else None,
+        "bytes_per_answer": round(sum(s["bytes"] for s in ok) / len(ok)) if ok else None,
+        "error_rate": round(1 - len(ok) / len(samples), 4),
+        "fallback_rate": round(sum(s["fallback"] for s in samples) / len(samples), 4),
+        "wall_s": round(wall, 3),
+    }
+
+
+def lookup(results: dict, path: str):
+    value = results
+    for part in path.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Human-readable regressions of `results` against `baseline`."""
+    regressions = []
+    for scenario, base in baseline["results"].items():
+        current = results.get(scenario)
+        if current is None:
+            continue
+        for path, (direction, slack) in CHECKS.items():
+            old, new = lookup(base, path), lookup(current, path)
+            if old is None or new is None:
+                continue
+            if direction == "higher":
+                limit = old * (1 + tolerance) + slack
+                failed = new > limit
+            else:
+                limit = old * (1 - tolerance) - slack
+                failed = new < limit
+            if failed:
+                regressions.append(f"{scenario}.{path}: {new} (baseline {old}, limit {round(limit, 3)})")
+    return regressions
+
+
+def start_services(args):
+    """Configure the stand-ins via environment, then import and serve the real backend and gateway."""
+    os.environ.update({
+        "FAKE_LLAMA_PROMPT_MS": str(args.prompt_ms),
+        "FAKE_LLAMA_TOKEN_MS": str(args.token_ms),
+        "FAKE_LLAMA_TOKENS": str(args.tokens),
+        "CEREBRAS_API_KEY": "fake-key",
+        "CEREBRAS_BASE_URL": f"http://127.0.0.1:{CEREBRAS_PORT}",
+        "LOCAL_MODEL_URL": f"http://127.0.0.1:{BACKEND_PORT}",
+        "NETWORK_PROBE_INTERVAL": "0",
+        # Measure serving, not admission (see rate_limits.py)
+        "RATE_LIMIT_SESSION_REQUESTS": "0",
+        "RATE_LIMIT_GLOBAL_REQUESTS": "0",
+        "CEREBRAS_TOKENS_PER_MINUTE": "0",
+    })
+    sys.path[:0] = [
+        os.path.join(HERE, "fake_modules"), os.path.join(ROOT, "backend"), os.path.join(ROOT, "mcp-gateway"), ROOT
+    ]
+    # Usage logs and other relative paths land in a scratch directory, not the repo
+    os.chdir(tempfile.mkdtemp(prefix="bridgeai-load-"))
+
+    from app.main import app as backend_app
+    import gateway
+
+    online = args.gateway_route == "online"
+    gateway.network_status = gateway.NetworkStatus(online=online, cerebras_available=online, last_check="pinned")
+
+    serve(make_fake_cerebras(args.tokens, args.cerebras_token_ms / 1000, args.cerebras_ttft_ms / 1000,
+                             fail_rate=args.cerebras_fail_rate), CEREBRAS_PORT)
+    serve(backend_app, BACKEND_PORT)
+    serve(gateway.app, GATEWAY_PORT)
+
+    # The local model loads in the background after startup
+    while httpx.get(f"http://127.0.0.1:{BACKEND_PORT}/readyz").status_code != 200:
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=40, help="per scenario")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--tokens", type=int, default=32, help="tokens per answer (both models)")
+    parser.add_argument("--prompt-ms", type=float, default=0.5, help="fake llama prompt eval, per uncached token")
+    parser.add_argument("--token-ms", type=float, default=10.0, help="fake llama time per generated token")
+    parser.add_argument("--cerebras-ttft-ms", type=float, default=50.0)
+    parser.add_argument("--cerebras-token-ms", type=float, default=2.0)
+    parser.add_argument("--cerebras-fail-rate", type=float, default=0.0)
+    parser.add_argument("--gateway-route", choices=("online", "local"), default="online")
+    parser.add_argument("--compact", action="store_true", help="request compact SSE framing")
+    parser.add_argument("--output", help="write results JSON here as well as to stdout")
+    parser.add_argument("--baseline", help="compare against this baseline JSON")
+    parser.add_argument("--update-baseline", metavar="PATH", help="write this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    for option in ("output", "baseline", "update_baseline"):
+        if getattr(args, option):
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+
+    config = {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "update_baseline", "tolerance")}
+    # Keep stdout for the JSON report; service startup banners go to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        start_services(args)
+
+    results = {scenario: asyncio.run(run_scenario(scenario, args)) for scenario in scenarios}
+    report = {"config": config, "results": results}
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.update_baseline:
+        with open(args.update_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        differing = {k for k in ("concurrency", "requests", "tokens", "prompt_ms", "token_ms", "cerebras_ttft_ms",
+                                 "cerebras_token_ms", "cerebras_fail_rate", "gateway_route", "compact")
+                     if baseline["config"].get(k) != config.get(k)}
+        if differing:
+            print(f"warning: run config differs from the baseline in {', '.join(sorted(differing))}", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit("Regressions against baseline:\n  " + "\n  ".join(regressions))
+        print("No regressions against baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
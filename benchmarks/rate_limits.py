@@ -0,0 +1,147 @@
+"""
+Gateway admission: per-session rate limits, and Cerebras quota admission against a fake
+Cerebras that enforces a tokens-per-minute quota with 429s.
+
+Flood: one session sends `--flood` requests back to back; past its per-minute allowance
+(`--session-requests`) the gateway answers 429 with Retry-After, while another session is still
+served. Quota: `--requests` single-turn chats from distinct sessions, at `--concurrency`, against a
+quota of `--quota` tokens per minute, first without quota admission (overflow hits 429s, retries
+and fallbacks, and opens the circuit breaker) and then with it (overflow goes to the local model
+up front). Exits non-zero if the flood is not limited as configured, or if with admission Cerebras
+refused any request or no request was answered online.
+
+    python benchmarks/rate_limits.py --requests 40 --quota 3000
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+from fakes import make_fake_backend, make_fake_cerebras, serve
+
+CEREBRAS_PORT = 18900
+BACKEND_PORT = 18910
+GATEWAY_PORT = 18980
+
+
+async def chat(client: httpx.AsyncClient, session: str, text: str) -> dict:
+    payload = {"messages": [{"role": "user", "content": text}], "session_id": session, "no_cache": True}
+    start = time.perf_counter()
+    sources, fallback = set(), False
+    async with client.stream("POST", f"http://127.0.0.1:{GATEWAY_PORT}/chat", json=payload) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return {"status": response.status_code, "retry_after": response.headers.get("retry-after")}
+        async for line in response.aiter_lines():
+            if line.startswith("data: "):
+                data = json.loads(line[6:])
+                fallback = fallback or bool(data.get("fallback"))
+                if data.get("content") and data.get("source"):
+                    sources.add(data["source"])
+    route = "fallback" if fallback else "online" if sources == {"online"} else "local"
+    return {"status": 200, "route": route, "seconds": time.perf_counter() - start}
+
+
+async def flood(args) -> dict:
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        results = [await chat(client, "flooder", f"flood {i}") for i in range(args.flood)]
+        bystander = await chat(client, "bystander", "am I still served?")
+    refused = [r for r in results if r["status"] == 429]
+    return {
+        "sent": len(results),
+        "served": sum(1 for r in results if r["status"] == 200),
+        "refused": len(refused),
+        "refused_with_retry_after": sum(1 for r in refused if r["retry_after"]),
+        "bystander_served": bystander["status"] == 200,
+    }
+
+
+async def quota_run(gateway, fake, args, admission: bool) -> dict:
+    fake.state.charged.clear()
+    fake.state.refused = 0
+    gateway.cerebras_breaker = gateway.CircuitBreaker(failure_threshold=3, base_backoff=5.0, max_backoff=300.0)
+    gateway.cerebras_budget = gateway.TokenBudget(
+        args.quota if admission else 0, gateway.CEREBRAS_HEADROOM, reply_tokens=gateway.CEREBRAS_MAX_TOKENS / 4
+    )
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(i: int) -> dict:
+        async with semaphore:
+            return await chat(client, f"quota-{admission}-{i}", f"question number {i}, please answer briefly")
+
+    async with httpx.AsyncClient(timeout=120.0) as client:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one(i) for i in range(args.requests)))
+        seconds = time.perf_counter() - start
+
+    latencies = sorted(r["seconds"] for r in results if r["status"] == 200)
+    return {
+        "admission": admission,
+        "seconds": round(seconds, 2),
+        "online": sum(1 for r in results if r.get("route") == "online"),
+        "local": sum(1 for r in results if r.get("route") == "local"),
+        "fallback": sum(1 for r in results if r.get("route") == "fallback"),
+        "cerebras_429s": fake.state.refused,
+        "cerebras_tokens": sum(n for _, n in fake.state.charged),
+        "latency_s_p50": round(statistics.median(latencies), 3) if latencies else None,
+        "latency_s_max": round(latencies[-1], 3) if latencies else None,
+        "admissions": gateway.cerebras_budget.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--flood", type=int, default=20, help="back-to-back requests from one session")
+    parser.add_argument("--session-requests", type=int, default=5, help="per-session requests per minute")
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--quota", type=int, default=3000, help="fake Cerebras tokens per minute")
+    parser.add_argument("--tokens", type=int, default=32, help="tokens per answer")
+    parser.add_argument("--token-delay", type=float, default=0.005)
+    args = parser.parse_args()
+
+    os.environ.update({
+        "CEREBRAS_API_KEY": "fake-key",
+        "CEREBRAS_BASE_URL": f"http://127.0.0.1:{CEREBRAS_PORT}",
+        "LOCAL_MODEL_URL": f"http://127.0.0.1:{BACKEND_PORT}",
+        "NETWORK_PROBE_INTERVAL": "0",
+        "RATE_LIMIT_SESSION_REQUESTS": str(args.session_requests),
+    })
+    root = os.path.join(os.path.dirname(__file__), "..")
+    sys.path[:0] = [os.path.join(root, "mcp-gateway"), root]
+    import gateway
+
+    fake = make_fake_cerebras(args.tokens, args.token_delay, tokens_per_minute=args.quota)
+    serve(fake, CEREBRAS_PORT)
+    serve(make_fake_backend(args.tokens, args.token_delay), BACKEND_PORT)
+    serve(gateway.app, GATEWAY_PORT)
+
+    # The flood runs on the local route, so it leaves the Cerebras quota alone
+    gateway.network_status = gateway.NetworkStatus(online=False, cerebras_available=False, last_check="pinned")
+    flooded = asyncio.run(flood(args))
+    gateway.network_status = gateway.NetworkStatus(online=True, cerebras_available=True, last_check="pinned")
+    without = asyncio.run(quota_run(gateway, fake, args, admission=False))
+    time.sleep(61)  # let the fake's quota minute pass
+    with_admission = asyncio.run(quota_run(gateway, fake, args, admission=True))
+
+    report = {"flood": flooded, "quota": {"without_admission": without, "with_admission": with_admission}}
+    print(json.dumps(report, indent=2))
+    problems = []
+    if flooded["served"] != args.session_requests or flooded["refused_with_retry_after"] != flooded["refused"]:
+        problems.append("flood was not limited to the session allowance with Retry-After")
+    if not flooded["bystander_served"]:
+        problems.append("another session was refused during the flood")
+    if with_admission["cerebras_429s"] or with_admission["fallback"] or not with_admission["online"]:
+        problems.append("quota admission did not keep Cerebras under its quota")
+    if problems:
+        sys.exit("Rate limit check failed: " + "; ".join(problems))
+
+
+if __name__ == "__main__":
+    main()
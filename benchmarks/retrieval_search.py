@@ -0,0 +1,241 @@
+"""
+Retrieval over past answers: search latency and accuracy of the index at --entries pairs, and
+past answers reaching offline prompts through the real backend.
+
+Index: pairs get synthetic `--model-dim` embeddings (a random vector per pair; queries are
+that vector plus noise of relative size `--noise`), projected to the index's dimension like
+model embeddings are. Reports search latency (embedding excluded) and how often each query's top
+result is its own pair, next to the same for an exact scan of every row. The search latency is
+also measured while the background worker compacts away a third of the rows, and the index
+is reopened to check it persisted.
+
+Backend: the real backend on the fake `llama_cpp` (see fake_modules), whose embeddings are
+hashed bags of words. --pairs online turns are recorded as the gateway would, and a new
+session then asks each question reworded; the request traces must show past answers in the
+offline prompts. Exits non-zero if the median search takes longer than --max-search-ms, or
+fewer than --min-recall of queries find their pair.
+
+    python benchmarks/retrieval_search.py --entries 100000
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+from fakes import serve
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BACKEND_PORT = 18700
+BASE = f"http://127.0.0.1:{BACKEND_PORT}/api"
+SYNC_TOKEN = "benchmark-sync-token"  # the backend's SESSION_SYNC_TOKEN, as the gateway would send it
+ADMIN_TOKEN = "benchmark-admin-token"  # for the trace endpoints
+_PAIR = re.compile(r"pair (\d+)")
+
+TOPICS = [
+    "purify drinking water", "treat a minor burn", "splint a broken finger", "store rice for years",
+    "charge a phone with a solar panel", "read a topographic map", "start a fire in wet weather",
+    "keep bees in a small garden", "fix a bicycle puncture", "grow tomatoes in containers",
+    "tie a bowline knot", "preserve fish with salt", "build a rain barrel", "recognize heat stroke",
+    "sharpen a kitchen knife", "make yogurt without a machine", "find north without a compass",
+    "test soil acidity", "patch a leaking roof", "calculate compound interest",
+]
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 3) if values else 0.0
+
+
+def pair_embedder(model_dim: int):
+    """Embedder for synthetic pairs: the random vector of the pair named in the text."""
+    def embed(text: str):
+        return np.random.default_rng(int(_PAIR.search(text).group(1))).standard_normal(model_dim)
+    return embed
+
+
+def timed_searches(index, queries: list) -> list:
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        index.nearest(query)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def index_benchmark(args) -> dict:
+    from app.services.retrieval import AnswerIndex
+
+    path = tempfile.mkdtemp(prefix="bridgeai-retrieval-")
+    sessions = 90
+    index = AnswerIndex(path, dim=args.dim, min_score=0.0, coarse_dim=args.coarse_dim, candidates=args.candidates,
+                        max_pending=args.entries)
+    index.register_embedder("synthetic", pair_embedder(args.model_dim), args.model_dim)
+
+    started = time.perf_counter()
+    for i in range(args.entries):
+        index.add(f"s{i % sessions}", f"question about pair {i}", f"answer about pair {i}", "online")
+    while index.stats()["appended"] < args.entries:
+        time.sleep(0.05)
+    indexing = time.perf_counter() - started
+
+    # Noisy queries for random pairs; exact top-k over every row's full vector for comparison
+    rng = np.random.default_rng(1)
+    targets = rng.choice(args.entries, args.queries, replace=False)
+    embed = pair_embedder(args.model_dim)
+    queries = []
+    for target in targets:
+        vector = embed(f"pair {target}")
+        noise = rng.standard_normal(args.model_dim) * args.noise * np.linalg.norm(vector) / args.model_dim ** 0.5
+        vector = vector + noise
+        if index._projection is not None:
+            vector = vector @ index._projection
+        queries.append((vector / np.linalg.norm(vector)).astype(np.float32))
+    latencies = timed_searches(index, queries)
+
+    found = exact_found = 0
+    matrix = np.asarray(index._vectors[:index._count])
+    for target, query in zip(targets, queries):
+        results = index.nearest(query)
+        found += _PAIR.search(results[0]["question"]).group(1) == str(target) if results else 0
+        exact_found += int(np.argmax(matrix @ query)) == target  # rows are in insertion order here
+
+    # Forget a third of the sessions: the worker compacts while searches go on
+    compactions = index.stats()["compactions"]
+    for i in range(sessions // 3):
+        index.forget(f"s{i}")
+    during = []
+    while index.stats()["compactions"] == compactions:
+        during += timed_searches(index, queries[:10])
+    stats = index.stats()
+    index.close()
+
+    reopened = AnswerIndex(path, dim=args.dim, min_score=0.0)
+    reopened.register_embedder("synthetic", pair_embedder(args.model_dim), args.model_dim)
+    kept = reopened.stats()["entries"]
+    reopened.close()
+    shutil.rmtree(path)
+    return {
+        "entries": args.entries,
+        "dim": args.dim,
+        "model_dim": args.model_dim,
+        "indexing_seconds": round(indexing, 2),
+        "search_ms": {"p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99)},
+        "search_ms_during_compaction": {"p50": percentile(during, 0.5), "p99": percentile(during, 0.99),
+                                        "searches": len(during)},
+        "top1_recall": round(found / len(targets), 4),
+        "exact_scan_top1_recall": round(exact_found / len(targets), 4),
+        "compaction_seconds": stats["last_compaction_seconds"],
+        "entries_after_compaction": stats["entries"],
+        "entries_after_reopen": kept,
+    }
+
+
+def trace_spans(client: httpx.Client, trace_id: str) -> list:
+    """Spans of a finished request; the trace is stored just after the last byte of the response."""
+    while True:
+        response = client.get(f"{BASE}/debug/traces/{trace_id}", headers={"Authorization": f"Bearer {ADMIN_TOKEN}"})
+        if response.status_code != 404:
+            return response.json()["traces"][0]["spans"]
+        time.sleep(0.01)
+
+
+def backend_benchmark(args) -> dict:
+    os.environ.update({
+        "FAKE_LLAMA_PROMPT_MS": "0.1",
+        "FAKE_LLAMA_TOKEN_MS": "2",
+        "FAKE_LLAMA_TOKENS": "16",
+        "CEREBRAS_API_KEY": "",
+        "RETRIEVAL_ENABLED": "true",
+        "RETRIEVAL_SHARED": "true",  # the questions are asked from new sessions
+        "RETRIEVAL_PATH": tempfile.mkdtemp(prefix="bridgeai-retrieval-"),
+        # Bag-of-words similarity between a short question and a long pair is low; model embeddings need their own
+        "RETRIEVAL_MIN_SCORE": "0.1",
+        "RATE_LIMIT_SESSION_REQUESTS": "0",
+        "RATE_LIMIT_GLOBAL_REQUESTS": "0",
+        "SESSION_SYNC_TOKEN": SYNC_TOKEN,
+        "ADMIN_TOKEN": ADMIN_TOKEN,
+    })
+    os.chdir(tempfile.mkdtemp(prefix="bridgeai-retrieval-backend-"))
+
+    from app.main import app
+
+    serve(app, BACKEND_PORT)
+    with httpx.Client(timeout=120.0) as client:
+        while client.get(f"http://127.0.0.1:{BACKEND_PORT}/readyz").status_code != 200:
+            time.sleep(0.05)
+        while not client.get(f"{BASE}/local/stats").json()["retrieval"]["ready"]:
+            time.sleep(0.05)
+
+        topics = (TOPICS * (args.pairs // len(TOPICS) + 1))[:args.pairs]
+        for i, topic in enumerate(topics):
+            turn = [
+                {"role": "user", "content": f"How do I {topic}?"},
+                {"role": "assistant", "content": f"To {topic}, follow these steps carefully. " * 3},
+            ]
+            client.post(f"{BASE}/sessions/kb-{i}/turns", json={"messages": turn, "source": "online"},
+                        headers={"Authorization": f"Bearer {SYNC_TOKEN}"})
+        while client.get(f"{BASE}/local/stats").json()["retrieval"]["entries"] < len(set(topics)):
+            time.sleep(0.05)
+
+        with_context = 0
+        embed_ms, search_ms = [], []
+        for i, topic in enumerate(topics):
+            payload = {"session_id": f"ask-{i}", "query": f"what is the best way to {topic} offline", "no_cache": True}
+            with client.stream("POST", f"{BASE}/chat", json=payload) as response:
+                trace_id = response.headers["x-trace-id"]
+                for _ in response.iter_lines():
+                    pass
+            spans = trace_spans(client, trace_id)
+            for span in spans:
+                if span["name"] == "prompt_build":
+                    with_context += span.get("past_answers", 0) > 0
+                elif span["name"] == "retrieval_embed":
+                    embed_ms.append(span["duration_ms"])
+                elif span["name"] == "retrieval_search":
+                    search_ms.append(span["duration_ms"])
+        stats = client.get(f"{BASE}/local/stats").json()["retrieval"]
+    return {
+        "pairs": len(topics),
+        "entries": stats["entries"],
+        "duplicates": stats["duplicates"],
+        "prompts_with_past_answers": with_context,
+        "embed_ms_p50": percentile(embed_ms, 0.5),
+        "search_ms_p50": percentile(search_ms, 0.5),
+        "hit_rate": stats["hit_rate"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--dim", type=int, default=256, help="index dimension (RETRIEVAL_DIM)")
+    parser.add_argument("--coarse-dim", type=int, default=96, help="columns scanned for every row")
+    parser.add_argument("--candidates", type=int, default=1024, help="rows rescored on every dimension")
+    parser.add_argument("--model-dim", type=int, default=1024, help="synthetic embedding width")
+    parser.add_argument("--noise", type=float, default=0.5, help="query noise relative to the embedding")
+    parser.add_argument("--pairs", type=int, default=40, help="online turns recorded on the backend")
+    parser.add_argument("--max-search-ms", type=float, default=10.0)
+    parser.add_argument("--min-recall", type=float, default=0.95)
+    args = parser.parse_args()
+    sys.path[:0] = [os.path.join(HERE, "fake_modules"), os.path.join(ROOT, "backend"), ROOT]
+
+    report = {"index": index_benchmark(args), "backend": backend_benchmark(args)}
+    print(json.dumps(report, indent=2))
+    index, backend = report["index"], report["backend"]
+    if index["search_ms"]["p50"] > args.max_search_ms or index["top1_recall"] < args.min_recall:
+        sys.exit(f"Retrieval check failed: search p50 over {args.max_search_ms} ms or recall under {args.min_recall}")
+    if backend["prompts_with_past_answers"] < args.min_recall * backend["pairs"]:
+        sys.exit("Retrieval check failed: past answers missing from offline prompts")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Versioned sessions: request bytes per turn with the whole conversation in every request versus
+only the new turn at the session's revision, and consistency of the server-side history.
+
+Two backend replicas (the real backend on the fake `llama_cpp`, one process each, see
+fake_modules) behind the gateway, and a fake Cerebras. `--sessions` conversations of `--turns`
+turns alternate between Cerebras (even turns) and the local model (odd turns), first sending
+full `messages` and then `query` + `revision`. Halfway through the second run both replicas are
+replaced by empty ones, one after a local turn (the gateway's copy is a turn behind, so the client
+gets a 409 and catches up with the history the server kept) and the other a turn later, after a
+Cerebras turn (the gateway resyncs the replica from its copy). Exits non-zero if an answer fails or any
+session's history on the backend, in the gateway's copy and on the client differ at the end.
+
+    python benchmarks/session_revisions.py --sessions 6 --turns 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fakes import make_fake_cerebras, serve
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+CEREBRAS_PORT = 18600
+BACKEND_PORT = 18610  # replica i listens on BACKEND_PORT + i
+GATEWAY_PORT = 18680
+SYNC_TOKEN = "benchmark-sync-token"  # SESSION_SYNC_TOKEN of the gateway and the replicas
+SYNC_HEADERS = {"Authorization": f"Bearer {SYNC_TOKEN}"}
+
+
+def serve_backend(args):
+    """Child process: one backend replica on port args.serve until killed."""
+    os.environ.update({
+        "FAKE_LLAMA_PROMPT_MS": "0.5",
+        "FAKE_LLAMA_TOKEN_MS": str(args.token_ms),
+        "FAKE_LLAMA_TOKENS": str(args.tokens),
+        "CEREBRAS_API_KEY": "",
+    })
+    sys.path[:0] = [os.path.join(HERE, "fake_modules"), os.path.join(ROOT, "backend"), ROOT]
+    os.chdir(tempfile.mkdtemp(prefix="bridgeai-replica-"))
+
+    from app.main import app
+
+    serve(app, args.serve)
+    while True:
+        time.sleep(3600)
+
+
+def start_replica(port: int) -> subprocess.Popen:
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(port)] + sys.argv[1:])
+    while True:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/readyz").status_code == 200:
+                return process
+        except httpx.TransportError:
+            pass
+        time.sleep(0.05)
+
+
+class Client:
+    """One conversation as a client keeps it: the transcript, and the revision it last saw."""
+
+    def __init__(self, session: str, delta: bool):
+        self.session = session
+        self.delta = delta
+        self.messages = []
+        self.revision = 0
+        self.generation = 0
+        self.request_bytes = 0
+        self.resyncs = 0
+        self.failures = 0
+
+    async def turn(self, http: httpx.AsyncClient, number: int, retry: bool = True):
+        query = f"{self.session} turn {number}: what did we say so far?"
+        if self.delta:
+            payload = {"session_id": self.session, "query": query, "revision": self.revision, "no_cache": True}
+        else:
+            payload = {"session_id": self.session, "messages": self.messages + [{"role": "user", "content": query}],
+                       "no_cache": True}
+        body = json.dumps(payload).encode()
+        self.request_bytes += len(body)
+        text, error = "", None
+        async with http.stream("POST", f"http://127.0.0.1:{GATEWAY_PORT}/chat", content=body,
+                               headers={"content-type": "application/json"}) as response:
+            if response.status_code == 409 and retry:
+                await self.resync(http, json.loads(await response.aread())["detail"])
+                return await self.turn(http, number, retry=False)
+            if response.status_code != 200:
+                error = (await response.aread()).decode(errors="replace")
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    data = json.loads(line[6:])
+                    if data.get("error"):
+                        error = data["error"]
+                    elif "revision" in data:
+                        self.revision, self.generation = data["revision"], data["generation"]
+                    else:
+                        text += data.get("content", "")
+        if error or not text:
+            self.failures += 1
+        self.messages += [{"role": "user", "content": query}, {"role": "assistant", "content": text.strip()}]
+
+    async def resync(self, http: httpx.AsyncClient, server: dict):
+        """After a 409: catch up with the server's history, which wins even if it lost turns we have."""
+        self.resyncs += 1
+        url = f"http://127.0.0.1:{GATEWAY_PORT}/sessions/{self.session}/history"
+        state = (await http.get(url, params={"revision": self.revision, "generation": self.generation})).json()
+        if state["reset"]:
+            self.messages = []
+        self.messages += [{"role": m["role"], "content": m["content"]} for m in state["messages"]]
+        self.revision, self.generation = state["revision"], state["generation"]
+
+
+def transcript(messages: list) -> list:
+    return [(m["role"], m["content"]) for m in messages if m.get("source") != "summary"]
+
+
+async def run(gateway, args, delta: bool, replace=None) -> dict:
+    clients = [Client(f"{'delta' if delta else 'full'}-s{i}", delta) for i in range(args.sessions)]
+    replaced = 0
+    async with httpx.AsyncClient(timeout=600.0) as http:
+        start = time.perf_counter()
+        for number in range(args.turns):
+            online = number % 2 == 0
+            gateway.network_status = gateway.NetworkStatus(online=online, cerebras_available=online,
+                                                           last_check="pinned")
+            if replace is not None and number in (args.turns // 2, args.turns // 2 + 1):
+                replace(number - args.turns // 2)
+                replaced += 1
+            await asyncio.gather(*(client.turn(http, number) for client in clients))
+        seconds = time.perf_counter() - start
+
+        mismatched = 0
+        if delta:
+            for client in clients:
+                url = f"/sessions/{client.session}/history"
+                mirrored = (await http.get(f"http://127.0.0.1:{GATEWAY_PORT}{url}")).json()
+                replica = gateway.backend_pool.home(client.session)
+                stored = (await http.get(f"{replica.url}/api{url}", headers=SYNC_HEADERS)).json()
+                expected = [(m["role"], m["content"]) for m in client.messages]
+                if not (transcript(stored["messages"]) == transcript(mirrored["messages"]) == expected
+                        and stored["revision"] == mirrored["revision"] == client.revision):
+                    mismatched += 1
+
+    turns = args.sessions * args.turns
+    return {
+        "mode": "query+revision" if delta else "messages",
+        "seconds": round(seconds, 3),
+        "request_bytes_per_turn": round(sum(c.request_bytes for c in clients) / turns),
+        "failed": sum(c.failures for c in clients),
+        "replicas_replaced": replaced,
+        "client_resyncs": sum(c.resyncs for c in clients),
+        "mismatched_histories": mismatched if delta else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=6)
+    parser.add_argument("--turns", type=int, default=8, help="a multiple of 4 replaces replicas as described")
+    parser.add_argument("--tokens", type=int, default=32, help="tokens per answer")
+    parser.add_argument("--token-ms", type=float, default=2.0)
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve_backend(args)
+        return
+
+    urls = [f"http://127.0.0.1:{BACKEND_PORT + i}" for i in range(2)]
+    os.environ.update({
+        "CEREBRAS_API_KEY": "fake-key",
+        "CEREBRAS_BASE_URL": f"http://127.0.0.1:{CEREBRAS_PORT}",
+        "LOCAL_MODEL_URLS": ",".join(urls),
+        "NETWORK_PROBE_INTERVAL": "0",
+        "BACKEND_HEALTH_INTERVAL": "0",
+        "HEDGE_DEFAULT": "false",
+        "RATE_LIMIT_SESSION_REQUESTS": "0",
+        "RATE_LIMIT_SESSION_TOKENS": "0",
+        "RATE_LIMIT_GLOBAL_REQUESTS": "0",
+        "RATE_LIMIT_GLOBAL_TOKENS": "0",
+        "CEREBRAS_TOKENS_PER_MINUTE": "0",
+        "SESSION_SYNC_TOKEN": SYNC_TOKEN,  # inherited by the replica processes
+    })
+    sys.path[:0] = [os.path.join(ROOT, "mcp-gateway"), ROOT]
+    import gateway
+
+    serve(make_fake_cerebras(args.tokens, args.token_ms / 1000), CEREBRAS_PORT)
+    serve(gateway.app, GATEWAY_PORT)
+    processes = [start_replica(BACKEND_PORT + i) for i in range(2)]
+
+    def replace(i: int):
+        # An empty replica where replica i was: its sessions' histories are gone
+        processes[i].kill()
+        processes[i].wait()
+        processes[i] = start_replica(BACKEND_PORT + i)
+
+    try:
+        full = asyncio.run(run(gateway, args, delta=False))
+        delta = asyncio.run(run(gateway, args, delta=True, replace=replace))
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+    report = {
+        "sessions": args.sessions,
+        "turns": args.turns,
+        "full": full,
+        "delta": delta,
+        "bytes_saved": round(1 - delta["request_bytes_per_turn"] / full["request_bytes_per_turn"], 3),
+        "mirror": gateway.session_mirror.stats(),
+        "syncs": {kind: gateway.session_syncs.labels(kind).value for kind in ("delta", "reset", "push", "failed")},
+    }
+    print(json.dumps(report, indent=2))
+    if full["failed"] or delta["failed"] or delta["mismatched_histories"]:
+        sys.exit("Session revision check failed: failed answers or diverged histories")
+
+
+if __name__ == "__main__":
+    main()
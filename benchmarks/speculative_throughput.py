@@ -0,0 +1,127 @@
+"""
+Local-model decode speed with and without speculative decoding, on the fake `llama_cpp` (see fake_modules).
+
+SPECULATIVE_MODE is read when the backend is imported, so each mode is served by its own backend
+process. The same questions go through /api/chat one at a time; answers must match across modes.
+The gain on the fake comes from its cost model (FAKE_LLAMA_VERIFY_COST, the extra cost of each
+draft token in a decode) and from how much of each answer repeats the prompt (FAKE_LLAMA_ECHO);
+on real hardware, measure with GGUF models. The fake draft model only guesses the runs that are
+not copied, so try --mode draft with a low --echo. Exits non-zero if the speedup is below --min-speedup.
+
+    python benchmarks/speculative_throughput.py --mode prompt_lookup --echo 0.5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fakes import serve
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BACKEND_PORT = 18500
+BASE = f"http://127.0.0.1:{BACKEND_PORT}/api"
+
+
+def serve_backend(args):
+    """Child process: serve the backend with SPECULATIVE_MODE=args.serve until killed."""
+    os.environ.update({
+        "FAKE_LLAMA_PROMPT_MS": str(args.prompt_ms),
+        "FAKE_LLAMA_TOKEN_MS": str(args.token_ms),
+        "FAKE_LLAMA_TOKENS": str(args.tokens),
+        "FAKE_LLAMA_VERIFY_COST": str(args.verify_cost),
+        "FAKE_LLAMA_ECHO": str(args.echo),
+        "SPECULATIVE_MODE": args.serve,
+        "CEREBRAS_API_KEY": "",
+    })
+    sys.path[:0] = [os.path.join(HERE, "fake_modules"), os.path.join(ROOT, "backend"), ROOT]
+    os.chdir(tempfile.mkdtemp(prefix="bridgeai-speculative-"))
+
+    from app.main import app
+
+    serve(app, BACKEND_PORT)
+    while True:
+        time.sleep(3600)
+
+
+def questions(count: int) -> list:
+    return [f"Question {i}: summarise what we said about offline answers and the local model." for i in range(count)]
+
+
+def run_mode(mode: str, args) -> dict:
+    command = [sys.executable, os.path.abspath(__file__), "--serve", mode] + sys.argv[1:]
+    backend = subprocess.Popen(command)
+    try:
+        with httpx.Client(timeout=600.0) as client:
+            while True:
+                try:
+                    if client.get(f"http://127.0.0.1:{BACKEND_PORT}/readyz").status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.05)
+
+            answers = []
+            start = time.perf_counter()
+            for i, query in enumerate(questions(args.requests)):
+                payload = {"session_id": f"spec-{i}", "query": query, "no_cache": True}
+                text = ""
+                with client.stream("POST", f"{BASE}/chat", json=payload) as response:
+                    for line in response.iter_lines():
+                        if line.startswith("data: "):
+                            text += json.loads(line[6:]).get("content", "")
+                answers.append(text)
+            seconds = time.perf_counter() - start
+            stats = client.get(f"{BASE}/local/stats").json()["speculative"]
+    finally:
+        backend.terminate()
+        backend.wait()
+
+    return {
+        "seconds": round(seconds, 3),
+        "tokens_per_s": round(args.requests * args.tokens / seconds, 1),
+        "speculative": stats,
+        "answers": answers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", default="prompt_lookup", choices=("prompt_lookup", "draft"))
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--tokens", type=int, default=128, help="tokens per answer")
+    parser.add_argument("--prompt-ms", type=float, default=0.5)
+    parser.add_argument("--token-ms", type=float, default=20.0)
+    parser.add_argument("--verify-cost", type=float, default=0.05)
+    parser.add_argument("--echo", type=float, default=0.5, help="share of each answer copied from its prompt")
+    parser.add_argument("--min-speedup", type=float, default=1.3)
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve_backend(args)
+        return
+
+    plain = run_mode("off", args)
+    speculative = run_mode(args.mode, args)
+    identical = plain.pop("answers") == speculative.pop("answers")
+    report = {
+        "mode": args.mode,
+        "requests": args.requests,
+        "tokens_per_answer": args.tokens,
+        "off": plain,
+        args.mode: speculative,
+        "speedup": round(plain["seconds"] / speculative["seconds"], 2),
+        "identical_answers": identical,
+    }
+    print(json.dumps(report, indent=2))
+    if not identical or report["speedup"] < args.min_speedup:
+        sys.exit(f"Speculative decoding check failed (speedup {report['speedup']}, identical answers {identical})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+Pool of backend replicas for local-model traffic: least-outstanding routing with session
+affinity, active health checks and ejection of failing or slow replicas.
+"""
+import asyncio
+import logging
+import random
+import socket
+import statistics
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from shared.prometheus import Registry
+
+logger = logging.getLogger(__name__)
+
+
+class Replica:
+    """One backend instance and what the gateway has seen of it."""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0  # streams in flight
+        self.healthy = True  # latest /readyz said the local model is loaded (assumed until the first check)
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.backoff = 0.0
+        self.consecutive_failures = 0  # failed streams in a row
+        self.check_failures = 0  # unreachable health checks in a row
+        self.latency = None  # moving average of seconds to response headers
+        self.requests = 0
+        self.failures = 0
+        self.last_check = None
+
+    @property
+    def ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and not self.ejected
+
+    def snapshot(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "ejected_for": round(max(self.ejected_until - time.monotonic(), 0.0), 1),
+            "outstanding": self.outstanding,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "last_check": self.last_check,
+        }
+
+
+class Lease:
+    """
+    A stream's hold on a replica, used as a context manager around the request. Set `outcome`
+    to "ok", "rejected" (the replica was busy or warming up: not its fault) or "error"; leaving
+    without one counts as "cancelled" (the client went away), or "error" on an exception.
+    """
+
+    def __init__(self, pool: "BackendPool", replica: Replica):
+        self.pool = pool
+        self.replica = replica
+        self.outcome = None
+        self.started = time.monotonic()
+
+    def headers_received(self):
+        self.pool._record_latency(self.replica, time.monotonic() - self.started)
+
+    def __enter__(self):
+        self.replica.outstanding += 1
+        self.replica.requests += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.replica.outstanding -= 1
+        outcome = self.outcome
+        if outcome is None:
+            cancelled = exc_type is None or issubclass(exc_type, (asyncio.CancelledError, GeneratorExit))
+            outcome = "cancelled" if cancelled else "error"
+        self.pool._finish(self.replica, outcome)
+        return False
+
+
+class BackendPool:
+    """
+    Backend replicas, from `urls` or, with `discovery`, from every address their host names
+    resolve to (e.g. a scaled Docker Compose service), re-resolved on each health round.
+
+    A session sticks to the replica that served it, so its history and KV-cache snapshot stay
+    warm there, unless that replica is unavailable or has `affinity_slack` more streams in flight
+    than the least loaded one; new and moved sessions go to the least loaded replica.
+
+    Replicas are checked every `health_interval` seconds (GET /readyz). A replica is ejected after
+    `eject_failures` consecutive failed streams, or as many unreachable checks in a row, or when its response latency is over
+    `slow_factor` times the pool median (and over `slow_min` seconds); ejection lasts
+    `eject_backoff`, doubling up to `max_eject_backoff` for repeat offenders. At most
+    `max_ejected_fraction` of the replicas are ejected at once.
+    """
+
+    def __init__(self, urls: list, registry: Registry, discovery: bool = False, health_interval: float = 5.0,
+                 health_timeout: float = 2.0, eject_failures: int = 3, eject_backoff: float = 10.0,
+                 max_eject_backoff: float = 300.0, slow_factor: float = 3.0, slow_min: float = 1.0,
+                 max_ejected_fraction: float = 0.5, affinity_sessions: int = 10000, affinity_slack: int = 2):
+        if not urls:
+            raise ValueError("At least one backend URL is required")
+        self.seeds = [url.rstrip("/") for url in urls]
+        self.discovery = discovery
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.eject_failures = eject_failures
+        self.eject_backoff = eject_backoff
+        self.max_eject_backoff = max_eject_backoff
+        self.slow_factor = slow_factor
+        self.slow_min = slow_min
+        self.max_ejected_fraction = max_ejected_fraction
+        self.affinity_sessions = affinity_sessions
+        self.affinity_slack = affinity_slack
+        self.replicas = {url: Replica(url) for url in self.seeds}
+        self._affinity = OrderedDict()  # session id -> replica url, least recently used first
+        self._affinity_stats = {"hits": 0, "moves": 0, "new": 0}
+
+        self.requests = registry.counter(
+            "gateway_backend_requests_total", "Local-model streams by backend and outcome", ("backend", "outcome")
+        )
+        self.latency = registry.histogram(
+            "gateway_backend_latency_seconds", "Time to response headers from a backend", ("backend",)
+        )
+        self.ejections = registry.counter("gateway_backend_ejections_total", "Backend ejections", ("backend", "reason"))
+        registry.gauge("gateway_backend_outstanding", "Streams in flight per backend", ("backend",)).set_function(
+            lambda: {(r.url,): r.outstanding for r in self.replicas.values()}
+        )
+        registry.gauge("gateway_backend_available", "Backend healthy and not ejected", ("backend",)).set_function(
+            lambda: {(r.url,): int(r.available) for r in self.replicas.values()}
+        )
+
+    # ----- Routing -----
+
+    def choose(self, session_id: str, exclude: tuple = ()):
+        """The replica for this session's next stream, or None once every replica is in `exclude`."""
+        candidates = [r for r in self.replicas.values() if r.available and r not in exclude]
+        if not candidates:
+            # Every replica is down or ejected: trying one beats failing outright
+            candidates = [r for r in self.replicas.values() if r not in exclude]
+            if not candidates:
+                return None
+
+        least = min(r.outstanding for r in candidates)
+        sticky = self.replicas.get(self._affinity.get(session_id))
+        if sticky in candidates and sticky.outstanding <= least + self.affinity_slack:
+            self._affinity.move_to_end(session_id)
+            self._affinity_stats["hits"] += 1
+            return sticky
+
+        self._affinity_stats["moves" if session_id in self._affinity else "new"] += 1
+        replica = random.choice([r for r in candidates if r.outstanding == least])
+        self._affinity[session_id] = replica.url
+        self._affinity.move_to_end(session_id)
+        while len(self._affinity) > self.affinity_sessions:
+            self._affinity.popitem(last=False)
+        return replica
+
+    def home(self, session_id: str):
+        """The replica holding this session's history: its sticky one while available, else a new pick."""
+        sticky = self.replicas.get(self._affinity.get(session_id))
+        if sticky is not None and sticky.available:
+            return sticky
+        return self.choose(session_id)
+
+    def lease(self, replica: Replica) -> Lease:
+        return Lease(self, replica)
+
+    def _finish(self, replica: Replica, outcome: str):
+        self.requests.labels(replica.url, outcome).inc()
+        if outcome == "ok":
+            replica.consecutive_failures = replica.check_failures = 0
+        elif outcome == "error":
+            replica.failures += 1
+            replica.consecutive_failures += 1
+            if replica.consecutive_failures >= self.eject_failures:
+                self._eject(replica, "errors")
+
+    # ----- Ejection -----
+
+    def _record_latency(self, replica: Replica, seconds: float):
+        self.latency.labels(replica.url).observe(seconds)
+        replica.latency = seconds if replica.latency is None else replica.latency + 0.2 * (seconds - replica.latency)
+        others = [r.latency for r in self.replicas.values() if r is not replica and r.latency is not None]
+        if not others:
+            return
+        limit = max(self.slow_factor * statistics.median(others), self.slow_min)
+        if replica.latency > limit:
+            self._eject(replica, "slow")
+
+    def _eject(self, replica: Replica, reason: str):
+        if replica.ejected:
+            return
+        ejected = sum(1 for r in self.replicas.values() if r.ejected)
+        if ejected + 1 > self.max_ejected_fraction * len(self.replicas):
+            return
+        replica.backoff = min(replica.backoff * 2, self.max_eject_backoff) if replica.backoff else self.eject_backoff
+        replica.ejected_until = time.monotonic() + replica.backoff
+        replica.ejections += 1
+        replica.consecutive_failures = replica.check_failures = 0
+        replica.latency = None  # judged afresh after its time out
+        self.ejections.labels(replica.url, reason).inc()
+        logger.warning(f"Ejected backend {replica.url} for {replica.backoff:.0f}s ({reason})")
+
+    # ----- Health checks and discovery -----
+
+    async def discover(self):
+        """Add replicas for every address the seed hosts resolve to; drop the ones that are gone."""
+        loop = asyncio.get_running_loop()
+        found = set()
+        for seed in self.seeds:
+            parts = urlsplit(seed)
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+            try:
+                addresses = await loop.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+            except OSError as e:
+                logger.warning(f"Could not resolve backend {seed}: {e}")
+                return  # keep the current set rather than dropping live replicas
+            for *_, sockaddr in addresses:
+                host = f"[{sockaddr[0]}]" if ":" in sockaddr[0] else sockaddr[0]
+                found.add(f"{parts.scheme}://{host}:{port}")
+        self.update(found)
+
+    def update(self, urls):
+        """Make `urls` the replica set, keeping what is known about the ones already in it."""
+        urls = {url.rstrip("/") for url in urls}
+        for url in urls - self.replicas.keys():
+            logger.info(f"Added backend {url}")
+            self.replicas[url] = Replica(url)
+        for url in self.replicas.keys() - urls:
+            logger.info(f"Removed backend {url}")
+            del self.replicas[url]  # streams in flight keep their Replica object
+
+    async def check(self, client, replica: Replica):
+        started = time.monotonic()
+        try:
+            response = await client.get(f"{replica.url}/readyz", timeout=self.health_timeout)
+            healthy = response.status_code == 200
+        except Exception as e:
+            logger.debug(f"Health check of {replica.url} failed: {e}")
+            healthy = None  # unreachable, as opposed to reachable but still loading
+        replica.last_check = round(time.monotonic() - started, 3)
+        if healthy is None:
+            replica.check_failures += 1
+            if replica.check_failures >= self.eject_failures:
+                self._eject(replica, "health_check")
+        else:
+            replica.check_failures = 0  # reached it: earlier timeouts were not a run (failed streams still are)
+        if replica.healthy != bool(healthy):
+            logger.info(f"Backend {replica.url} is {'ready' if healthy else 'not ready'}")
+        replica.healthy = bool(healthy)
+
+    async def check_all(self, client):
+        if self.discovery:
+            await self.discover()
+        await asyncio.gather(*(self.check(client, r) for r in list(self.replicas.values())))
+
+    async def run(self, client):
+        """Background loop that keeps replica health (and, with discovery, membership) fresh"""
+        while True:
+            try:
+                await self.check_all(client)
+            except Exception as e:
+                logger.error(f"Backend health round failed: {e}")
+            await asyncio.sleep(self.health_interval)
+
+    def stats(self) -> dict:
+        return {
+            "replicas": [r.snapshot() for r in self.replicas.values()],
+            "available": sum(1 for r in self.replicas.values() if r.available),
+            "affinity": {"sessions": len(self._affinity), **self._affinity_stats},
+            "discovery": self.discovery,
+        }
@@ -4,17 +4,29 @@ MCP Gateway - Network-aware routing between Cerebras and local model
 Automatically detects internet connectivity and routes requests accordingly
 """
 import os
-import json
 import logging
 import asyncio
+import datetime
+import time
+from collections import deque
 from typing import Optional
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import httpx
-from cerebras.cloud.sdk import Cerebras
+from cerebras.cloud.sdk import AsyncCerebras, RateLimitError
 from dotenv import load_dotenv
+from backend_pool import BackendPool
+from session_mirror import SessionMirror
+from shared.cerebras_errors import fallback_cause, retry_after
+from shared.debug import debug_router
+from shared.guards import reject_if_rate_limited
+from shared.prometheus import SIZE_BUCKETS, Registry, StreamMetrics
+from shared.rate_limit import RateLimiter, TokenBudget
+from shared.response_cache import ResponseCache, cache_key
+from shared.sse import TextFrames, count_text_frames, event, is_text_frame, replay_frames, with_deadlines_async
+from shared.tracing import TRACE_HEADER, Tracer, TracingMiddleware, annotate, current_trace, record, span
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,11 +42,81 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[TRACE_HEADER],
 )
 
 # Configuration
 CEREBRAS_API_KEY = os.getenv("CEREBRAS_API_KEY", "")
 CEREBRAS_MODEL = "llama-3.3-70b"
+CEREBRAS_BASE_URL = os.getenv("CEREBRAS_BASE_URL", "https://api.cerebras.ai")
+LOCAL_MODEL_URL = os.getenv("LOCAL_MODEL_URL", "http://backend:8000")
+NETWORK_PROBE_INTERVAL = float(os.getenv("NETWORK_PROBE_INTERVAL", "10"))  # seconds; 0 disables the prober
+
+# Backend replicas for the local model (see backend_pool.py): a comma-separated LOCAL_MODEL_URLS, else
+# LOCAL_MODEL_URL. With BACKEND_DISCOVERY, each host name is expanded to every address it resolves to
+# (e.g. `docker compose up --scale backend=3`).
+LOCAL_MODEL_URLS = [url.strip() for url in os.getenv("LOCAL_MODEL_URLS", LOCAL_MODEL_URL).split(",") if url.strip()]
+BACKEND_DISCOVERY = os.getenv("BACKEND_DISCOVERY", "false").lower() == "true"
+BACKEND_HEALTH_INTERVAL = float(os.getenv("BACKEND_HEALTH_INTERVAL", "5"))  # seconds; 0 disables health checks
+BACKEND_EJECT_FAILURES = int(os.getenv("BACKEND_EJECT_FAILURES", "3"))  # consecutive failures before ejection
+BACKEND_EJECT_BACKOFF = float(os.getenv("BACKEND_EJECT_BACKOFF", "10"))  # seconds, doubling for repeat ejections
+BACKEND_SLOW_FACTOR = float(os.getenv("BACKEND_SLOW_FACTOR", "3"))  # latency over this x the pool median ejects
+BACKEND_AFFINITY_SLACK = int(os.getenv("BACKEND_AFFINITY_SLACK", "2"))  # extra streams tolerated to keep a session
+
+# Hedged routing: start the local model too if Cerebras has not produced a token by the deadline
+HEDGE_DEFAULT = os.getenv("HEDGE_DEFAULT", "false").lower() == "true"
+HEDGE_DEADLINE = float(os.getenv("HEDGE_DEADLINE", "0"))  # seconds; 0 = p95 of recent Cerebras TTFTs
+HEDGE_MIN_DEADLINE = float(os.getenv("HEDGE_MIN_DEADLINE", "0.5"))
+HEDGE_INITIAL_DEADLINE = float(os.getenv("HEDGE_INITIAL_DEADLINE", "2.0"))  # until enough TTFTs are recorded
+
+# Exact-match cache of completed Cerebras answers, replayed for repeat questions (also while offline)
+CEREBRAS_TEMPERATURE = 0.8
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", str(32 * 1024 ** 2)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 60 * 60)))  # seconds
+RESPONSE_CACHE_DB_PATH = os.getenv("RESPONSE_CACHE_DB_PATH") or None
+RESPONSE_CACHE_REPLAY_CHARS = int(os.getenv("RESPONSE_CACHE_REPLAY_CHARS", "24"))
+RESPONSE_CACHE_REPLAY_INTERVAL = float(os.getenv("RESPONSE_CACHE_REPLAY_INTERVAL", "0.02"))  # seconds per frame
+
+# Per-session and global rate limits on /chat, per minute, in requests and in estimated tokens (prompt plus
+# RATE_LIMIT_REPLY_TOKENS); a session may burst up to a minute's allowance. 0 disables a limit.
+RATE_LIMIT_SESSION_REQUESTS = int(os.getenv("RATE_LIMIT_SESSION_REQUESTS", "20"))
+RATE_LIMIT_SESSION_TOKENS = int(os.getenv("RATE_LIMIT_SESSION_TOKENS", "40000"))
+RATE_LIMIT_GLOBAL_REQUESTS = int(os.getenv("RATE_LIMIT_GLOBAL_REQUESTS", "600"))
+RATE_LIMIT_GLOBAL_TOKENS = int(os.getenv("RATE_LIMIT_GLOBAL_TOKENS", "1000000"))
+RATE_LIMIT_REPLY_TOKENS = int(os.getenv("RATE_LIMIT_REPLY_TOKENS", "256"))
+
+# Cerebras quota: requests that would take the last minute's tokens (reported usage, estimates for streams in
+# flight) past CEREBRAS_HEADROOM of the quota go to the local model up front instead of waiting for 429s. The
+# backend replicas call Cerebras with the same key, so each process admits against its CEREBRAS_TPM_SHARE of the
+# quota; the gateway's and the backends' shares must add up to at most 1.
+CEREBRAS_TOKENS_PER_MINUTE = int(os.getenv("CEREBRAS_TOKENS_PER_MINUTE", "60000"))  # 0 disables the check
+CEREBRAS_TPM_SHARE = float(os.getenv("CEREBRAS_TPM_SHARE", "0.5"))
+CEREBRAS_HEADROOM = float(os.getenv("CEREBRAS_HEADROOM", "0.9"))
+CEREBRAS_MAX_TOKENS = 1024
+CEREBRAS_CONTEXT = 8192  # llama-3.3-70b context window: history fills what the reply and system prompt leave
+
+# Session histories live on the backend; the gateway keeps a copy per session, synced by revision (see session_mirror.py)
+SESSION_MIRROR_SESSIONS = int(os.getenv("SESSION_MIRROR_SESSIONS", "10000"))
+SESSION_SYNC_TIMEOUT = float(os.getenv("SESSION_SYNC_TIMEOUT", "2"))  # seconds; past it the turn uses the copy as is
+# Sent as "Authorization: Bearer <SESSION_SYNC_TOKEN>" to the backend's session history endpoints, which only the
+# gateway may call; set the same value on both. Unset, the backend refuses them and turns go without history.
+SESSION_SYNC_TOKEN = os.getenv("SESSION_SYNC_TOKEN", "")
+SESSION_SYNC_HEADERS = {"Authorization": f"Bearer {SESSION_SYNC_TOKEN}"}
+
+# Request tracing: spans per request (session sync, Cerebras connect / first token / stream, backend streams,
+# response writes), the last TRACE_BUFFER_SIZE traces kept for /debug/traces (0 disables). The trace id goes to
+# the backend in the X-Trace-Id header, so its half of the request is found under the same id.
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "1000"))
+TRACE_MAX_SPANS = 256  # per trace; later spans are counted but dropped
+
+# Admin endpoints (/debug/traces, /debug/profile) take "Authorization: Bearer <ADMIN_TOKEN>"; unset disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_MAX_SECONDS = 30  # longest sampling profile one request may run
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+
+# SSE framing: Cerebras deltas arriving faster than this are coalesced into one frame (0 sends every delta)
+SSE_FRAME_INTERVAL = float(os.getenv("SSE_FRAME_INTERVAL", "0.05"))  # seconds
+SSE_FRAME_MAX_CHARS = int(os.getenv("SSE_FRAME_MAX_CHARS", "256"))
 
 # System prompts from config
 SYSTEM_PROMPT_ONLINE = """You are BridgeAI (online mode) - an advanced AI powered by Cerebras, built by Team Cyber_Samurais for FutureStack GenAI Hackathon 2025.
@@ -52,12 +134,26 @@ Respond naturally and completely without meta-commentary about response length."
 
 # Cerebras client (lazy initialization)
 cerebras_client = None
+cerebras_client_lock = asyncio.Lock()
+
+# Shared keep-alive connection pool to the backend, created on startup
+http_client: Optional[httpx.AsyncClient] = None
 
 
 class ChatRequest(BaseModel):
-    messages: list
+    """
+    A new turn: `query` at the session `revision` the client last saw (the history itself lives
+    on the backend; 409 with the current history if the revision is stale), or the whole
+    conversation as `messages`, whose last user message is the turn.
+    """
     session_id: str
+    query: Optional[str] = None
+    revision: Optional[int] = None
+    messages: list = []
     stream: bool = True
+    hedge: Optional[bool] = None  # race Cerebras against the local model; defaults to HEDGE_DEFAULT
+    no_cache: bool = False  # skip the response cache lookup
+    compact: bool = False  # compact SSE framing: bare-string text frames, source sent once (see shared/sse.py)
 
 
 class NetworkStatus(BaseModel):
@@ -66,158 +162,847 @@ class NetworkStatus(BaseModel):
     last_check: str
 
 
-# Network detection cache
-network_cache = {
-    "online": False,
-    "cerebras_available": False,
-    "last_check": None,
-    "check_interval": 10  # seconds
+class CircuitBreaker:
+    """
+    Circuit breaker over real Cerebras request outcomes.
+
+    CLOSED: requests flow. After `failure_threshold` consecutive failures it OPENs and
+    rejects requests for a backoff period; then one HALF_OPEN trial request is let through.
+    A successful trial closes the breaker, a failed one re-opens it with doubled backoff.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 3, base_backoff: float = 5.0, max_backoff: float = 300.0):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.backoff = base_backoff
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.trial_started = 0.0
+
+    def allow_request(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.backoff:
+            self.state = self.HALF_OPEN
+        # A trial whose stream never reported back (never started) must not wedge the breaker
+        trial_stale = time.monotonic() - self.trial_started > max(self.backoff, 60.0)
+        if self.state == self.HALF_OPEN and (not self.trial_in_flight or trial_stale):
+            self.trial_in_flight = True
+            self.trial_started = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.backoff = self.base_backoff
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN:
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            self._open()
+        elif self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self.backoff = self.base_backoff
+            self._open()
+
+    def record_cancelled(self):
+        """The request ended without a verdict (e.g. client disconnect); free the trial slot."""
+        self.trial_in_flight = False
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.trial_in_flight = False
+        logger.warning(f"Cerebras circuit opened for {self.backoff:.0f}s after {self.consecutive_failures} failures")
+
+    def snapshot(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures, "backoff": self.backoff}
+
+
+# Latest probe result. The background prober replaces the whole object, so readers always
+# see a consistent snapshot and request handling never waits on the network.
+network_status = NetworkStatus(online=False, cerebras_available=False, last_check="never")
+cerebras_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv("CEREBRAS_FAILURE_THRESHOLD", "3")),
+    base_backoff=float(os.getenv("CEREBRAS_BASE_BACKOFF", "5")),
+    max_backoff=float(os.getenv("CEREBRAS_MAX_BACKOFF", "300")),
+)
+prober_task: Optional[asyncio.Task] = None
+backend_health_task: Optional[asyncio.Task] = None
+
+# Recent Cerebras time-to-first-token samples (seconds) and hedging outcomes
+online_ttfts = deque(maxlen=200)
+response_cache = ResponseCache(RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL, db_path=RESPONSE_CACHE_DB_PATH)
+hedge_stats = {
+    "requests": 0,
+    "hedged": 0,
+    "wins": {"online": 0, "local": 0},
+    "no_winner": 0,
+    "wasted_frames": 0,
+    "wasted_bytes": 0,
+    "wasted_seconds": 0.0,
 }
 
+# Prometheus metrics, served at /metrics. Streams are labelled by source ("online", "local", "cache").
+metrics_registry = Registry()
+streams = StreamMetrics(metrics_registry, "gateway")
+prompt_tokens = metrics_registry.histogram(
+    "gateway_prompt_tokens", "Cerebras prompt size in tokens, as reported by the API", buckets=SIZE_BUCKETS
+)
+route_decisions = metrics_registry.counter(
+    "gateway_route_decisions_total", "Requests by routing decision", ("route",)
+)
+fallbacks = metrics_registry.counter(
+    "gateway_fallbacks_total", "Cerebras streams handed over to the local model", ("cause", "stage")
+)
+client_disconnects = metrics_registry.counter(
+    "gateway_client_disconnects_total", "Streams cancelled because the client went away", ("route",)
+)
+metrics_registry.gauge("gateway_online", "Latest probe: internet reachable").set_function(
+    lambda: int(network_status.online)
+)
+metrics_registry.gauge("gateway_cerebras_circuit_open", "Cerebras circuit breaker is open").set_function(
+    lambda: int(cerebras_breaker.state == "open")
+)
+metrics_registry.gauge("gateway_response_cache_entries", "Answers in the response cache").set_function(
+    lambda: response_cache.stats()["entries"]
+)
+
+# Request traces (see shared/tracing.py); probes, scrapes and the debug endpoints themselves are not traced
+tracer = Tracer(TRACE_BUFFER_SIZE, TRACE_MAX_SPANS)
+app.add_middleware(TracingMiddleware, tracer=tracer, exclude=("/health", "/metrics", "/debug"))
+
+# Rate limits (scope: "session" or "global"; unit: "requests" or "tokens") and Cerebras quota admission
+rate_limiter = RateLimiter(
+    RATE_LIMIT_SESSION_REQUESTS, RATE_LIMIT_SESSION_TOKENS, RATE_LIMIT_GLOBAL_REQUESTS, RATE_LIMIT_GLOBAL_TOKENS
+)
+cerebras_budget = TokenBudget(
+    round(CEREBRAS_TOKENS_PER_MINUTE * CEREBRAS_TPM_SHARE), CEREBRAS_HEADROOM, reply_tokens=CEREBRAS_MAX_TOKENS / 4
+)
+rate_limited = metrics_registry.counter(
+    "gateway_rate_limited_total", "Requests refused by a rate limit", ("scope", "unit")
+)
+cerebras_admissions = metrics_registry.counter(
+    "gateway_cerebras_admissions_total", "Cerebras-routed requests by quota admission", ("outcome",)
+)
+metrics_registry.gauge(
+    "gateway_cerebras_quota_tokens", "Cerebras tokens charged over the last minute (streams in flight at their estimate)"
+).set_function(cerebras_budget.used)
+backend_pool = BackendPool(
+    LOCAL_MODEL_URLS,
+    metrics_registry,
+    discovery=BACKEND_DISCOVERY,
+    health_interval=BACKEND_HEALTH_INTERVAL,
+    eject_failures=BACKEND_EJECT_FAILURES,
+    eject_backoff=BACKEND_EJECT_BACKOFF,
+    slow_factor=BACKEND_SLOW_FACTOR,
+    affinity_slack=BACKEND_AFFINITY_SLACK,
+)
+
+# The gateway's copy of session histories (the backend's is authoritative), synced by revision
+session_mirror = SessionMirror(SESSION_MIRROR_SESSIONS)
+session_syncs = metrics_registry.counter(
+    "gateway_session_syncs_total", "Session history syncs with a backend replica", ("kind",)
+)
+
 
 async def check_internet_connectivity() -> bool:
-    """Check if internet is available by pinging reliable endpoints"""
+    """Check if internet is available by probing reliable endpoints concurrently"""
     test_urls = [
         "https://www.google.com",
         "https://1.1.1.1",  # Cloudflare DNS
         "https://8.8.8.8",  # Google DNS
     ]
-    
-    async with httpx.AsyncClient(timeout=3.0) as client:
-        for url in test_urls:
-            try:
-                response = await client.get(url)
-                if response.status_code == 200:
-                    logger.info(f"Internet connectivity confirmed via {url}")
-                    return True
-            except Exception as e:
-                logger.debug(f"Failed to reach {url}: {e}")
-                continue
-    
-    logger.warning("No internet connectivity detected")
+
+    async def probe(url: str) -> bool:
+        try:
+            # Any HTTP response at all proves connectivity
+            await http_client.head(url, timeout=3.0)
+            return True
+        except Exception as e:
+            logger.debug(f"Failed to reach {url}: {e}")
+            return False
+
+    pending = {asyncio.create_task(probe(url)) for url in test_urls}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if any(task.result() for task in done):
+                return True
+    finally:
+        # The first answer settles it; don't leave the other probes running until their timeout
+        for task in pending:
+            task.cancel()
+
+    logger.debug("No internet connectivity detected")
     return False
 
 
+async def get_cerebras_client() -> AsyncCerebras:
+    """
+    Async Cerebras client, created once
+    Construction runs in a worker thread because newer SDKs warm the TCP connection synchronously.
+    """
+    global cerebras_client
+    async with cerebras_client_lock:
+        if cerebras_client is None:
+            cerebras_client = await asyncio.to_thread(AsyncCerebras, api_key=CEREBRAS_API_KEY)
+    return cerebras_client
+
+
 async def check_cerebras_availability() -> bool:
-    """Check if Cerebras API is available and responding"""
+    """Token-free liveness check: list models instead of running a completion"""
     if not CEREBRAS_API_KEY:
-        logger.warning("No Cerebras API key configured")
         return False
-    
+
     try:
-        global cerebras_client
-        if cerebras_client is None:
-            cerebras_client = Cerebras(api_key=CEREBRAS_API_KEY)
-        
-        # Try a minimal API call to check availability
-        # This is a lightweight check
-        response = cerebras_client.chat.completions.create(
-            model=CEREBRAS_MODEL,
-            messages=[{"role": "user", "content": "test"}],
-            max_tokens=1,
-            stream=False
+        response = await http_client.get(
+            f"{CEREBRAS_BASE_URL}/v1/models",
+            headers={"Authorization": f"Bearer {CEREBRAS_API_KEY}"},
+            timeout=3.0,
         )
-        
-        logger.info("Cerebras API is available")
-        return True
+        if response.status_code == 200:
+            return True
+        logger.warning(f"Cerebras liveness check returned {response.status_code}")
+        return False
     except Exception as e:
-        logger.error(f"Cerebras API unavailable: {e}")
+        logger.warning(f"Cerebras API unreachable: {e}")
         return False
 
 
-async def detect_network_status() -> dict:
+async def probe_network() -> NetworkStatus:
+    """Run all probes concurrently and publish a fresh status snapshot"""
+    global network_status
+    online, cerebras_reachable = await asyncio.gather(
+        check_internet_connectivity(), check_cerebras_availability()
+    )
+    status = NetworkStatus(
+        online=online or cerebras_reachable,
+        cerebras_available=cerebras_reachable,
+        last_check=datetime.datetime.now().isoformat(),
+    )
+    if (status.online, status.cerebras_available) != (network_status.online, network_status.cerebras_available):
+        logger.info(f"Network status: Online={status.online}, Cerebras={status.cerebras_available}")
+    network_status = status
+    return status
+
+
+async def network_prober():
+    """Background loop that keeps `network_status` fresh"""
+    while True:
+        try:
+            await probe_network()
+        except Exception as e:
+            logger.error(f"Network probe failed: {e}")
+        await asyncio.sleep(NETWORK_PROBE_INTERVAL)
+
+
+def should_use_cerebras() -> bool:
+    """Routing decision from the published snapshot and the breaker; never touches the network"""
+    return network_status.cerebras_available and cerebras_breaker.allow_request()
+
+
+def estimate_prompt_tokens(messages: list) -> int:
+    """Conservative prompt size (~3 chars/token, ~4 tokens of chat format per message), system prompt included"""
+    tokens = sum(len(str(m.get("content", ""))) // 3 + 5 for m in messages)
+    if not messages or messages[0].get("role") != "system":
+        tokens += len(SYSTEM_PROMPT_ONLINE) // 3 + 5
+    return tokens
+
+
+def admit_cerebras(prompt_tokens: int):
+    """Cerebras quota reservation for a request, or None to send it to the local model"""
+    reservation = cerebras_budget.admit(prompt_tokens)
+    cerebras_admissions.labels("deferred" if reservation is None else "admitted").inc()
+    return reservation
+
+
+def turn_prompt(mirrored, query: str) -> list:
     """
-    Comprehensive network detection
-    Returns: dict with online and cerebras_available status
+    Cerebras messages for a new turn: system prompt, the newest mirrored history that fits the
+    context (a rolling summary is a system message of its own), then the query
     """
-    import datetime
-    
-    # Check if we need to refresh (avoid checking too frequently)
-    now = datetime.datetime.now()
-    if network_cache["last_check"]:
-        elapsed = (now - network_cache["last_check"]).seconds
-        if elapsed < network_cache["check_interval"]:
-            logger.info("Using cached network status")
-            return {
-                "online": network_cache["online"],
-                "cerebras_available": network_cache["cerebras_available"]
-            }
-    
-    # Perform network checks
-    logger.info("Performing network detection...")
-    
-    # Check internet connectivity
-    online = await check_internet_connectivity()
-    network_cache["online"] = online
-    
-    # Check Cerebras availability (only if online)
-    cerebras_available = False
-    if online:
-        cerebras_available = await check_cerebras_availability()
-    
-    network_cache["cerebras_available"] = cerebras_available
-    network_cache["last_check"] = now
-    
-    logger.info(f"Network status: Online={online}, Cerebras={cerebras_available}")
-    
-    return {
-        "online": online,
-        "cerebras_available": cerebras_available
+    system = [{"role": "system", "content": SYSTEM_PROMPT_ONLINE}]
+    turn = [{"role": "user", "content": query}]
+    if mirrored is None:
+        return system + turn
+    budget = CEREBRAS_CONTEXT - CEREBRAS_MAX_TOKENS - estimate_prompt_tokens(system + turn)
+    return system + mirrored.window(budget) + turn
+
+
+def reject_if_stale(session_id: str, mirrored, revision: Optional[int]):
+    """409 with the current revision when the client's copy of the history is not the server's"""
+    if revision is None or mirrored is None or revision == mirrored.revision:
+        return
+    detail = {
+        "message": f"Session history has diverged; resync from /sessions/{session_id}/history",
+        "revision": mirrored.revision, "generation": mirrored.generation, "length": len(mirrored.messages),
     }
+    raise HTTPException(status_code=409, detail=detail)
 
 
-async def stream_from_cerebras(messages: list, session_id: str):
-    """Stream response from Cerebras API with proper system prompt"""
-    global cerebras_client
-    
-    if cerebras_client is None:
-        cerebras_client = Cerebras(api_key=CEREBRAS_API_KEY)
+async def sync_session(session_id: str, replica=None, push: bool = False):
+    """
+    Bring the gateway's copy of a session up to date with a backend replica (its home one by
+    default): the turns it is missing, or the whole history if the two have diverged. With `push`,
+    a replica behind the copy (one the session moved to, or that lost it) is resynced from the
+    copy instead. Returns the copy; on failure, the copy as it was (None if there is none).
+    """
+    mirrored = session_mirror.get(session_id)
+    replica = replica or backend_pool.home(session_id)
+    if replica is None:
+        return mirrored
+    params = {"revision": mirrored.revision, "generation": mirrored.generation} if mirrored is not None else {}
+    try:
+        response = await http_client.get(
+            f"{replica.url}/api/sessions/{session_id}/history", params=params, headers=SESSION_SYNC_HEADERS,
+            timeout=SESSION_SYNC_TIMEOUT
+        )
+        response.raise_for_status()
+        state = response.json()
+        if push and mirrored is not None and state["revision"] < mirrored.revision:
+            return await push_session(session_id, replica, list(mirrored.messages), mirrored.revision,
+                                      mirrored.generation)
+        session_syncs.labels("reset" if state["reset"] else "delta").inc()
+        return session_mirror.apply(session_id, state)
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        session_syncs.labels("failed").inc()
+        logger.warning(f"Could not sync session {session_id[:8]}... with {replica.url}: {e}")
+        return mirrored
+
+
+async def push_session(session_id: str, replica, messages: list, revision: int, generation: int):
+    """Full resync of a replica from the gateway's copy, which then follows what the replica stored"""
+    response = await http_client.put(
+        f"{replica.url}/api/sessions/{session_id}/history",
+        json={"messages": messages, "revision": revision, "generation": generation},
+        headers=SESSION_SYNC_HEADERS,
+        timeout=SESSION_SYNC_TIMEOUT,
+    )
+    response.raise_for_status()
+    session_syncs.labels("push").inc()
+    return session_mirror.apply(session_id, {**response.json(), "reset": True, "messages": messages})
+
+
+async def record_turn(session_id: str, query: str, answer: str, source: str) -> Optional[dict]:
+    """
+    Append a turn the gateway answered itself (Cerebras, cache) to the session's history on its
+    home replica, and to the gateway's copy. Returns the new session state, None if not recorded.
+    """
+    replica = backend_pool.home(session_id)
+    if replica is None or not answer:
+        return None
+    turn = [{"role": "user", "content": query, "source": source},
+            {"role": "assistant", "content": answer, "source": source}]
+    mirrored = session_mirror.get(session_id)
+    if mirrored is not None:
+        expected, generation, history = mirrored.revision + len(turn), mirrored.generation, mirrored.messages + turn
+    else:
+        expected = generation = history = None
+    try:
+        response = await http_client.post(
+            f"{replica.url}/api/sessions/{session_id}/turns",
+            json={"messages": [{"role": m["role"], "content": m["content"]} for m in turn], "source": source},
+            headers=SESSION_SYNC_HEADERS,
+            timeout=SESSION_SYNC_TIMEOUT,
+        )
+        response.raise_for_status()
+        state = response.json()
+        if expected is not None and state["revision"] < expected:
+            # The replica lost the session (or the session moved to it): resync it, this turn included
+            mirrored = await push_session(session_id, replica, history, expected, generation)
+            return {"revision": mirrored.revision, "generation": mirrored.generation}
+        session_mirror.append(session_id, turn, state)
+        return state
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        logger.warning(f"Could not record turn for session {session_id[:8]}... on {replica.url}: {e}")
+        return None
+
+
+async def revision_event(session_id: str, query: str, answer: str, source: str):
+    """Record the turn, then tell the client the session revision it is now at"""
+    with span("record_turn"):
+        state = await record_turn(session_id, query, answer, source)
+    if state is not None:
+        yield event(revision=state["revision"], generation=state["generation"])
+
+
+async def stream_from_cerebras(messages: list, session_id: str, partial: Optional[list] = None,
+                               compact: bool = False, reservation: Optional[tuple] = None):
+    """
+    Stream response from Cerebras API with proper system prompt
+    Uses the async SDK so waiting on tokens never blocks the event loop; concurrent
+    streams, health checks and local proxying interleave on the same loop.
+    Deltas are coalesced into frames (see shared/sse.py); sent text is appended to `partial` so a
+    mid-stream failure can be continued locally from exactly what the client has.
+    A quota `reservation` (see admit_cerebras) is settled with the usage the stream reports.
+    """
+    client = await get_cerebras_client()
+    started = time.monotonic()
+    first_token = True
+    timer = streams.timer("online")
+    frames = TextFrames("online", compact, SSE_FRAME_INTERVAL, SSE_FRAME_MAX_CHARS)
+    unsent = []
+    usage = None
     
     # Ensure system prompt is present (prepend if not already there)
     if not messages or messages[0].get("role") != "system":
         messages = [{"role": "system", "content": SYSTEM_PROMPT_ONLINE}] + messages
     
     try:
-        response = cerebras_client.chat.completions.create(
-            model=CEREBRAS_MODEL,
-            messages=messages,
-            temperature=0.8,
-            max_tokens=1024,
-            stream=True
-        )
+        with span("cerebras_connect", messages=len(messages)):
+            response = await client.chat.completions.create(
+                model=CEREBRAS_MODEL,
+                messages=messages,
+                temperature=CEREBRAS_TEMPERATURE,
+                max_tokens=CEREBRAS_MAX_TOKENS,
+                stream=True
+            )
+        streaming = time.perf_counter()
+        first_token_at = None
         
-        for chunk in response:
-            if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                delta = chunk.choices[0].delta
-                if hasattr(delta, 'content') and delta.content:
-                    yield f"data: {json.dumps({'content': delta.content, 'source': 'online'})}\n\n"
+        # Ticks flush text held back while the upstream stalls
+        chunks = with_deadlines_async(response, frames)
+        try:
+            async for chunk in chunks:
+                if chunk is None:
+                    # Upstream stalled with text held back: send it instead of waiting for the next delta
+                    frame = frames.flush()
+                    if frame:
+                        if partial is not None:
+                            partial.extend(unsent)
+                        unsent = []
+                        yield frame
+                    continue
+                if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
+                    delta = chunk.choices[0].delta
+                    if hasattr(delta, 'content') and delta.content:
+                        timer.token()
+                        if first_token:
+                            online_ttfts.append(time.monotonic() - started)
+                            first_token = False
+                            first_token_at = time.perf_counter()
+                            record("cerebras_first_token", streaming, first_token_at)
+                        unsent.append(delta.content)
+                        frame = frames.push(delta.content)
+                        if frame:
+                            if partial is not None:
+                                partial.extend(unsent)
+                            unsent = []
+                            yield frame
+                if getattr(chunk, 'usage', None):
+                    usage = chunk.usage
+                    prompt_tokens.observe(usage.prompt_tokens)
+        finally:
+            # Also closes the upstream connection when our client disconnects mid-stream
+            await chunks.aclose()
+            await response.close()
+            record("cerebras_stream", first_token_at or streaming, chunks=timer.tokens,
+                   completion_tokens=getattr(usage, "completion_tokens", None))
         
-        yield f"data: {json.dumps({'done': True, 'source': 'online'})}\n\n"
+        cerebras_breaker.record_success()
+        frame = frames.flush()
+        if frame:
+            if partial is not None:
+                partial.extend(unsent)
+            yield frame
+        yield event(done=True, source="online")
         
+    except (asyncio.CancelledError, GeneratorExit):
+        cerebras_breaker.record_cancelled()
+        raise
     except Exception as e:
         logger.error(f"Cerebras streaming error: {e}")
+        cerebras_breaker.record_failure()
+        if isinstance(e, RateLimitError):
+            cerebras_budget.throttle(retry_after(e))
         raise
+    finally:
+        timer.finish()
+        if reservation is not None and usage is not None:
+            cerebras_budget.settle(reservation, usage.total_tokens, usage.completion_tokens)
+
+
+async def stream_from_local_model(messages: list, session_id: str, assistant_prefix: str = "", compact: bool = False,
+                                  query: Optional[str] = None):
+    """
+    Forward to local model service (llama.cpp) on a backend replica picked by `backend_pool`
+    With `assistant_prefix`, the local model continues that partial answer instead of starting over.
+    With `query`, only the new turn is sent, at the revision of the gateway's copy of the session;
+    a replica whose history differs (409) is synced with the copy and asked once more.
+    SSE bytes are passed through as they arrive. A replica that is unreachable, busy (429) or still
+    loading (503) before sending anything is skipped for the next one. If our client disconnects,
+    the generator is cancelled and leaving the stream context closes the backend connection, so
+    the backend sees the disconnect too.
+    """
+    timer = streams.timer("local")
+    tried = []
+    status, detail = 503, "No backend replica available"
+    sent = False
+    resynced = False
+    try:
+        while True:
+            replica = backend_pool.choose(session_id, exclude=tried)
+            if replica is None:
+                logger.warning(f"No backend replica could take the request: {detail}")
+                yield event(error=detail, status=status, content="Local model unavailable")
+                yield event(done=True)
+                return
+            tried.append(replica)
+            if query is None:
+                payload = {"messages": messages}
+            else:
+                mirrored = session_mirror.get(session_id)
+                payload = {"query": query, "revision": mirrored.revision if mirrored is not None else None}
 
+            with backend_pool.lease(replica) as lease:
+                connecting = time.perf_counter()
+                try:
+                    async with http_client.stream(
+                        "POST",
+                        f"{replica.url}/api/local/stream",
+                        json={
+                            **payload, "session_id": session_id, "assistant_prefix": assistant_prefix,
+                            "compact": compact,
+                        },
+                    ) as response:
+                        lease.headers_received()
+                        connected = time.perf_counter()
+                        record("backend_connect", connecting, connected, replica=replica.url,
+                               status=response.status_code)
+                        if response.status_code == 409 and not resynced:
+                            # Its history is not our copy's: sync the two, then ask again at the new revision
+                            await response.aread()
+                            lease.outcome = "rejected"
+                            resynced = True
+                            await sync_session(session_id, replica, push=True)
+                            tried.remove(replica)
+                            continue
+                        if response.status_code != 200:
+                            status = response.status_code
+                            detail = (await response.aread()).decode(errors="replace")
+                            lease.outcome = "rejected" if status in (429, 503) else "error"
+                            logger.warning(f"Backend {replica.url} rejected request ({status}): {detail}")
+                            continue
+
+                        first_text = None
+                        received = 0
+                        try:
+                            async for chunk in response.aiter_raw():
+                                # Raw chunks can hold several frames (or only queue updates); count the text frames
+                                frames = count_text_frames(chunk)
+                                if frames > 0:
+                                    timer.token(frames)
+                                    first_text = first_text or time.perf_counter()
+                                received += len(chunk)
+                                sent = True
+                                yield chunk
+                        finally:
+                            ttft = None if first_text is None else round((first_text - connected) * 1000, 2)
+                            record("backend_stream", connected, replica=replica.url, bytes=received,
+                                   first_text_ms=ttft)
+                        # A stream with no text only carried an in-stream refusal (queue full, warming up)
+                        lease.outcome = "ok" if first_text is not None else "rejected"
+                        return
+                except httpx.TransportError as e:
+                    lease.outcome = "error"
+                    if sent:
+                        raise
+                    status, detail = 502, f"Backend unreachable: {e}"
+                    logger.warning(f"Backend {replica.url} unreachable, trying another: {e}")
+
+    except asyncio.CancelledError:
+        logger.info(f"Client disconnected, closing local stream for session {session_id[:8]}...")
+        raise
+    except Exception as e:
+        logger.error(f"Local model streaming error: {e}")
+        yield event(error=str(e), content="Local model failed")
+    finally:
+        timer.finish()
+
+
+def online_cache_key(messages: list) -> Optional[str]:
+    """Cache key for the last user message in the context of the conversation before it"""
+    conversation = [m for m in messages if m.get("role") != "system"]
+    if not conversation or conversation[-1].get("role") != "user":
+        return None
+    return cache_key(
+        conversation[-1].get("content", ""), SYSTEM_PROMPT_ONLINE, conversation[:-1],
+        CEREBRAS_MODEL, CEREBRAS_TEMPERATURE,
+    )
+
+
+async def cache_get(key: str):
+    """Cached (answer, source) for `key`, or None; SQLite lookups run off the event loop."""
+    if response_cache.persistent:
+        return await asyncio.to_thread(response_cache.get, key)
+    return response_cache.get(key)
+
+
+async def cache_put(key: Optional[str], answer: str):
+    """Cache an answer Cerebras finished on its own; SQLite writes run off the event loop."""
+    if not key:
+        return
+    if response_cache.persistent:
+        await asyncio.to_thread(response_cache.put, key, answer, "online")
+    else:
+        response_cache.put(key, answer, "online")
+
+
+async def replay_cached_response(answer: str, source: str, compact: bool = False, session_id: str = None,
+                                 query: Optional[str] = None):
+    """Stream a cached answer at a steady pace (with `query`, recorded as the session's new turn)"""
+    timer = streams.timer("cache")
+    try:
+        for i, frame in enumerate(replay_frames(answer, source, RESPONSE_CACHE_REPLAY_CHARS, compact)):
+            if i and RESPONSE_CACHE_REPLAY_INTERVAL:
+                await asyncio.sleep(RESPONSE_CACHE_REPLAY_INTERVAL)
+            timer.token()
+            yield frame
+    finally:
+        timer.finish()
+    if query is not None:
+        async for frame in revision_event(session_id, query, answer, source):
+            yield frame
 
-async def stream_from_local_model(messages: list, session_id: str):
-    """Forward to local model service (llama.cpp)"""
-    # Forward request to the backend's local model service
-    async with httpx.AsyncClient(timeout=120.0) as client:
+
+def event_stream(frames, compact: bool = False) -> StreamingResponse:
+    """SSE response; X-SSE-Framing tells the client which framing it is getting"""
+    return StreamingResponse(
+        frames, media_type="text/event-stream", headers={"X-SSE-Framing": "compact" if compact else "standard"}
+    )
+
+
+async def cancel_on_disconnect(stream, route: str):
+    """
+    Forward `stream`, and close it as soon as the client goes away.
+    Closing propagates into the Cerebras and local-model streams, which close their upstream
+    connections: Cerebras stops generating tokens we pay for, and the backend sees the
+    disconnect and frees its model worker.
+    """
+    finished = False
+    try:
+        async for frame in stream:
+            yield frame
+        finished = True
+    except Exception:
+        finished = True
+        raise
+    finally:
+        if not finished:
+            logger.info(f"Client disconnected from {route} stream")
+            client_disconnects.labels(route).inc()
+            await stream.aclose()
+
+
+def decide(route: str):
+    """Count a routing decision and note it on the request's trace"""
+    route_decisions.labels(route).inc()
+    annotate(route=route)
+
+
+def record_fallback(error: Exception, partial: list):
+    """Count a fallback by its cause and note it on the trace; the request keeps its one routing decision"""
+    cause = fallback_cause(error)
+    fallbacks.labels(cause, "mid_stream" if partial else "before_first_token").inc()
+    annotate(fallback=cause)
+
+
+async def stream_with_failover(messages: list, session_id: str, compact: bool = False,
+                               reservation: Optional[tuple] = None, query: Optional[str] = None):
+    """
+    Cerebras stream that, if it breaks (before or mid-answer), hands over to the local model.
+    Text already sent is kept and the local model continues from it, so the client sees one answer.
+    Answers Cerebras finishes on its own go into the response cache (and, with `query`, the session).
+    """
+    partial = []
+    try:
+        async for frame in stream_from_cerebras(messages, session_id, partial, compact, reservation):
+            yield frame
+    except Exception as e:
+        logger.warning(f"Cerebras failed after {len(partial)} chunks, continuing on local model: {e}")
+        record_fallback(e, partial)
+    else:
+        answer = "".join(partial).strip()
+        await cache_put(online_cache_key(messages), answer)
+        if query is not None:
+            async for frame in revision_event(session_id, query, answer, "online"):
+                yield frame
+        return
+
+    yield event(fallback=True, content="", continuation=bool(partial))
+    async for chunk in stream_from_local_model(messages, session_id, "".join(partial), compact, query):
+        yield chunk
+
+
+def hedge_deadline() -> float:
+    """Fixed HEDGE_DEADLINE, or the p95 of recent Cerebras TTFTs once we have enough samples"""
+    if HEDGE_DEADLINE > 0:
+        return HEDGE_DEADLINE
+    if len(online_ttfts) < 20:
+        return HEDGE_INITIAL_DEADLINE
+    samples = sorted(online_ttfts)
+    return max(samples[int(0.95 * (len(samples) - 1))], HEDGE_MIN_DEADLINE)
+
+
+async def hedged_stream(messages: list, session_id: str, compact: bool = False, reservation: Optional[tuple] = None,
+                        query: Optional[str] = None):
+    """
+    Start Cerebras; if it has no first token within the hedge deadline (or fails first), start
+    the local model as well. Whichever produces a token first is streamed, the other is cancelled.
+    An answer Cerebras finishes goes into the response cache and, with `query`, the session
+    (the backend records its own).
+    """
+    hedge_stats["requests"] += 1
+    queue = asyncio.Queue()
+    tasks = {}
+    started = {}
+    received = {"online": [0, 0], "local": [0, 0]}  # frames, bytes
+
+    async def pump(name: str, stream):
         try:
-            # Call the backend's local model endpoint
-            response = await client.post(
-                "http://backend:8000/api/local/stream",
-                json={"messages": messages, "session_id": session_id},
-                timeout=120.0
-            )
-            
-            async for line in response.aiter_lines():
-                if line.startswith("data: "):
-                    yield f"{line}\n\n"
-                    
+            async for frame in stream:
+                queue.put_nowait((name, frame))
         except Exception as e:
-            logger.error(f"Local model streaming error: {e}")
-            yield f"data: {json.dumps({'error': str(e), 'content': 'Local model failed'})}\n\n"
+            queue.put_nowait((name, e))
+        finally:
+            queue.put_nowait((name, None))
+
+    online_partial = []
+
+    def start(name: str):
+        if name == "online":
+            stream = stream_from_cerebras(messages, session_id, online_partial, compact, reservation)
+        else:
+            stream = stream_from_local_model(messages, session_id, compact=compact, query=query)
+        tasks[name] = asyncio.create_task(pump(name, stream))
+        started[name] = time.monotonic()
+
+    deadline = hedge_deadline()
+    hedge_at = time.monotonic() + deadline
+    start("online")
+    finished = set()
+    pending = {"online": [], "local": []}
+    winner = None
+
+    try:
+        while winner is None and len(finished) < len(tasks):
+            timeout = None if "local" in tasks else max(0.0, hedge_at - time.monotonic())
+            try:
+                name, item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                logger.info(f"No Cerebras token after {deadline:.2f}s, hedging with local model")
+                hedge_stats["hedged"] += 1
+                start("local")
+                continue
+
+            if item is None:
+                finished.add(name)
+            elif isinstance(item, Exception):
+                logger.warning(f"Hedged {name} stream failed: {item}")
+            else:
+                received[name][0] += 1
+                received[name][1] += len(item)
+                if is_text_frame(item):
+                    winner = name
+                pending[name].append(item)
+
+            # Cerebras failed before the deadline: don't wait for it, go local right away
+            if name == "online" and (item is None or isinstance(item, Exception)) and winner is None and "local" not in tasks:
+                hedge_stats["hedged"] += 1
+                start("local")
+
+        if winner is None:
+            hedge_stats["no_winner"] += 1
+            yield event(error="No model produced a response", content="Error: Could not generate response.")
+            yield event(done=True)
+            return
+
+        hedge_stats["wins"][winner] += 1
+        annotate(hedge_winner=winner)
+        loser = "local" if winner == "online" else "online"
+        if loser in tasks:
+            tasks[loser].cancel()
+            hedge_stats["wasted_frames"] += received[loser][0]
+            hedge_stats["wasted_bytes"] += received[loser][1]
+            hedge_stats["wasted_seconds"] += time.monotonic() - started[loser]
+        logger.info(f"Hedged request won by {winner} (deadline {deadline:.2f}s)")
+
+        yield event(hedge={"winner": winner, "hedged": "local" in tasks, "deadline": round(deadline, 3)}, content="")
+        for frame in pending[winner]:
+            yield frame
+        while winner not in finished:
+            name, item = await queue.get()
+            if name != winner:
+                continue
+            if item is None:
+                finished.add(name)
+            elif isinstance(item, Exception):
+                # Cerebras broke after winning: the local model continues the same answer
+                logger.warning(f"Cerebras failed mid-stream, continuing on local model: {item}")
+                record_fallback(item, online_partial)
+                yield event(fallback=True, content="", continuation=True)
+                async for chunk in stream_from_local_model(
+                    messages, session_id, "".join(online_partial), compact, query
+                ):
+                    yield chunk
+                return
+            else:
+                yield item
+        if winner == "online":
+            # Cached like an unhedged answer, so hedging does not change what the cache holds
+            answer = "".join(online_partial).strip()
+            await cache_put(online_cache_key(messages), answer)
+            if query is not None:
+                async for frame in revision_event(session_id, query, answer, "online"):
+                    yield frame
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+
+async def propagate_trace(request: httpx.Request):
+    """Backend calls made while serving a traced request carry its trace id"""
+    trace = current_trace()
+    if trace is not None:
+        request.headers[TRACE_HEADER] = trace.trace_id
+
+
+@app.on_event("startup")
+async def startup_event():
+    global http_client
+    http_client = httpx.AsyncClient(
+        event_hooks={"request": [propagate_trace]},
+        timeout=httpx.Timeout(120.0, connect=5.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0),
+    )
+    if not SESSION_SYNC_TOKEN:
+        logger.warning("SESSION_SYNC_TOKEN is not set: session histories cannot be synced with the backend")
+    global prober_task, backend_health_task
+    if NETWORK_PROBE_INTERVAL > 0:
+        prober_task = asyncio.create_task(network_prober())
+    if BACKEND_HEALTH_INTERVAL > 0:
+        backend_health_task = asyncio.create_task(backend_pool.run(http_client))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if prober_task is not None:
+        prober_task.cancel()
+    if backend_health_task is not None:
+        backend_health_task.cancel()
+    if http_client is not None:
+        await http_client.aclose()
+    response_cache.close()
 
 
 @app.get("/")
@@ -227,12 +1012,14 @@ def root():
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint with network status"""
-    status = await detect_network_status()
+    """Health check endpoint with the latest published network status (never probes inline)"""
+    status = network_status
     return {
         "status": "healthy",
-        "online": status["online"],
-        "cerebras_available": status["cerebras_available"]
+        "online": status.online,
+        "cerebras_available": status.cerebras_available,
+        "last_check": status.last_check,
+        "cerebras_circuit": cerebras_breaker.snapshot(),
     }
 
 
@@ -241,53 +1028,156 @@ async def chat_endpoint(request: ChatRequest):
     """
     Main chat endpoint with automatic routing
     Routes to Cerebras if online, falls back to local model if offline
+    A `query` turn is answered from the session's server-side history (Cerebras prompts from the
+    gateway's synced copy of it); the stream ends with the session's new revision.
     """
     try:
-        # Detect network status
-        network_status = await detect_network_status()
-        
-        # Decide routing
-        use_cerebras = network_status["cerebras_available"]
+        query = request.query
+        if query is not None:
+            if not query.strip():
+                raise HTTPException(status_code=400, detail="Empty query")
+            mirrored = session_mirror.get(request.session_id)
+            messages = turn_prompt(mirrored, query)
+        else:
+            messages = request.messages
+        prompt_tokens = estimate_prompt_tokens(messages)
+        reject_if_rate_limited(rate_limiter, rate_limited, request.session_id, prompt_tokens + RATE_LIMIT_REPLY_TOKENS)
+
+        # Our copy is current if the client saw the same revision; otherwise fetch what changed
+        if query is not None and (mirrored is None or request.revision != mirrored.revision):
+            with span("session_sync"):
+                mirrored = await sync_session(request.session_id)
+            reject_if_stale(request.session_id, mirrored, request.revision)
+            messages = turn_prompt(mirrored, query)
+            prompt_tokens = estimate_prompt_tokens(messages)
+
+        # Repeat questions are answered from the cache whichever way we would route
+        key = None if request.no_cache else online_cache_key(messages)
+        cached = await cache_get(key) if key else None
+        if cached:
+            logger.info("Serving cached response")
+            decide("cache")
+            return event_stream(
+                cancel_on_disconnect(
+                    replay_cached_response(*cached, request.compact, request.session_id, query), "cache"
+                ),
+                request.compact
+            )
+
+        # Decide routing from the background prober's snapshot, the circuit breaker and the Cerebras quota
+        use_cerebras = should_use_cerebras()
+        reservation = admit_cerebras(prompt_tokens) if use_cerebras else None
+        over_quota = use_cerebras and reservation is None
+        use_cerebras = use_cerebras and not over_quota
+        if over_quota:
+            # No Cerebras call will report back: give up a HALF_OPEN trial slot the breaker just handed us
+            cerebras_breaker.record_cancelled()
         
         logger.info(f"Routing request: {'CEREBRAS' if use_cerebras else 'LOCAL MODEL'}")
         
+        hedge = HEDGE_DEFAULT if request.hedge is None else request.hedge
+        if use_cerebras and hedge:
+            decide("hedge")
+            return event_stream(
+                cancel_on_disconnect(
+                    hedged_stream(messages, request.session_id, request.compact, reservation, query), "hedge"
+                ),
+                request.compact
+            )
+        
         if use_cerebras:
-            # Try Cerebras first
-            try:
-                return StreamingResponse(
-                    stream_from_cerebras(request.messages, request.session_id),
-                    media_type="text/event-stream"
-                )
-            except Exception as e:
-                logger.warning(f"Cerebras failed, falling back to local: {e}")
-                # Send fallback notification
-                async def fallback_stream():
-                    yield f"data: {json.dumps({'fallback': True, 'content': ''})}\n\n"
-                    async for chunk in stream_from_local_model(request.messages, request.session_id):
-                        yield chunk
-                
-                return StreamingResponse(
-                    fallback_stream(),
-                    media_type="text/event-stream"
-                )
+            # Errors happen while streaming, after this returns, so failover lives in the generator
+            decide("cerebras")
+            return event_stream(
+                cancel_on_disconnect(
+                    stream_with_failover(messages, request.session_id, request.compact, reservation, query),
+                    "cerebras"
+                ),
+                request.compact
+            )
         else:
             # Use local model directly
-            return StreamingResponse(
-                stream_from_local_model(request.messages, request.session_id),
-                media_type="text/event-stream"
+            decide("quota" if over_quota else "local")
+            return event_stream(
+                cancel_on_disconnect(
+                    stream_from_local_model(messages, request.session_id, compact=request.compact, query=query),
+                    "local"
+                ),
+                request.compact
             )
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Chat endpoint error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(metrics_registry.render(), media_type=metrics_registry.content_type)
+
+
+# Admin only: /debug/traces and /debug/profile (see shared/debug.py)
+app.include_router(
+    debug_router(tracer, ADMIN_TOKEN, PROFILE_INTERVAL, PROFILE_MAX_SECONDS), prefix="/debug", tags=["Debug"]
+)
+
+
+@app.get("/hedge/stats")
+async def get_hedge_stats():
+    """Hedging rate, winners and wasted work, for tuning HEDGE_DEADLINE"""
+    requests = hedge_stats["requests"]
+    return {
+        **hedge_stats,
+        "hedge_rate": round(hedge_stats["hedged"] / requests, 4) if requests else 0.0,
+        "current_deadline": round(hedge_deadline(), 3),
+        "ttft_samples": len(online_ttfts),
+    }
+
+
+@app.get("/backends")
+async def get_backends():
+    """Backend replicas: health, ejections, streams in flight, latency, and session affinity"""
+    return backend_pool.stats()
+
+
+@app.get("/sessions/{session_id}/history")
+async def get_session_history(session_id: str, revision: Optional[int] = None, generation: Optional[int] = None):
+    """
+    The session's revision and generation, with the messages appended since the caller's
+    `revision` of the same `generation`; otherwise (`reset`) the whole history
+    """
+    mirrored = await sync_session(session_id)
+    if mirrored is None:
+        raise HTTPException(status_code=503, detail="No backend replica could provide the session history")
+    return mirrored.since(revision, generation)
+
+
+@app.get("/sessions/mirror/stats")
+async def get_session_mirror_stats():
+    """Mirrored sessions, and how many syncs were deltas rather than full resets"""
+    return session_mirror.stats()
+
+
+@app.get("/limits/stats")
+async def get_limits_stats():
+    """Rate limits with what is left of the global allowance, and the Cerebras quota admission state"""
+    return {"rate_limits": rate_limiter.stats(), "cerebras_quota": cerebras_budget.stats()}
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """Response cache size, hit rate and evictions"""
+    return response_cache.stats()
+
+
 @app.post("/refresh-network")
 async def refresh_network_status():
-    """Force refresh network status (bypasses cache)"""
-    network_cache["last_check"] = None
-    status = await detect_network_status()
-    return status
+    """Force an immediate probe instead of waiting for the next background run"""
+    status = await probe_network()
+    return {"online": status.online, "cerebras_available": status.cerebras_available}
 
 
 if __name__ == "__main__":
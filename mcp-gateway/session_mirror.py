@@ -0,0 +1,121 @@
+"""
+The gateway's copy of each session's history. The backend holds the authoritative one; the copy
+follows it by revision (see the backend's SessionStore) with small deltas, and is what Cerebras
+prompts are built from and what a backend replica that lost a session is resynced from.
+"""
+from collections import OrderedDict
+
+SUMMARY_SOURCE = "summary"
+
+
+def estimate_tokens(message: dict) -> int:
+    """~3 chars/token plus ~4 tokens of chat format per message, as the backend estimates online prompts"""
+    return len(str(message.get("content", ""))) // 3 + 5
+
+
+class MirroredSession:
+    __slots__ = ("revision", "generation", "messages")
+
+    def __init__(self, revision: int, generation: int, messages: list):
+        self.revision = revision
+        self.generation = generation
+        self.messages = messages
+
+    def window(self, budget: int) -> list:
+        """Newest whole messages within `budget` tokens, after the rolling summary (as the backend windows)."""
+        messages = self.messages
+        summary = []
+        if messages and messages[0].get("source") == SUMMARY_SOURCE:
+            summary, messages = messages[:1], messages[1:]
+            if estimate_tokens(summary[0]) <= budget:
+                budget -= estimate_tokens(summary[0])
+            else:
+                summary = []
+        start = len(messages)
+        used = 0
+        while start > 0 and used + estimate_tokens(messages[start - 1]) <= budget:
+            used += estimate_tokens(messages[start - 1])
+            start -= 1
+        selected = messages[start:]
+        # Never open the window on an orphaned assistant reply
+        if selected and selected[0]["role"] == "assistant":
+            selected = selected[1:]
+        return [{"role": m["role"], "content": m["content"]} for m in summary + selected]
+
+    def since(self, revision: int = None, generation: int = None) -> dict:
+        """What a copy at (`revision`, `generation`) is missing, in the backend's GET .../history format."""
+        messages = self.messages
+        missing = self.revision - revision if revision is not None else -1
+        pinned = 1 if messages and messages[0].get("source") == SUMMARY_SOURCE else 0
+        state = {"revision": self.revision, "generation": self.generation, "length": len(messages)}
+        if generation == self.generation and 0 <= missing <= len(messages) - pinned:
+            return {**state, "reset": False, "messages": messages[len(messages) - missing:]}
+        return {**state, "reset": True, "messages": list(messages)}
+
+
+class SessionMirror:
+    """Mirrored sessions, least recently used dropped first beyond `max_sessions`."""
+
+    def __init__(self, max_sessions: int = 10000):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._stats = {"deltas": 0, "resets": 0, "messages_received": 0}
+
+    def get(self, session_id: str):
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def apply(self, session_id: str, state: dict) -> MirroredSession:
+        """
+        Apply a backend answer: a delta or full history (GET/PUT .../history) brings the copy to its
+        revision; a bare state (POST .../turns) only moves the revision on.
+        """
+        session = self._sessions.get(session_id)
+        messages = state.get("messages")
+        if messages is not None and (state.get("reset") or session is None):
+            session = MirroredSession(state["revision"], state["generation"], list(messages))
+            self._sessions[session_id] = session
+            self._stats["resets"] += 1
+        elif messages is not None:
+            session.messages.extend(messages)
+            session.revision, session.generation = state["revision"], state["generation"]
+            self._stats["deltas"] += 1
+        elif session is not None:
+            session.revision, session.generation = state["revision"], state["generation"]
+        else:
+            return None
+        self._stats["messages_received"] += len(messages or ())
+
+        # The backend caps stored messages, keeping a rolling summary at the head: do the same
+        excess = len(session.messages) - state.get("length", len(session.messages))
+        if excess > 0:
+            pinned = 1 if session.messages[0].get("source") == SUMMARY_SOURCE else 0
+            del session.messages[pinned:pinned + excess]
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return session
+
+    def append(self, session_id: str, messages: list, state: dict) -> bool:
+        """
+        Record a turn the gateway itself answered, at the revision the backend gave it. False (and
+        the copy dropped, to be fetched afresh) if something else changed the history meanwhile.
+        """
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = MirroredSession(0, state["generation"], [])
+        if (session.revision + len(messages), session.generation) != (state["revision"], state["generation"]):
+            self._sessions.pop(session_id, None)
+            return False
+        session.messages.extend(messages)
+        self.apply(session_id, {"revision": state["revision"], "generation": state["generation"],
+                                "length": state["length"]})
+        return True
+
+    def drop(self, session_id: str):
+        self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._sessions), "max_sessions": self.max_sessions, **self._stats}
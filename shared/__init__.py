@@ -0,0 +1,5 @@
+"""
+Modules used by both the backend and the gateway: metrics, tracing, the profiler, SSE framing,
+the response cache, rate limits, request guards (admin token, rate-limit refusals) and Cerebras
+error handling. Each image copies this package next to its own code.
+"""
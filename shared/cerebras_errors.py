@@ -0,0 +1,36 @@
+"""
+Reading Cerebras SDK errors the same way in the backend and the gateway: how long a 429 asked
+us to wait, and a bounded metric label for why a call failed.
+"""
+from cerebras.cloud.sdk import (
+    APIConnectionError, APIStatusError, APITimeoutError, AuthenticationError, RateLimitError
+)
+
+# Most specific first: a timeout is also a connection error, every status error an APIStatusError
+_CAUSES = (
+    (APITimeoutError, "timeout"),
+    (APIConnectionError, "connection"),
+    (RateLimitError, "rate_limited"),
+    (AuthenticationError, "auth"),
+    (APIStatusError, "api_status"),
+)
+
+
+def retry_after(error: RateLimitError) -> float:
+    """Seconds Cerebras asked us to wait after a 429 (a short pause if it did not say)."""
+    try:
+        return float(error.response.headers.get("retry-after", "5"))
+    except (AttributeError, ValueError):
+        return 5.0
+
+
+def fallback_cause(error: Exception) -> str:
+    """
+    Coarse, bounded label for why a Cerebras call failed. An SDK error wrapped in another
+    exception (the backend's service re-raises them as ValueError) is labelled by what it wraps.
+    """
+    for candidate in (error, error.__cause__ or error.__context__):
+        for kind, label in _CAUSES:
+            if isinstance(candidate, kind):
+                return label
+    return "other"
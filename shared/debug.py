@@ -0,0 +1,69 @@
+"""
+Admin-only debug endpoints, the same in the backend (under /api/debug) and the gateway (under
+/debug): buffered request traces and an on-demand sampling profile of the live process.
+"""
+import logging
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+
+from . import profiler
+from .guards import require_admin
+
+logger = logging.getLogger(__name__)
+
+
+def debug_router(tracer, admin_token: str, profile_interval: float, profile_max_seconds: float) -> APIRouter:
+    """
+    Routes over this service's `tracer` and profiler. All of them take "Authorization: Bearer
+    <admin_token>": trace names are request paths, which carry session ids.
+    """
+    router = APIRouter()
+
+    @router.get("/traces")
+    async def recent_traces(limit: int = 50, name: Optional[str] = None, min_ms: float = 0,
+                            authorization: Optional[str] = Header(None)):
+        """
+        Completed request traces, newest first, with their spans (queueing, prompt eval and decode
+        on the backend; session sync and Cerebras on the gateway; response writes on both). `name`
+        filters by "METHOD /path" prefix, `min_ms` keeps only slower requests. A gateway request's
+        backend half is found under the same trace id.
+        """
+        require_admin(authorization, admin_token)
+        return {"traces": tracer.recent(max(1, min(limit, 1000)), name=name, min_ms=min_ms), **tracer.stats()}
+
+    @router.get("/traces/{trace_id}")
+    async def get_trace(trace_id: str, authorization: Optional[str] = Header(None)):
+        """Every buffered trace with this id (a gateway request that was retried reaches the backend more than once)"""
+        require_admin(authorization, admin_token)
+        traces = tracer.recent(tracer.capacity or 1, trace_id=trace_id)
+        if not traces:
+            raise HTTPException(status_code=404, detail="No buffered trace with this id")
+        return {"traces": traces}
+
+    @router.post("/profile")
+    async def profile(seconds: float = 5.0, interval: float = profile_interval, include_idle: bool = False,
+                      format: str = "json", authorization: Optional[str] = Header(None)):
+        """
+        Sample the live process's stacks for `seconds` (at most PROFILE_MAX_SECONDS) and return the
+        hottest functions and folded stacks; `format=folded` returns just the folded stacks, for
+        flamegraph.pl or speedscope. One profile runs at a time (409 otherwise).
+        """
+        require_admin(authorization, admin_token)
+        if not 0 < seconds <= profile_max_seconds:
+            raise HTTPException(status_code=400, detail=f"seconds must be in (0, {profile_max_seconds}]")
+        if format not in ("json", "folded"):
+            raise HTTPException(status_code=400, detail="format must be 'json' or 'folded'")
+        logger.info(f"Profiling for {seconds}s at {interval * 1000:.1f}ms intervals")
+        try:
+            # Sampled from a worker thread, so the event loop keeps serving (and shows up in the profile)
+            result = await run_in_threadpool(profiler.sample, seconds, max(interval, 0.001), include_idle)
+        except profiler.ProfilerBusy as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        if format == "folded":
+            return PlainTextResponse("\n".join(result["folded"]) + "\n")
+        return result
+
+    return router
@@ -0,0 +1,40 @@
+"""
+Request guards for the backend's and the gateway's FastAPI handlers: each raises the
+HTTPException the client should get, so both services refuse requests the same way.
+"""
+import hmac
+import math
+from typing import Optional
+
+from fastapi import HTTPException
+
+from .rate_limit import RateLimitExceeded
+
+
+def require_token(authorization: Optional[str], expected: str, what: str, setting: str):
+    """
+    403 unless the request carries "Authorization: Bearer <expected>" (always, while `expected` is
+    empty). `what` names the endpoints and `setting` the variable that holds the token, for the error.
+    """
+    if not expected:
+        raise HTTPException(status_code=403, detail=f"{what} endpoints are disabled ({setting} is not set)")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), expected.encode()):
+        raise HTTPException(status_code=403, detail=f"{what} token required")
+
+
+def require_admin(authorization: Optional[str], admin_token: str):
+    """403 unless the request carries "Authorization: Bearer <admin_token>" (always, while admin_token is empty)"""
+    require_token(authorization, admin_token, "Admin", "ADMIN_TOKEN")
+
+
+def reject_if_rate_limited(limiter, counter, session_id: str, tokens: int):
+    """
+    429 with Retry-After once the session, or everyone together, is over `limiter`'s per-minute
+    limits; refusals are counted in `counter` by scope and unit.
+    """
+    try:
+        limiter.acquire(session_id, tokens)
+    except RateLimitExceeded as e:
+        counter.labels(e.scope, e.unit).inc()
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
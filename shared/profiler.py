@@ -0,0 +1,98 @@
+"""
+Sampling profiler for the live process: every `interval` it records the Python stack of each
+thread (sys._current_frames), and aggregates the samples into per-function self and total
+counts and folded stacks (the `flamegraph.pl` / speedscope input format).
+
+Sampling only reads frames, so the profiled code runs unmodified; the cost is the sampling
+thread's own work (a stack walk per thread per sample), which it reports as `overhead`.
+Native code (llama.cpp, sockets) shows as the Python frame that called it.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Leaf frames of threads that are waiting rather than working (event loop select, idle pools, queues)
+IDLE_LEAVES = {
+    ("selectors.py", "select"), ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"), ("thread.py", "_worker"), ("socket.py", "accept"), ("socketserver.py", "serve_forever"),
+}
+
+
+class ProfilerBusy(Exception):
+    """A profile is already running; one at a time keeps the overhead bounded."""
+
+
+_running = threading.Lock()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def sample(seconds: float, interval: float = 0.005, include_idle: bool = False, top: int = 30) -> dict:
+    """
+    Sample every thread's stack for `seconds` (blocking the caller; run it in a thread). Idle
+    threads' samples are left out unless `include_idle`. Raises ProfilerBusy if one is running.
+    """
+    if not _running.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    try:
+        me = threading.get_ident()
+        names = {}
+        stacks = Counter()
+        self_counts = Counter()
+        total_counts = Counter()
+        samples = idle = 0
+        overhead = 0.0
+        started = time.perf_counter()
+        deadline = started + seconds
+        while True:
+            tick = time.perf_counter()
+            if tick >= deadline:
+                break
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                code = frame.f_code
+                if not include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_LEAVES:
+                    idle += 1
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.reverse()
+                samples += 1
+                stacks[(names.get(thread_id, str(thread_id)),) + tuple(labels)] += 1
+                self_counts[labels[-1]] += 1
+                total_counts.update(set(labels))
+            overhead += time.perf_counter() - tick
+            time.sleep(max(0.0, interval - (time.perf_counter() - tick)))
+        elapsed = time.perf_counter() - started
+    finally:
+        _running.release()
+
+    def share(count: int) -> float:
+        return round(100.0 * count / samples, 2) if samples else 0.0
+
+    return {
+        "seconds": round(elapsed, 3),
+        "interval": interval,
+        "samples": samples,
+        "idle_samples": idle,
+        "overhead": round(overhead / elapsed, 4) if elapsed else 0.0,
+        "top_self": [
+            {"function": name, "samples": count, "percent": share(count)}
+            for name, count in self_counts.most_common(top)
+        ],
+        "top_total": [
+            {"function": name, "samples": count, "percent": share(count)}
+            for name, count in total_counts.most_common(top)
+        ],
+        "folded": [f"{';'.join(stack)} {count}" for stack, count in stacks.most_common()],
+    }
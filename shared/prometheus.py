@@ -0,0 +1,244 @@
+import threading
+import time
+from bisect import bisect_left
+from functools import partial
+
+# Seconds; covers sub-100ms cache replays up to multi-minute local generations
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple, lock: threading.Lock, new_child):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = lock
+        self._new_child = new_child  # makes the value kept for one label combination
+        self._children = {}
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            lines.extend(child.render(self.name, self.labelnames, values))
+        return lines
+
+
+class _Value:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self, lock: threading.Lock):
+        self.value = 0.0
+        self._lock = lock
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self, name: str, labelnames: tuple, values: tuple) -> list:
+        return [f"{name}{_format_labels(labelnames, values)} {_format_value(self.value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple, lock: threading.Lock):
+        super().__init__(name, documentation, labelnames, lock, partial(_Value, lock))
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    """Gauge set by the caller, or computed at scrape time with `set_function`."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple, lock: threading.Lock):
+        super().__init__(name, documentation, labelnames, lock, partial(_Value, lock))
+        self._function = None
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        """`function()` returns a number, or a dict of label-value tuple -> number."""
+        self._function = function
+
+    def render(self) -> list:
+        if self._function is not None:
+            result = self._function()
+            items = result.items() if isinstance(result, dict) else [((), result)]
+            for values, value in items:
+                self.labels(*values).set(value)
+        return super().render()
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets: tuple, lock: threading.Lock):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = lock
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self, name: str, labelnames: tuple, values: tuple) -> list:
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else _format_value(bound)
+            labels = _format_labels(labelnames, values, 'le="' + le + '"')
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labelnames, values)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labelnames, values)} {cumulative}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Fixed-bucket histogram: one bisect and two additions per observation."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple, lock: threading.Lock,
+                 buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, lock, partial(_HistogramValue, self.buckets, lock))
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+
+class Registry:
+    """A set of metrics rendered together in the Prometheus text exposition format."""
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._add(Counter(name, documentation, labelnames, self._lock))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._add(Gauge(name, documentation, labelnames, self._lock))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labelnames, self._lock, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class StreamMetrics:
+    """TTFT, duration, generation speed and in-flight count for streamed responses, by source."""
+
+    def __init__(self, registry: Registry, prefix: str):
+        self.ttft = registry.histogram(
+            f"{prefix}_ttft_seconds", "Time from request to first generated text", ("source",)
+        )
+        self.duration = registry.histogram(
+            f"{prefix}_stream_duration_seconds", "Time from request to the end of the stream", ("source",)
+        )
+        self.rate = registry.histogram(
+            f"{prefix}_tokens_per_second", "Generation speed after the first token", ("source",), buckets=RATE_BUCKETS
+        )
+        self.active = registry.gauge(f"{prefix}_active_streams", "Responses currently streaming", ("source",))
+
+    def timer(self, source: str) -> "StreamTimer":
+        return StreamTimer(self, source)
+
+
+class StreamTimer:
+    """
+    Per-stream bookkeeping. The token loop only calls `token()`, which is a counter bump
+    after the first call; histograms are updated once, in `finish()`.
+    """
+
+    __slots__ = ("metrics", "source", "started", "first_token_at", "tokens", "finished")
+
+    def __init__(self, metrics: StreamMetrics, source: str):
+        self.metrics = metrics
+        self.source = source
+        self.started = time.perf_counter()
+        self.first_token_at = None
+        self.tokens = 0
+        self.finished = False
+        metrics.active.labels(source).inc()
+
+    def token(self, count: int = 1):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            self.metrics.ttft.labels(self.source).observe(self.first_token_at - self.started)
+        self.tokens += count
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        now = time.perf_counter()
+        self.metrics.active.labels(self.source).dec()
+        self.metrics.duration.labels(self.source).observe(now - self.started)
+        if self.first_token_at is not None and self.tokens > 1 and now > self.first_token_at:
+            self.metrics.rate.labels(self.source).observe((self.tokens - 1) / (now - self.first_token_at))
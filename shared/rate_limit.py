@@ -0,0 +1,200 @@
+"""
+Token-bucket rate limits per session and overall, and admission against an upstream API's
+tokens-per-minute quota.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimitExceeded(Exception):
+    """A request was refused by the `scope` ("session" or "global") limit on `unit` ("requests" or "tokens")."""
+
+    def __init__(self, scope: str, unit: str, retry_after: float):
+        super().__init__(f"Rate limit exceeded ({scope} {unit} per minute), retry in {retry_after:.1f}s")
+        self.scope = scope
+        self.unit = unit
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Holds up to `capacity` units, refilled at `rate` units per second (lazily, when used)."""
+
+    __slots__ = ("capacity", "rate", "level", "updated")
+
+    def __init__(self, capacity: float, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.level = capacity
+        self.updated = now
+
+    def wait(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units are available, 0 if they are now (more than `capacity` needs a full bucket)."""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount: float):
+        # An oversized request leaves the bucket in debt, so it still costs its full size
+        self.level -= amount
+
+
+class RateLimiter:
+    """
+    Request and estimated-token limits per minute, for each session and across all of them.
+
+    Each limit is a token bucket holding one minute's allowance (so a quiet session can burst
+    up to it) that refills continuously; 0 disables a limit. A request is admitted only if every
+    bucket can pay for it, and then pays all of them, so a refused request costs nothing. Each
+    check touches four buckets. Buckets are kept for the `max_sessions` most recently seen
+    sessions; one that falls out starts over with full buckets, as it would after a quiet minute.
+    """
+
+    UNITS = ("requests", "tokens")
+
+    def __init__(self, session_requests: int, session_tokens: int, global_requests: int, global_tokens: int,
+                 max_sessions: int = 10000):
+        self.limits = {"session": (session_requests, session_tokens), "global": (global_requests, global_tokens)}
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._global = self._buckets("global", time.monotonic())
+        self._sessions = OrderedDict()  # session id -> buckets, least recently seen first
+        self._stats = {"admitted": 0, "limited": 0}
+
+    def _buckets(self, scope: str, now: float) -> tuple:
+        return tuple(TokenBucket(limit, limit / 60.0, now) if limit else None for limit in self.limits[scope])
+
+    def acquire(self, session_id: str, tokens: int):
+        """Admit one request of about `tokens` tokens, or raise RateLimitExceeded for the limit with the longest wait."""
+        now = time.monotonic()
+        with self._lock:
+            buckets = self._sessions.get(session_id)
+            if buckets is None:
+                buckets = self._sessions[session_id] = self._buckets("session", now)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+
+            charges = []
+            refusal = None
+            for scope, scope_buckets in (("session", buckets), ("global", self._global)):
+                for unit, bucket, amount in zip(self.UNITS, scope_buckets, (1, tokens)):
+                    if bucket is None:
+                        continue
+                    wait = bucket.wait(amount, now)
+                    if wait > 0 and (refusal is None or wait > refusal[2]):
+                        refusal = (scope, unit, wait)
+                    charges.append((bucket, amount))
+            if refusal is not None:
+                self._stats["limited"] += 1
+                raise RateLimitExceeded(*refusal)
+            for bucket, amount in charges:
+                bucket.take(amount)
+            self._stats["admitted"] += 1
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            remaining = {}
+            for unit, bucket in zip(self.UNITS, self._global):
+                if bucket is not None:
+                    bucket.wait(0, now)  # refill
+                    remaining[unit] = max(round(bucket.level), 0)
+            return {
+                "limits": {scope: dict(zip(self.UNITS, limits)) for scope, limits in self.limits.items()},
+                "global_remaining": remaining,
+                "sessions_tracked": len(self._sessions),
+                **self._stats,
+            }
+
+
+class TokenBudget:
+    """
+    Admission against an upstream tokens-per-minute quota, from the usage it reports.
+
+    `admit()` charges a request's estimated tokens (its prompt plus a moving average of reply
+    lengths) to a sliding minute, unless that would take the minute's total past `headroom` of
+    `tokens_per_minute`; overflow can then go elsewhere before the API starts answering 429.
+    `settle()` corrects the charge to the tokens the request really used once it reports them
+    (a request that never does, e.g. a cancelled stream, keeps its estimate). A 429 that comes
+    anyway closes admission for its Retry-After (`throttle()`). The minute is kept in one-second
+    slots. 0 tokens per minute admits everything (usage is still tracked).
+    """
+
+    def __init__(self, tokens_per_minute: int, headroom: float = 0.9, reply_tokens: float = 256):
+        self.tokens_per_minute = tokens_per_minute
+        self.headroom = headroom
+        self.reply_tokens = reply_tokens
+        self._lock = threading.Lock()
+        self._slots = [0] * 60  # tokens charged in each second of the last minute
+        self._second = int(time.monotonic())
+        self._used = 0
+        self._blocked_until = 0.0
+        self._stats = {"admitted": 0, "deferred": 0, "throttled": 0}
+
+    def _advance(self, now: float):
+        """Forget the slots that fell out of the minute (at most all 60 of them)."""
+        second = int(now)
+        for elapsed in range(max(self._second + 1, second - 59), second + 1):
+            self._used -= self._slots[elapsed % 60]
+            self._slots[elapsed % 60] = 0
+        self._second = max(self._second, second)
+
+    def _charge(self, second: int, tokens: int):
+        self._slots[second % 60] += tokens
+        self._used += tokens
+
+    def admit(self, prompt_tokens: int):
+        """Charge a request's estimate: its reservation (for `settle()`), or None if it does not fit the quota now."""
+        now = time.monotonic()
+        estimate = prompt_tokens + round(self.reply_tokens)
+        with self._lock:
+            self._advance(now)
+            over = self._used and self._used + estimate > self.headroom * self.tokens_per_minute
+            if self.tokens_per_minute and (now < self._blocked_until or over):
+                self._stats["deferred"] += 1
+                return None
+            self._charge(self._second, estimate)
+            self._stats["admitted"] += 1
+            return self._second, estimate
+
+    def settle(self, reservation: tuple, total_tokens: int = None, completion_tokens: int = None):
+        """Correct a reservation's charge to the tokens the request used, when it reports them."""
+        second, estimate = reservation
+        with self._lock:
+            if completion_tokens is not None:
+                self.reply_tokens += 0.2 * (completion_tokens - self.reply_tokens)
+            if total_tokens is None:
+                return
+            self._advance(time.monotonic())
+            if second > self._second - 60:
+                self._charge(second, total_tokens - estimate)
+            else:
+                self._charge(self._second, total_tokens)  # the estimate has already left the minute
+
+    def throttle(self, seconds: float):
+        """The API refused a request for quota: admit nothing for `seconds`."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._stats["throttled"] += 1
+
+    def used(self) -> int:
+        """Tokens charged over the last minute."""
+        with self._lock:
+            self._advance(time.monotonic())
+            return self._used
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            self._advance(now)
+            return {
+                "tokens_per_minute": self.tokens_per_minute,
+                "headroom": self.headroom,
+                "used_last_minute": self._used,
+                "reply_tokens": round(self.reply_tokens),
+                "blocked_for": round(max(self._blocked_until - now, 0.0), 1),
+                **self._stats,
+            }
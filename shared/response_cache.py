@@ -0,0 +1,182 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!.,;:]+$")
+
+
+def normalize_query(query: str) -> str:
+    """Case, whitespace and trailing punctuation don't change the question."""
+    return _TRAILING_PUNCTUATION.sub("", _WHITESPACE.sub(" ", query.strip().lower()))
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def history_fingerprint(history: list) -> str:
+    """'first' for a first turn (so repeat questions hit across sessions), else a digest of the history."""
+    if not history:
+        return "first"
+    return _digest(json.dumps([[m["role"], m["content"]] for m in history]))[:16]
+
+
+def cache_key(query: str, system_prompt: str, history: list, model: str, temperature: float) -> str:
+    parts = [
+        normalize_query(query),
+        _digest(system_prompt)[:12],  # system prompt version
+        history_fingerprint(history),
+        model,
+        f"{round(temperature, 1):.1f}",  # temperature bucket
+    ]
+    return _digest("\x1f".join(parts))
+
+
+def _size(answer: str) -> int:
+    """Bytes an answer counts against the cap: its UTF-8 length, not its character count."""
+    return len(answer.encode("utf-8"))
+
+
+class ResponseCache:
+    """
+    Exact-match answer cache: LRU under a byte cap, entries expire after `ttl` seconds.
+    With `db_path`, entries are also written through to SQLite and reloaded on a memory miss,
+    so cached answers survive restarts. `get()` and `put()` then do blocking I/O (see `persistent`).
+    Entries evicted from memory are deleted from SQLite too, and expired rows are swept out on
+    open and every PRUNE_INTERVAL, so the file stays about as large as the byte cap.
+    """
+
+    PRUNE_INTERVAL = 60 * 60  # seconds between sweeps of expired rows
+
+    def __init__(self, max_bytes: int, ttl: float, db_path: str = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (answer, source, created_at)
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._stores = 0
+
+        self._db = None
+        self._pruned_at = 0.0
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, answer TEXT NOT NULL, source TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._prune(time.time())
+
+    @property
+    def persistent(self) -> bool:
+        """Whether lookups and stores touch SQLite (async callers should run them in a thread)."""
+        return self._db is not None
+
+    def get(self, *keys: str):
+        """First live entry among `keys` as (answer, source), or None. Counts one hit or miss."""
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None and self._db is not None:
+                    row = self._db.execute(
+                        "SELECT answer, source, created_at FROM responses WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row and now - row[2] <= self.ttl:
+                        entry = tuple(row)
+                        self._insert(key, entry)
+                    elif row:
+                        self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                        self._db.commit()
+                if entry is None:
+                    continue
+                if now - entry[2] > self.ttl:
+                    self._remove(key)
+                    continue
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry[0], entry[1]
+            self._misses += 1
+            return None
+
+    def put(self, key: str, answer: str, source: str):
+        if not answer or _size(answer) > self.max_bytes:
+            return
+        entry = (answer, source, time.time())
+        with self._lock:
+            self._remove(key)
+            self._insert(key, entry)
+            self._stores += 1
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, *entry))
+                self._db.commit()
+                if entry[2] - self._pruned_at >= self.PRUNE_INTERVAL:
+                    self._prune(entry[2])
+
+    def _insert(self, key: str, entry: tuple):
+        self._entries[key] = entry
+        self._bytes += _size(entry[0])
+        evicted = []
+        while self._bytes > self.max_bytes:
+            evicted_key, evicted_entry = self._entries.popitem(last=False)
+            self._bytes -= _size(evicted_entry[0])
+            self._evictions += 1
+            evicted.append((evicted_key,))
+        if evicted and self._db is not None:
+            self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+            self._db.commit()
+
+    def _prune(self, now: float):
+        """Delete expired rows, then the oldest past the byte cap (rows memory never reloaded, or a larger old cap)."""
+        self._db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        kept = 0
+        over = []
+        rows = self._db.execute(
+            "SELECT key, length(CAST(answer AS BLOB)) FROM responses ORDER BY created_at DESC"  # UTF-8 bytes
+        )
+        for key, size in rows:
+            kept += size
+            if kept > self.max_bytes:
+                over.append((key,))
+        self._db.executemany("DELETE FROM responses WHERE key = ?", over)
+        self._db.commit()
+        self._pruned_at = now
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= _size(entry[0])
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "stores": self._stores,
+                "evictions": self._evictions,
+                "persistent": self._db is not None,
+            }
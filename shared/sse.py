@@ -0,0 +1,197 @@
+"""
+Server-sent event framing shared by every streaming path.
+
+Text frames are built from pre-serialized templates, so each frame costs one json.dumps of the
+text. Compact framing (opted into per request) sends text as a bare JSON string, and the source
+once in a leading event instead of in every frame:
+
+    standard:  data: {"content": " world", "source": "offline"}
+    compact:   data: {"source": "offline"}      (first frame only)
+               data: " world"
+
+Control events (queue positions, fallback, errors, done) are JSON objects in both framings.
+"""
+import asyncio
+import json
+import queue
+import threading
+import time
+
+FRAME_INTERVAL = 0.05  # seconds; target age of a coalesced frame
+FRAME_MAX_CHARS = 256
+
+
+def event(**fields) -> str:
+    """One control event frame."""
+    return f"data: {json.dumps(fields)}\n\n"
+
+
+def is_text_frame(frame) -> bool:
+    """True for frames carrying generated text (not queue positions, errors or done markers), in either framing."""
+    if isinstance(frame, bytes):
+        frame = frame.decode(errors="ignore")
+    if frame.startswith('data: "') or '\ndata: "' in frame:
+        return True
+    return '"content": "' in frame and '"content": ""' not in frame and '"error"' not in frame
+
+
+def count_text_frames(chunk: bytes) -> int:
+    """Text frames in a raw chunk of SSE bytes (which may hold several frames, or none)."""
+    return sum(1 for frame in chunk.split(b"\n\n") if frame and is_text_frame(frame))
+
+
+class TextFrames:
+    """
+    Encodes one stream's generated text as SSE frames, coalescing deltas adaptively.
+
+    The first delta is sent at once, so time to first token is unchanged. After that, a frame is
+    sent as soon as waiting for one more delta (at the recent token rate) would make it older
+    than `interval`: a slow model still gets one frame per token, a fast one gets about one frame
+    per `interval` instead of thousands of tiny writes. `interval=0` sends every delta.
+
+    Held-back text is due at `pending_deadline()`. If the upstream stalls before the next delta,
+    the stream loop flushes it then (see `with_deadlines`), so it is not held until that delta.
+    """
+
+    def __init__(self, source: str, compact: bool = False, interval: float = FRAME_INTERVAL,
+                 max_chars: int = FRAME_MAX_CHARS, **extra):
+        self.compact = compact
+        self.interval = interval
+        self.max_chars = max_chars
+        if compact:
+            self._header = event(source=source, **extra)
+            self._prefix, self._suffix = "data: ", "\n\n"
+        else:
+            self._header = ""
+            self._prefix = 'data: {"content": '
+            self._suffix = ", " + json.dumps({"source": source, **extra})[1:] + "\n\n"
+
+        self._buffer = []
+        self._buffered = 0
+        self._opened_at = 0.0
+        self._last_delta_at = None
+        self._gap = None  # moving average of the time between deltas
+        self.frames = 0
+        self.bytes = 0
+
+    def push(self, text: str) -> str:
+        """Add a delta; returns the frame to send now, or "" while it is being coalesced."""
+        if not text:
+            return ""
+        now = time.monotonic()
+        if self._last_delta_at is not None:
+            gap = now - self._last_delta_at
+            self._gap = gap if self._gap is None else self._gap + 0.3 * (gap - self._gap)
+        self._last_delta_at = now
+
+        if not self._buffer:
+            self._opened_at = now
+        self._buffer.append(text)
+        self._buffered += len(text)
+
+        if (self.frames == 0 or self._gap is None or self._buffered >= self.max_chars
+                or now - self._opened_at + self._gap >= self.interval):
+            return self._emit()
+        return ""
+
+    def flush(self) -> str:
+        """Whatever is still held back; call before the done event."""
+        return self._emit() if self._buffer else ""
+
+    def pending_deadline(self):
+        """time.monotonic() by which held-back text should be sent, or None if nothing is held."""
+        return self._opened_at + self.interval if self._buffer else None
+
+    def text(self, text: str) -> str:
+        """A frame for `text` right away, without coalescing (e.g. replaying stored answers)."""
+        return self.flush() + self._frame(text)
+
+    def _emit(self) -> str:
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        return self._frame(text)
+
+    def _frame(self, text: str) -> str:
+        frame = self._prefix + json.dumps(text) + self._suffix
+        if self.frames == 0:
+            frame = self._header + frame
+        self.frames += 1
+        self.bytes += len(frame)
+        return frame
+
+
+def _timeout(frames: TextFrames):
+    deadline = frames.pending_deadline()
+    return None if deadline is None else max(deadline - time.monotonic(), 0.0)
+
+
+_DONE = object()
+
+
+def with_deadlines(chunks, frames: TextFrames):
+    """
+    The items of a blocking iterator, with None in between whenever text held back by `frames`
+    is due; the caller then sends `frames.flush()`. The iterator is read by a thread of its own,
+    which stops at the next item once this generator is closed.
+    """
+    items = queue.Queue()
+    closed = threading.Event()
+
+    def read():
+        try:
+            for chunk in chunks:
+                items.put((chunk, None))
+                if closed.is_set():
+                    return
+        except Exception as e:
+            items.put((_DONE, e))
+        items.put((_DONE, None))
+
+    threading.Thread(target=read, name="sse-reader", daemon=True).start()
+    try:
+        while True:
+            try:
+                chunk, error = items.get(timeout=_timeout(frames))
+            except queue.Empty:
+                yield None
+                continue
+            if error is not None:
+                raise error
+            if chunk is _DONE:
+                return
+            yield chunk
+    finally:
+        closed.set()
+
+
+async def with_deadlines_async(chunks, frames: TextFrames):
+    """`with_deadlines` for an async iterator; waits on its next item without cancelling it."""
+    iterator = chunks.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=_timeout(frames))
+            if not done:
+                yield None
+                continue
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+def replay_frames(answer: str, source: str, chars_per_frame: int, compact: bool = False) -> list:
+    """SSE frames replaying a cached answer in fixed-size pieces."""
+    step = max(chars_per_frame, 1)
+    frames = TextFrames(source, compact, cached=True)
+    replay = [frames.text(answer[i:i + step]) for i in range(0, len(answer), step)]
+    replay.append(event(done=True, cached=True))
+    return replay
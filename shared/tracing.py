@@ -0,0 +1,186 @@
+"""
+Lightweight request tracing: a trace per request, timed spans within it, and a ring buffer of
+completed traces. The gateway sends its trace id to the backend in the X-Trace-Id header, so one
+id finds both halves.
+
+Spans are flat (start offset and duration within the trace, like a waterfall), so code running
+concurrently for one request (a hedge, a pump thread) can add them without coordination. Outside
+a traced request every call here is a cheap no-op.
+"""
+import contextvars
+import re
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+TRACE_HEADER = "X-Trace-Id"
+_VALID_ID = re.compile(r"^[0-9A-Za-z._-]{1,64}$")
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    """One request: its id, name (method and path), attributes, and spans."""
+
+    __slots__ = ("trace_id", "name", "attrs", "started_at", "started", "duration", "spans", "max_spans", "dropped")
+
+    def __init__(self, name: str, trace_id: str = None, max_spans: int = 256):
+        self.trace_id = trace_id if trace_id and _VALID_ID.match(trace_id) else secrets.token_hex(8)
+        self.name = name
+        self.attrs = {}
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.spans = []  # (name, start, duration, attrs), seconds since the trace started
+        self.max_spans = max_spans
+        self.dropped = 0
+
+    def add(self, name: str, started: float, ended: float = None, **attrs):
+        """Record a span from `started` to `ended` (time.perf_counter() values; `ended` defaults to now)."""
+        if len(self.spans) >= self.max_spans:
+            self.dropped += 1
+            return
+        ended = time.perf_counter() if ended is None else ended
+        self.spans.append((name, started - self.started, ended - started, attrs))
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": round(self.started_at, 3),
+            "duration_ms": None if self.duration is None else round(self.duration * 1000, 2),
+            "attrs": self.attrs,
+            "spans": [
+                {"name": name, "start_ms": round(start * 1000, 2), "duration_ms": round(duration * 1000, 2), **attrs}
+                for name, start, duration, attrs in self.spans
+            ],
+            "dropped_spans": self.dropped,
+        }
+
+
+class Tracer:
+    """Starts traces and keeps the last `capacity` completed ones (0 disables tracing)."""
+
+    def __init__(self, capacity: int = 1000, max_spans: int = 256):
+        self.capacity = capacity
+        self.max_spans = max_spans
+        self._lock = threading.Lock()
+        self._traces = deque(maxlen=capacity or 1)
+        self._stats = {"started": 0, "finished": 0}
+
+    def start(self, name: str, trace_id: str = None):
+        """A new trace, made current for this context (None while tracing is disabled)."""
+        if not self.capacity:
+            return None
+        trace = Trace(name, trace_id, self.max_spans)
+        _current.set(trace)
+        self._stats["started"] += 1
+        return trace
+
+    def finish(self, trace: Trace):
+        trace.duration = time.perf_counter() - trace.started
+        with self._lock:
+            self._traces.append(trace)
+            self._stats["finished"] += 1
+
+    def recent(self, limit: int = 50, trace_id: str = None, name: str = None, min_ms: float = 0) -> list:
+        """Completed traces, newest first, optionally filtered by id, name prefix and minimum duration."""
+        with self._lock:
+            traces = list(self._traces)
+        found = []
+        for trace in reversed(traces):
+            if trace_id is not None and trace.trace_id != trace_id:
+                continue
+            if name is not None and not trace.name.startswith(name):
+                continue
+            if trace.duration * 1000 < min_ms:
+                continue
+            found.append(trace.to_dict())
+            if len(found) >= limit:
+                break
+        return found
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"capacity": self.capacity, "buffered": len(self._traces) if self.capacity else 0, **self._stats}
+
+
+def current_trace():
+    return _current.get()
+
+
+def annotate(**attrs):
+    """Add attributes to the current trace (e.g. the route a request took)."""
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+def record(name: str, started: float, ended: float = None, **attrs):
+    """Record a span on the current trace, from `started` (time.perf_counter()) to `ended` or now."""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, started, ended, **attrs)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Time the enclosed block as a span of the current trace."""
+    trace = _current.get()
+    if trace is None:
+        yield attrs
+        return
+    started = time.perf_counter()
+    try:
+        yield attrs  # the block may add attributes
+    finally:
+        trace.add(name, started, **attrs)
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware: traces each HTTP request outside `exclude` (path prefixes), under the
+    caller's X-Trace-Id if it sent one, and returns the id in the same header. The trace ends
+    when the response body has been sent. A `response_write` span, from the first body chunk,
+    lasts the total time spent handing chunks (SSE frames) to the server: long when a slow
+    client makes the server wait before it can send more.
+    """
+
+    def __init__(self, app, tracer: Tracer, exclude: tuple = ()):
+        self.app = app
+        self.tracer = tracer
+        self.exclude = exclude
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.tracer.capacity or scope["path"].startswith(self.exclude):
+            await self.app(scope, receive, send)
+            return
+
+        header = TRACE_HEADER.lower().encode()
+        trace_id = next((value.decode("latin-1") for key, value in scope["headers"] if key == header), None)
+        trace = self.tracer.start(f"{scope['method']} {scope['path']}", trace_id)
+        writes = {"seconds": 0.0, "chunks": 0, "bytes": 0, "first": None}
+
+        async def traced_send(message):
+            if message["type"] == "http.response.start":
+                trace.attrs["status"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(header, trace.trace_id.encode())]
+                await send(message)
+                return
+            started = time.perf_counter()
+            await send(message)
+            if message["type"] == "http.response.body" and message.get("body"):
+                writes["first"] = writes["first"] or started
+                writes["seconds"] += time.perf_counter() - started
+                writes["chunks"] += 1
+                writes["bytes"] += len(message["body"])
+
+        try:
+            await self.app(scope, receive, traced_send)
+        finally:
+            if writes["chunks"]:
+                trace.add("response_write", writes["first"], writes["first"] + writes["seconds"],
+                          chunks=writes["chunks"], bytes=writes["bytes"])
+            self.tracer.finish(trace)